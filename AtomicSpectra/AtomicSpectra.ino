@@ -5,7 +5,10 @@
  */
  
 #define BAUD 115200              
-#define STEP_DELAY 560           // Step delay for motor pulses
+#define FIRMWARE_VERSION "1.0"   // Reported in the READY banner and the ping reply
+#define STEP_DELAY 560           // Step delay for motor pulses (default high and low phase, us)
+#define RAMP_SIZE  128           // Number of steps in the precomputed acceleration ramp
+#define PROGRAM_SIZE 64          // Number of targets a move program can hold
 
 #define PIN_STEP 6
 #define PIN_DIR  7
@@ -15,12 +18,30 @@
 #define PIN_PMT  A1
 
 /** Serial data handling **/
-const byte data_size = 64;        // Size of the data buffer receiving from the serial line 
-char received_data[data_size];    // Array for storing received data
+const byte data_size  = 64;       // Size of the data buffer receiving from the serial line 
+const byte queue_size = 6;        // Number of received commands that can wait to be parsed
+char received_data[queue_size][data_size]; // Queue of received commands, so frames sent back to back are not dropped
+byte queue_head  = 0;             // Index of the oldest command in the queue
+byte queue_count = 0;             // Number of commands in the queue
 char temp_data    [data_size];    // Temporary array for use when parsing
 char functionCall[20]  = {0};     //
-boolean newData = false;          // Flag used to indicate if new data has been found on the serial line
+boolean newData = false;          // Flag used to indicate if new data is waiting in the queue
 char * strtok_index;              // Used by strtok() as an index
+long reply_tag = -1;              // Tag of the command being answered (<#tag:cmd,args>), -1 if untagged
+
+/** Binary framing: SYNC, type, length, payload (little-endian), XOR checksum **/
+const byte FRAME_SYNC  = 0xA5;
+const byte FRAME_VALUE = 0x01;    // One 16-bit value (PMT, position, knob, switches...)
+const byte FRAME_SCAN  = 0x02;    // Scan header: start, signed step and number of points (16-bit each)
+const byte FRAME_SUM16 = 0x03;    // Block of 16-bit PMT sums
+const byte FRAME_SUM32 = 0x04;    // Block of 32-bit PMT sums
+const byte FRAME_END   = 0x05;    // End of a data stream
+boolean binary_mode = false;      // Flag used to indicate if replies are sent as binary frames
+byte scan_block[128];             // Block of PMT sums waiting to be sent as one frame
+
+/** Telemetry **/
+unsigned long telemetry_period = 0; // Time between status frames (ms), 0 when nobody subscribed
+unsigned long telemetry_last   = 0; // Time the last status frame was sent (ms)
 
 /** Motor control **/
 unsigned int motor_position  = 0; // $$(initially 1 to account for arduino reset?)$$
@@ -28,6 +49,38 @@ bool         motor_direction = 0;
 unsigned int MAX_STEP = 58860;    // 147.15 * (400 microsteps/step) (VERIFIED EMPIRICALLY)
 unsigned int MIN_STEP = 100;      // VERIFY THIS
 
+/** Motion state machine (see motion.ino) **/
+enum MOTION_STATE{IDLE, MOVING, HOMING, HOMING_RETURN};
+enum MOTION_STATE motion_state = IDLE;
+const char *MOTION_STATE_NAMES[] = {"IDLE","MOVING","HOMING","HOMING_RETURN","SCANNING"}; // SCANNING is reported while a scan runs
+unsigned int  motion_target = 0;  // Position the motor is moving to
+unsigned long step_time     = 0;  // micros() at the last edge of the step pin
+bool          step_high     = false; // Whether the step pin is high
+unsigned int  step_interval = 2*STEP_DELAY; // Duration of the current step (us)
+unsigned int  steps_done    = 0;  // Steps taken since the current move started
+
+/** Trapezoidal acceleration profile (see motion.ino) **/
+unsigned int  max_speed    = 2400;                     // Cruise speed (steps/s). Moves start at 1000000/(2*STEP_DELAY)
+unsigned long acceleration = 20000;                    // Acceleration and deceleration (steps/s^2)
+unsigned int  ramp_table[RAMP_SIZE];                   // Step intervals (us) while accelerating, slowest first
+byte          ramp_length  = 1;                        // Number of entries used, the last one is the cruise interval
+
+/** Scan in progress (see motion.ino) **/
+unsigned int  scan_points  = 0;   // Number of points in the scan, 0 when no scan is running
+unsigned int  scan_index   = 0;   // Index of the next point
+unsigned int  scan_stride  = 1;
+unsigned int  scan_samples = 1;
+bool          scan_reverse = false;
+long          scan_tag     = -1;  // Tag of the scan command, echoed on every line of the stream
+byte          scan_fill    = 0;   // Number of sums waiting in scan_block
+
+/** Move program: a list of targets run like a scan (see motion.ino) **/
+unsigned int  program[PROGRAM_SIZE];  // Targets, in the order they are visited
+byte          program_length   = 0;   // Number of targets loaded
+bool          program_running  = false; // Whether the scan in progress is the program
+unsigned int  program_backlash = 0;   // Every target is approached moving forward over at least this many steps
+bool          program_approach = false; // Moving to the approach point below the next target
+
 /** Miscellaneous **/ 
 unsigned int displacement;
 unsigned int sum;
@@ -43,19 +96,6 @@ enum CONTROL_MODE{FRONT_PANEL, COMPUTER};
 enum CONTROL_MODE motor_control = FRONT_PANEL;
 const char *CONTROL_MODE_NAMES[] = {"FRONT_PANEL","COMPUTER"};
 
-void step_motor(){
-  /*
-   * 
-   */
-  digitalWrite(PIN_STEP,1);       // Set step pin high
-  delayMicroseconds(STEP_DELAY);  // Delay
-  digitalWrite(PIN_STEP,0);       // Set step pin high
-  delayMicroseconds(STEP_DELAY);  // Delay 
-
-  if(motor_direction) motor_position--;
-  else                motor_position++;
-}
-
 void setup() {
   Serial.begin(BAUD);
   pinMode(PIN_STEP,OUTPUT);         // Motor stepping pin
@@ -66,45 +106,33 @@ void setup() {
 
   pinMode(LED_BUILTIN, OUTPUT);     // Built-in led for debug purposes
 
+  compute_ramp();                   // Acceleration profile for the default speed
+
   if(_debug) set_LED(LOW);
+
+  Serial.println("READY," FIRMWARE_VERSION); // Tell the computer we are listening
 }
 
 void loop() {
   receive_data();                       /* Look for and grab data on the serial line. */
                                         /* If new data is found, the newData flag will be set */ 
   if (newData == true) {
-      strcpy(temp_data, received_data); /* this temporary copy is necessary to protect the original data    */
-                                        /* because strtok() used in parseData() replaces the commas with \0 */
-      parseData();                      // Parse the data for commands
-      newData = false;                  // Reset newData flag
-  }
-}
+      strcpy(temp_data, received_data[queue_head]); /* this temporary copy is necessary to protect the original data    */
+                                                    /* because strtok() used in parseData() replaces the commas with \0 */
+      queue_head = (queue_head + 1) % queue_size;   // Pop the command from the queue
+      queue_count--;
+      newData = queue_count > 0;                    // More commands may be waiting
 
-void home(){
-  if(_debug) set_LED(HIGH);
-  
-  motor_position = 0;                 // Reset motor position variable
-  set_direction(LOW);                 // Set to increasing motor direction
-
-  /* Step the motor and count steps until hitting the switch */
-  while(1){ 
-      if( check_bounds() ){
-        set_calibration(FAILED);     // Record homing failure
-        break;                       // Exit
-      } 
-      if( check_max_limit() ) break; // Exit if switch was triggered 
-      step_motor();                  // Step the motor
-  }
-  set_direction(HIGH);               // Reverse direction
-  displacement = motor_position;     // Save total displacement to the limit switch
-  motor_position = MAX_STEP;         // Set the motor position to its (now) known location         
-    
-  /* Bring the motor back to its original position */
-  while(displacement){
-    step_motor();                    
-    displacement--;
+      parseData();                                  // Parse the data for commands
   }
 
-  if(get_calibration() != FAILED) set_calibration(COMPLETED); // Update motor calibration status
-  if(_debug) set_LED(LOW);
+  motion_update();                      // Step the motor if a step is due
+  scan_update();                        // Take the next scan point once the motor has arrived
+
+  /* Push the status to subscribers on a fixed cadence */
+  if(telemetry_period && millis() - telemetry_last >= telemetry_period){
+    telemetry_last += telemetry_period;
+    if(millis() - telemetry_last >= telemetry_period) telemetry_last = millis(); // Don't try to catch up
+    send_telemetry();
+  }
 }
@@ -6,6 +6,38 @@ unsigned int get_pmt(){
   return analogRead(PIN_PMT);
 }
 
+void send_pmt_stats(unsigned long samples, unsigned long duration){
+  /*
+   * Accumulate samples PMT readings, or as many as fit in duration (us)
+   * if samples is 0, and reply "<n>,<sum>,<sum of squares>,<min>,<max>".
+   * The motor keeps moving while the readings are taken.
+   */
+  unsigned long      n       = 0;
+  unsigned long      total   = 0;
+  unsigned long long squares = 0;
+  unsigned int       lowest  = 1023;
+  unsigned int       highest = 0;
+  unsigned long      start   = micros();
+
+  while(n == 0 || (samples ? n < samples : micros() - start < duration)){
+    unsigned int value = get_pmt();
+    total   += value;
+    squares += (unsigned long)value*value;
+    if(value < lowest)  lowest  = value;
+    if(value > highest) highest = value;
+    n++;
+
+    motion_update();
+  }
+
+  reply_prefix();
+  Serial.print(n);       Serial.print(',');
+  Serial.print(total);   Serial.print(',');
+  print_u64(squares);    Serial.print(',');
+  Serial.print(lowest);  Serial.print(',');
+  Serial.println(highest);
+}
+
 unsigned int get_position(){
   /*
    * Get absolute motor position. 
@@ -0,0 +1,332 @@
+/**
+ * Non-blocking motor control. Motion is a state machine advanced by
+ * motion_update() on every pass of loop(), so serial commands keep being
+ * answered while the motor moves. Each step is a high then a low phase on
+ * the step pin, scheduled from micros().
+ *
+ * Moves follow a trapezoidal speed profile: the step intervals for the
+ * acceleration are precomputed into ramp_table whenever the speed or
+ * acceleration changes, and read back in reverse to decelerate.
+ */
+
+void compute_ramp(){
+  /*
+   * Fill ramp_table for the current max_speed and acceleration. Moves
+   * start at the fixed rate the motor has always run at (2*STEP_DELAY per
+   * step), which it can start and stop at without losing steps, so short
+   * moves and scan points are never slower than that. After n steps the
+   * speed is sqrt(start^2 + 2*a*n), until it reaches max_speed. If the
+   * table is too short to reach max_speed, the last entry caps it. A
+   * max_speed below the start rate is used from the first step.
+   */
+  unsigned int cruise = 1000000UL/max_speed;
+  float        start  = 1e6/(2*STEP_DELAY); // Start/stop speed (steps/s)
+
+  ramp_length = 0;
+  while(ramp_length < RAMP_SIZE-1){
+    float interval = 1e6/sqrt(start*start + 2.0*acceleration*ramp_length);
+    if(interval <= cruise) break;
+    ramp_table[ramp_length++] = interval;
+  }
+
+  if(ramp_length == RAMP_SIZE-1) cruise = ramp_table[ramp_length-1];
+  ramp_table[ramp_length++] = cruise;
+}
+
+void set_speed(unsigned int speed){
+  /*
+   * Set the cruise speed of the motor (steps/s). Step intervals are
+   * 16-bit (us), so the slowest speed is 16 steps/s.
+   */
+  if(speed < 16) speed = 16;
+  max_speed = speed;
+  compute_ramp();
+}
+
+unsigned int get_speed(){
+  return max_speed;
+}
+
+void set_accel(unsigned long accel){
+  /*
+   * Set the acceleration and deceleration of the motor (steps/s^2).
+   */
+  if(accel == 0) accel = 1;
+  acceleration = accel;
+  compute_ramp();
+}
+
+unsigned long get_accel(){
+  return acceleration;
+}
+
+void start_move(unsigned int target){
+  /*
+   * Start moving the motor to the absolute position target.
+   */
+  if(target > MAX_STEP) target = MAX_STEP;
+
+  if(target > motor_position) set_direction(LOW);  // Forward (increasing) direction
+  else                        set_direction(HIGH); // Reverse (decreasing) direction
+
+  motion_target = target;
+  motion_state  = MOVING;
+  steps_done    = 0;                               // Start from the bottom of the ramp
+}
+
+void start_home(){
+  /*
+   * Start homing: step forward until the max limit switch triggers,
+   * then come back to the original position, which is now known.
+   */
+  if(_debug) set_LED(HIGH);
+  
+  motor_position = 0;                 // Reset motor position variable
+  set_direction(LOW);                 // Set to increasing motor direction
+  motion_state = HOMING;
+  steps_done   = 0;
+}
+
+void stop_motion(){
+  /*
+   * Stop the motor after the current step, abandoning any scan in progress.
+   */
+  motion_state = IDLE;
+  if(scan_points) finish_scan();
+  if(_debug) set_LED(LOW);
+}
+
+MOTION_STATE get_state(){
+  return motion_state;
+}
+
+byte get_state_index(){
+  /*
+   * Index of the current state in MOTION_STATE_NAMES, SCANNING while a scan runs.
+   */
+  if(scan_points) return 4;
+  return get_state();
+}
+
+void motion_update(){
+  /*
+   * Advance the motion state machine. Called on every pass of loop().
+   */
+  if(micros() - step_time < step_interval/2) return; // Not time for the next edge yet
+
+  /* Second half of a step */
+  if(step_high){
+    digitalWrite(PIN_STEP,0);
+    step_high = false;
+    step_time = micros();
+    return;
+  }
+
+  /* Decide whether to start another step */
+  switch(motion_state){
+    case IDLE:
+      return;
+
+    case MOVING:
+      if(motor_position == motion_target){
+        motion_state = IDLE;
+        return;
+      }
+      break;
+
+    case HOMING:
+      if( check_bounds() ) set_calibration(FAILED);     // Record homing failure
+      if( get_calibration() == FAILED || check_max_limit() ){ // Exit if out of bounds or the switch was triggered
+        set_direction(HIGH);                            // Reverse direction
+        displacement   = motor_position;                // Save total displacement to the limit switch
+        motor_position = MAX_STEP;                      // Set the motor position to its (now) known location
+        motion_target  = MAX_STEP - displacement;       // Bring the motor back to its original position
+        motion_state   = HOMING_RETURN;
+        steps_done     = 0;
+        return;
+      }
+      break;
+
+    case HOMING_RETURN:
+      if(motor_position == motion_target){
+        if(get_calibration() != FAILED) set_calibration(COMPLETED); // Update motor calibration status
+        if(_debug) set_LED(LOW);
+        motion_state = IDLE;
+        return;
+      }
+      break;
+  }
+
+  /* Accelerate for the first steps, decelerate for the last ones. The
+     distance to the limit switch is unknown while homing, so no deceleration. */
+  unsigned int remaining = (motion_state == HOMING) ? RAMP_SIZE
+                         : (motion_target > motor_position ? motion_target - motor_position : motor_position - motion_target);
+  unsigned int index = min(steps_done, remaining-1);
+  step_interval = ramp_table[min(index, (unsigned int)ramp_length-1)];
+  if(steps_done < RAMP_SIZE) steps_done++;
+
+  /* Always head for the target, whatever set_direction() was given since */
+  if(motion_state != HOMING) set_direction(motion_target < motor_position);
+
+  /* First half of a step. The driver steps on the rising edge. */
+  digitalWrite(PIN_STEP,1);
+  step_high = true;
+  step_time = micros();
+
+  if(motor_direction) motor_position--;
+  else                motor_position++;
+}
+
+void start_scan(unsigned int start, unsigned int stop, unsigned int stride, unsigned int samples){
+  /*
+   * Start a scan from start to stop in increments of stride, summing
+   * samples PMT readings at each point. scan_update() streams
+   * "SCAN,<points>", then one "<position>,<sum>" line per point, then "END"
+   * (or the equivalent binary frames).
+   */
+  if(start  > MAX_STEP) start  = MAX_STEP;
+  if(stop   > MAX_STEP) stop   = MAX_STEP;
+  if(stride  == 0)      stride  = 1;
+  if(samples == 0)      samples = 1;
+
+  scan_reverse = stop < start;
+  scan_points  = (scan_reverse ? start - stop : stop - start)/stride + 1;
+  scan_index   = 0;
+  scan_stride  = stride;
+  scan_samples = samples;
+  scan_tag     = reply_tag;
+  scan_fill    = 0;
+
+  if(binary_mode){
+    int header[3] = {(int)start, scan_reverse ? -(int)stride : (int)stride, (int)scan_points};
+    send_frame(FRAME_SCAN, header, sizeof(header));
+  }
+  else{
+    reply_prefix();
+    Serial.print("SCAN,");
+    Serial.println(scan_points);
+  }
+
+  if(_debug) set_LED(HIGH);
+  start_move(start);
+}
+
+void scan_update(){
+  /*
+   * Take the next scan point once the motor has arrived there.
+   * Called on every pass of loop().
+   */
+  if(scan_points == 0 || motion_state != IDLE) return;
+
+  /* Arrived below a program target: now go up to it */
+  if(program_approach){
+    program_approach = false;
+    start_move(program[scan_index]);
+    return;
+  }
+
+  unsigned long total = 0;
+  for(unsigned int j = 0; j < scan_samples; j++) total += get_pmt();
+
+  /* Replies belong to the scan command, not whatever was parsed last */
+  long tag  = reply_tag;
+  reply_tag = scan_tag;
+
+  if(binary_mode){
+    /* The sums are sent in blocks, 16-bit wide when they are sure to fit */
+    bool wide  = scan_samples > 64;
+    byte width = wide ? 4 : 2;
+
+    if(wide) ((unsigned long *)scan_block)[scan_fill] = total;
+    else     ((unsigned int  *)scan_block)[scan_fill] = total;
+    scan_fill++;
+
+    if(scan_fill*width == sizeof(scan_block) || scan_index == scan_points-1){
+      send_frame(wide ? FRAME_SUM32 : FRAME_SUM16, scan_block, scan_fill*width);
+      scan_fill = 0;
+    }
+  }
+  else{
+    reply_prefix();
+    Serial.print(motor_position);
+    Serial.print(',');
+    Serial.println(total);
+  }
+  reply_tag = tag;
+
+  scan_index++;
+  if     (scan_index == scan_points) finish_scan();
+  else if(program_running)           start_program_move(program[scan_index]);
+  else start_move(scan_reverse ? motor_position - scan_stride : motor_position + scan_stride);
+}
+
+void start_program(unsigned int samples, unsigned int backlash){
+  /*
+   * Run the loaded move program: visit each target in turn and sum
+   * samples PMT readings there. The data is streamed exactly as for a
+   * scan, one point per target (the binary header has a step of 0).
+   */
+  if(samples == 0) samples = 1;
+
+  scan_points      = program_length;
+  scan_index       = 0;
+  scan_samples     = samples;
+  scan_tag         = reply_tag;
+  scan_fill        = 0;
+  program_running  = program_length > 0;
+  program_backlash = backlash;
+
+  if(binary_mode){
+    int header[3] = {program_length ? (int)program[0] : (int)motor_position, 0, (int)program_length};
+    send_frame(FRAME_SCAN, header, sizeof(header));
+  }
+  else{
+    reply_prefix();
+    Serial.print("SCAN,");
+    Serial.println(program_length);
+  }
+
+  if(program_length == 0){
+    finish_scan();
+    return;
+  }
+
+  if(_debug) set_LED(HIGH);
+  start_program_move(program[0]);
+}
+
+void start_program_move(unsigned int target){
+  /*
+   * Move to the next target of the program so that the last
+   * program_backlash steps are forward, going below it first if needed.
+   * The slack in the drive is then always taken up the same way.
+   */
+  bool reversing = motor_direction == HIGH || target < motor_position;
+  if(program_backlash && reversing && target < (unsigned long)motor_position + program_backlash){
+    program_approach = true;
+    start_move(target > program_backlash ? target - program_backlash : 0);
+  }
+  else start_move(target);
+}
+
+void finish_scan(){
+  /*
+   * End the scan stream, sending any sums still waiting.
+   */
+  long tag  = reply_tag;
+  reply_tag = scan_tag;
+
+  if(binary_mode){
+    bool wide = scan_samples > 64;
+    if(scan_fill) send_frame(wide ? FRAME_SUM32 : FRAME_SUM16, scan_block, scan_fill*(wide ? 4 : 2));
+    send_frame(FRAME_END, NULL, 0);
+  }
+  else reply("END");
+
+  reply_tag        = tag;
+  scan_points      = 0;
+  scan_fill        = 0;
+  program_running  = false;
+  program_approach = false;
+  if(_debug) set_LED(LOW);
+}
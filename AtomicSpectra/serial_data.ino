@@ -11,13 +11,15 @@ void receive_data() {
   static byte index = 0;
   char rc;
   
-  while (Serial.available() > 0 && newData == false) {
+  /* Keep reading until the queue is full, so several frames can arrive back to back */
+  while (Serial.available() > 0 && queue_count < queue_size) {
+    char *received = received_data[(queue_head + queue_count) % queue_size];
     rc = Serial.read();
    
     if (recv_in_progress == true) {
       
       if (rc != endMarker) {
-        received_data[index] = rc;
+        received[index] = rc;
         index++;
         
         if (index >= data_size) {
@@ -26,9 +28,10 @@ void receive_data() {
         }
       }
       else {
-        received_data[index] = '\0'; // terminate the string
+        received[index] = '\0';      // terminate the string
         recv_in_progress = false;
         index = 0;
+        queue_count++;               // Push it on the queue
         newData = true;
         //Serial.println(received_data);
       }
@@ -40,46 +43,205 @@ void receive_data() {
   }
 }
 
+void send_frame(byte type, const void *payload, byte length){
+  /*
+   * Send a binary frame. The AVR is little-endian, so numbers
+   * can be copied straight from memory into the payload.
+   */
+  const byte *bytes = (const byte *)payload;
+  byte checksum = type ^ length;
+  for(byte i = 0; i < length; i++) checksum ^= bytes[i];
+
+  Serial.write(FRAME_SYNC);
+  Serial.write(type);
+  Serial.write(length);
+  Serial.write(bytes, length);
+  Serial.write(checksum);
+}
+
+void reply_prefix(){
+  /*
+   * Start a text reply line, echoing the tag of the command if it had one.
+   */
+  if(reply_tag < 0) return;
+  Serial.print('#');
+  Serial.print(reply_tag);
+  Serial.print(':');
+}
+
+void reply(const char *text){
+  reply_prefix();
+  Serial.println(text);
+}
+
+void reply(unsigned long value){
+  reply_prefix();
+  Serial.println(value);
+}
+
+void print_u64(unsigned long long value){
+  /*
+   * Print a 64-bit number, which Serial.print() does not support.
+   */
+  char digits[21];
+  byte i = sizeof(digits) - 1;
+  digits[i] = '\0';
+  do{
+    digits[--i] = '0' + value % 10;
+    value /= 10;
+  } while(value);
+  Serial.print(digits + i);
+}
+
+void send_value(unsigned int value){
+  /*
+   * Reply with a number, as a frame in binary mode or as text otherwise.
+   */
+  if(binary_mode) send_frame(FRAME_VALUE, &value, sizeof(value));
+  else            reply(value);
+}
+
+void send_telemetry(){
+  /*
+   * Send a status frame:
+   * T,<position>,<direction>,<calibration>,<control>,<max limit>,<min limit>,<knob>,<pmt>,<state>
+   * Calibration, control and state are sent as indices into their name arrays.
+   */
+  Serial.print("T,");
+  Serial.print(get_position());               Serial.print(',');
+  Serial.print(get_direction());              Serial.print(',');
+  Serial.print((int)get_calibration());       Serial.print(',');
+  Serial.print((int)get_control());           Serial.print(',');
+  Serial.print(digitalRead(PIN_SWITCH_MAX));  Serial.print(',');
+  Serial.print(digitalRead(PIN_SWITCH_MIN));  Serial.print(',');
+  Serial.print(get_knob());                   Serial.print(',');
+  Serial.print(get_pmt());                    Serial.print(',');
+  Serial.println(get_state_index());
+}
+
+unsigned long next_arg(unsigned long fallback){
+  /*
+   * Convert the current command argument to a number and advance
+   * to the next one. Returns fallback if the argument is missing.
+   */
+  if(strtok_index == NULL) return fallback;
+  unsigned long value = strtoul(strtok_index, NULL, 10);
+  strtok_index = strtok(NULL, ",");
+  return value;
+}
+
 void parseData() {      
-   strtok_index = strtok(temp_data,",");   // Get the first part - the string
+   char *command = temp_data;
+   reply_tag = -1;
+
+   /* Tagged commands look like #<tag>:<command>. Replies echo the tag. */
+   if(temp_data[0] == '#' && strchr(temp_data, ':') != NULL){
+     reply_tag = strtol(temp_data+1, NULL, 10);
+     command   = strchr(temp_data, ':') + 1;
+   }
+
+   strtok_index = strtok(command,",");     // Get the first part - the string
    strcpy(functionCall, strtok_index);     // Copy it to function_call
    strtok_index = strtok(NULL, ",");
 
+  /* Motion commands return immediately; motion_update() does the stepping */
   if(strcmp(functionCall,"step_motor")    == 0){
-    unsigned int number_steps = atoi(strtok_index); 
+    unsigned int number_steps = next_arg(0); 
     
-    for(int i = 0; i < number_steps; i++){
-      step_motor();
-    }
+    stop_motion();
+    if(get_direction()) start_move(number_steps > motor_position ? 0 : motor_position - number_steps);
+    else                start_move(motor_position + number_steps);
+  }
+
+  else if(strcmp(functionCall,"move_to")         == 0){
+    stop_motion();
+    start_move(next_arg(motor_position));
   }
 
-  else if(strcmp(functionCall,"get_pmt")         == 0) Serial.println(get_pmt());
+  else if(strcmp(functionCall,"stop")            == 0) stop_motion();
+
+  else if(strcmp(functionCall,"get_state")       == 0) reply(MOTION_STATE_NAMES[get_state_index()]);
+
+  else if(strcmp(functionCall,"set_speed")       == 0) set_speed(next_arg(max_speed));
+
+  else if(strcmp(functionCall,"get_speed")       == 0) reply(get_speed());
+
+  else if(strcmp(functionCall,"set_accel")       == 0) set_accel(next_arg(acceleration));
+
+  else if(strcmp(functionCall,"get_accel")       == 0) reply(get_accel());
+
+  else if(strcmp(functionCall,"get_pmt")         == 0) send_value(get_pmt());
+
+  else if(strcmp(functionCall,"get_pmt_avg")     == 0) send_pmt_stats(next_arg(1), 0);
+
+  else if(strcmp(functionCall,"get_pmt_time")    == 0) send_pmt_stats(0, next_arg(0));
   
-  else if(strcmp(functionCall,"set_direction")   == 0) set_direction(atoi(strtok_index));
+  else if(strcmp(functionCall,"set_direction")   == 0){
+    if(get_state_index() == 0) set_direction(atoi(strtok_index)); // Ignored while the motor is moving
+  }
 
-  else if(strcmp(functionCall,"get_direction")   == 0) Serial.println(get_direction());   
+  else if(strcmp(functionCall,"get_direction")   == 0) send_value(get_direction());   
 
   else if(strcmp(functionCall,"set_control")     == 0){
     if     (strcmp(strtok_index,"FRONT_PANEL") == 0) set_control(FRONT_PANEL);
     else if(strcmp(strtok_index,"COMPUTER")    == 0) set_control(COMPUTER);
   }
 
-  else if(strcmp(functionCall,"get_control")     == 0) Serial.println(CONTROL_MODE_NAMES[get_control()]);
+  else if(strcmp(functionCall,"get_control")     == 0) reply(CONTROL_MODE_NAMES[get_control()]);
   
-  else if(strcmp(functionCall,"get_knob")        == 0) Serial.println(get_knob());          
+  else if(strcmp(functionCall,"get_knob")        == 0) send_value(get_knob());          
   
-  else if(strcmp(functionCall,"get_calibration") == 0) Serial.println(CALIBRATION_NAMES[get_calibration()]);
+  else if(strcmp(functionCall,"get_calibration") == 0) reply(CALIBRATION_NAMES[get_calibration()]);
 
-  else if(strcmp(functionCall,"get_position")    == 0) Serial.println(get_position());
+  else if(strcmp(functionCall,"get_position")    == 0) send_value(get_position());
    
-  else if(strcmp(functionCall,"get_u1")          == 0) Serial.println(u1);
+  else if(strcmp(functionCall,"get_u1")          == 0) reply(u1);
   
-  else if(strcmp(functionCall,"get_max_limit")   == 0) Serial.println(digitalRead(PIN_SWITCH_MAX)); 
+  else if(strcmp(functionCall,"get_max_limit")   == 0) send_value(digitalRead(PIN_SWITCH_MAX)); 
   
-  else if(strcmp(functionCall,"get_min_limit")   == 0) Serial.println(digitalRead(PIN_SWITCH_MIN)); 
+  else if(strcmp(functionCall,"get_min_limit")   == 0) send_value(digitalRead(PIN_SWITCH_MIN)); 
   
   else if(strcmp(functionCall,"home")            == 0){
-    Serial.println("HOMING");
-    home();
+    reply("HOMING");
+    stop_motion();
+    start_home();
+  }
+
+  else if(strcmp(functionCall,"scan")            == 0){
+    unsigned int start   = next_arg(motor_position);
+    unsigned int stop    = next_arg(start);
+    unsigned int stride  = next_arg(1);
+    unsigned int samples = next_arg(1);
+    stop_motion();
+    start_scan(start, stop, stride, samples);
+  }
+
+  else if(strcmp(functionCall,"set_binary")      == 0){
+    binary_mode = next_arg(0);
+    reply_prefix();
+    Serial.print("BINARY,");                      // Always acknowledged in text
+    Serial.println(binary_mode);
+  }
+
+  else if(strcmp(functionCall,"subscribe")       == 0){
+    telemetry_period = next_arg(0);               // 0 unsubscribes
+    telemetry_last   = millis();
+  }
+
+  else if(strcmp(functionCall,"ping")            == 0) reply("PONG," FIRMWARE_VERSION);
+
+  /* Move programs: prog_clear, then prog_add,<target>,<target>,... as
+     many times as needed, then prog_run,<samples>,<backlash> */
+  else if(strcmp(functionCall,"prog_clear")      == 0) program_length = 0;
+
+  else if(strcmp(functionCall,"prog_add")        == 0){
+    while(strtok_index != NULL && program_length < PROGRAM_SIZE) program[program_length++] = next_arg(0);
+  }
+
+  else if(strcmp(functionCall,"prog_run")        == 0){
+    unsigned int samples  = next_arg(1);
+    unsigned int backlash = next_arg(0);
+    stop_motion();
+    start_program(samples, backlash);
   }
 }
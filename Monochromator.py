@@ -6,7 +6,6 @@ import serial        as _serial
 import time     as _time
 import shutil   as _shutil
 import numpy    as _n
-import scipy.special as _scipy_special
 import sys as _sys
 
 import traceback as _traceback
@@ -19,7 +18,11 @@ from spinmob.egg._gui import Button, ComboBox, NumberBox, Label, TextBox
 _g = _egg.gui
 
 from serial.tools.list_ports import comports as _comports
-from Monochromator_api    import Monochromator_api
+from Monochromator_api    import Monochromator_api, CALIBRATION_STATES, MOTION_STATES, MAX_STEP
+from Monochromator_acquisition import Acquisition_worker, SAMPLE_DTYPE
+from Monochromator_storage     import Run_writer
+from Monochromator_plot        import Minmax_decimator, Column_binner
+from Monochromator_discovery   import Port_discovery
 
 # GUI settings
 _s.settings['dark_theme_qt'] = True
@@ -79,26 +82,23 @@ class serial_gui_base(_g.BaseObject):
         self.grid_top = self.window.place_object(_g.GridLayout(margins=False), alignment=0)
         self.window.new_autorow()
 
-        # Get all the available ports
+        # Ports are listed and probed in the background. The combo box is 
+        # filled from the cached list, and refilled when it changes.
         self._label_port = self.grid_top.add(_g.Label('Port:'))
-        self._ports = [] # Actual port names for connecting
-        ports       = [] # Pretty port names for combo box
-        if _comports:
-            for p in _comports():
-                self._ports.append(p.device)
-                ports      .append(p.description)
-        
-        # Append simulation port
-        ports      .append('Simulation')
-        self._ports.append('Simulation')
+        self._ports          = ['Simulation', 'Refresh - Update Ports List'] # Actual port names for connecting
+        self._ports_revision = None  # Revision of the discovery list shown
+        self._filling_ports  = False # Ignore combo box changes while refilling it
         
-        # Append refresh port
-        ports      .append('Refresh - Update Ports List')
-        self._ports.append('Refresh - Update Ports List')
+        self.discovery = Port_discovery()
+        self.discovery.start()
         
-        self.combo_ports = self.grid_top.add(_g.ComboBox(ports, autosettings_path=name+'.combo_ports'))
+        self.combo_ports = self.grid_top.add(_g.ComboBox(list(self._ports), autosettings_path=name+'.combo_ports'))
         self.combo_ports.signal_changed.connect(self._ports_changed)
         
+        self.timer_ports = _g.Timer(interval_ms=500, single_shot=False)
+        self.timer_ports.signal_tick.connect(self._timer_ports_tick)
+        self.timer_ports.start()
+        
 
         self.grid_top.add(_g.Label('Address:')).show(hide_address)
         self.number_address = self.grid_top.add(_g.NumberBox(
@@ -142,49 +142,48 @@ class serial_gui_base(_g.BaseObject):
     
     def _ports_changed(self):
         """
-        Refreshes the list of availible serial ports in the GUI.
+        Asks the discovery thread for a fresh list of serial ports when 
+        Refresh is selected.
 
         """
+        if self._filling_ports: return
+        
         if self.get_selected_port() == 'Refresh - Update Ports List':
-            
-            len_ports = len(self.combo_ports.get_all_items())
-            
-            # Clear existing ports
-            if(len_ports > 1): # Stop recursion!
-                for n in range(len_ports):
-                    self.combo_ports.remove_item(0)
-            else:
-                return
-                self.combo_ports.remove_item(0)
-                 
-            self._ports = [] # Actual port names for connecting
-            ports       = [] # Pretty port names for combo box
-                
-            default_port = 0
-             
-            # Get all the available ports
-            if _comports:
-                for inx, p in enumerate(_comports()):
-                    self._ports.append(p.device)
-                    ports      .append(p.description)
-                    
-                    if 'Arduino' in p.description:
-                        default_port = inx
-                        
-            # Append simulation port
-            ports      .append('Simulation')
-            self._ports.append('Simulation')
-            
-            # Append refresh port
-            ports      .append('Refresh - Update Ports List')
-            self._ports.append('Refresh - Update Ports List')
-             
-            # Add the new list of ports
-            for item in ports:
-                self.combo_ports.add_item(item)
-             
-            # Set the new default port
-            self.combo_ports.set_index(default_port)
+            self.discovery.refresh()
+            self._fill_ports()
+    
+    def _timer_ports_tick(self, *a):
+        """
+        Refills the port list when the discovery thread has found a change,
+        unless we are connected.
+        """
+        if self.discovery.revision != self._ports_revision and not self.button_connect.is_checked(): 
+            self._fill_ports()
+    
+    def _fill_ports(self):
+        """
+        Fills the port combo box from the discovery cache: ports answering 
+        as the monochromator (with their firmware version) first, then the 
+        other ports, Simulation and Refresh. Keeps the selected port if it 
+        is still there, otherwise selects the first one.
+        """
+        ports    = self.discovery.ports()
+        selected = self._ports[self.combo_ports.get_index()] if 0 <= self.combo_ports.get_index() < len(self._ports) else None
+        
+        self._ports_revision = self.discovery.revision
+        self._ports = [p.device for p in ports] + ['Simulation', 'Refresh - Update Ports List']
+        names       = [p.description + (' (firmware '+p.version+')' if p.version else '') + (' (in use)' if p.busy else '') for p in ports] + ['Simulation', 'Refresh - Update Ports List']
+        
+        index = self._ports.index(selected) if selected in self._ports[:-2] else 0
+        
+        # Removing and adding items fires signal_changed
+        self._filling_ports = True
+        try:
+            for n in range(len(self.combo_ports.get_all_items())): self.combo_ports.remove_item(0)
+            for item in names: self.combo_ports.add_item(item)
+            self.combo_ports.set_index(index)
+        finally:
+            self._filling_ports = False
     
     def _button_connect_toggled(self, *a):
         """
@@ -196,10 +195,19 @@ class serial_gui_base(_g.BaseObject):
         # If we checked it, open the connection and start the timer.
         if self.button_connect.is_checked():
             port = self.get_selected_port()
-            self.api = self._api_class(
-                    port=port,
-                    baudrate=int(self.combo_baudrates.get_text()),
-                    timeout=self.number_timeout.get_value())
+            self.discovery.exclude(port) # Only we talk to it while connected
+            try:
+                self.api = self._api_class(
+                        port=port,
+                        baudrate=int(self.combo_baudrates.get_text()),
+                        timeout=self.number_timeout.get_value())
+            
+            # Could not open the port. Stay disconnected.
+            except Exception as e:
+                self.discovery.include(port)
+                self.label_message(str(e)).set_colors('red')
+                self.button_connect.set_checked(False, block_signals=True)
+                return
 
             # Record the time if it's not already there.
             if self.t0 is None: self.t0 = _time.time()
@@ -223,7 +231,9 @@ class serial_gui_base(_g.BaseObject):
 
         # Otherwise, shut it down
         else:
+            self._before_button_disconnect()
             self.api.disconnect()
+            self.discovery.include(self.get_selected_port())
             #self.label_status.set_text('')
             self.button_connect.set_colors()
             self.grid_bot.disable()
@@ -245,6 +255,12 @@ class serial_gui_base(_g.BaseObject):
         """
         return
 
+    def _before_button_disconnect(self):
+        """
+        Dummy function called before disconnecting.
+        """
+        return
+
     def _new_exception(self, a):
         """
         Just updates the status with the exception.
@@ -307,6 +323,21 @@ class Monochrmator(serial_gui_base):
         
         self.window.set_size([0,0])
         
+        # Acquisition worker, created when connecting
+        self.worker = None
+        
+        # Run being recorded to disk, if any
+        self.writer = None
+        
+        # Last time the diagnostics panel was refreshed
+        self._diagnostics_time = 0
+        
+        # Decimated copies of the samples for the live plots. Their size is
+        # fixed, so redrawing costs the same after a minute or a day.
+        self.decimator_time  = Minmax_decimator(2048)
+        self.binner_spectrum = Column_binner(0, MAX_STEP, 4096)
+        self._plotted        = 0 # Samples of the worker's buffer already fed to the plots
+        
         # Build the GUI
         self.gui_components(name)
         
@@ -327,13 +358,17 @@ class Monochrmator(serial_gui_base):
                 
                 self._update_status("Homing")
                 
-                
+                # The worker owns the serial line from now on
+                self.worker = Acquisition_worker(self.api, poll_interval=self.numberbox_poll.get_value(), telemetry=True)
+                self.worker.start()
+                self._plotted = 0
                 
                 self.grid_bot.enable()
                                 
                 self.timer.start()
                 
-                self.api.home()
+                self.worker.call(self.api.set_speed, self.numberbox_move_speed.get_value())
+                self.worker.call(self.api.home)
                 
                 
             except:
@@ -342,36 +377,163 @@ class Monochrmator(serial_gui_base):
         # Disconnected
         else:
             self.grid_bot.disable()
-            self.timer.stop()
+    
+    def _before_button_disconnect(self):
+        """
+        Stops the display timer, the recording and the acquisition worker before the port closes.
+        """
+        self.timer.stop()
+        if self.button_record.is_checked(): self.button_record.set_checked(False)
+        if self.worker is not None: 
+            self.worker.stop()
+            self.worker = None
     
     def _update_status(self, status = None):
         if status == None:
-            self.textbox_status.set_text(self.api.get_calibration())
+            sample = self.worker.buffer.latest()
+            if sample is None: return
+            status = CALIBRATION_STATES[sample['calibration']] if sample['calibration'] >= 0 else "No reply"
+            
+            # Show what the motor is doing while it moves
+            if sample['state'] > 0: status = MOTION_STATES[sample['state']]
+            
+            # The board has stopped answering
+            if _time.time() - sample['time'] > max(1, 3*self.worker.poll_interval): status = "No reply"
+        
+        self.textbox_status.set_text(status)
+    
+    def _button_home_clicked(self, *a):
+        """
+        Starts homing the motor.
+        """
+        self.worker.call(self.api.home)
+    
+    def _button_move_clicked(self, *a):
+        """
+        Starts moving the motor to the target position.
+        """
+        self.worker.call(self.api.move_to, int(self.numberbox_move_target.get_value()))
+    
+    def _numberbox_move_speed_changed(self, *a):
+        """
+        Sends the new cruise speed to the motor.
+        """
+        if self.worker is not None: self.worker.call(self.api.set_speed, self.numberbox_move_speed.get_value())
+    
+    def _button_stop_clicked(self, *a):
+        """
+        Stops the motor.
+        """
+        self.worker.call(self.api.stop)
+    
+    def _numberbox_poll_changed(self, *a):
+        """
+        Updates the acquisition worker's poll interval.
+        """
+        if self.worker is not None: self.worker.set_poll_interval(self.numberbox_poll.get_value())
+    
+    def _numberbox_refresh_changed(self, *a):
+        """
+        Updates the display refresh interval.
+        """
+        self.timer.set_interval(int(1000*self.numberbox_refresh.get_value()))
+    
+    def _button_record_toggled(self, *a):
+        """
+        Starts or stops streaming the acquired samples to a new run in ./runs.
+        """
+        if self.button_record.is_checked():
+            path = _os.path.join('runs', _time.strftime('%Y%m%d-%H%M%S'))
+            self.writer = Run_writer(path, SAMPLE_DTYPE, metadata=dict(
+                port=self.combo_ports.get_text(), firmware_version=self.api.firmware_version))
+            if self.worker is not None: self.worker.writer = self.writer
+            self.button_record.set_text('Recording').set_colors(background='red')
+            self.label_record.set_text(path)
+        
         else:
-            self.textbox_status.set_text(status)
+            if self.worker is not None: self.worker.writer = None
+            if self.writer is not None: self.writer.close()
+            self.writer = None
+            self.button_record.set_text('Record').set_colors(background='')
+    
+    def _button_reset_stats_clicked(self, *a):
+        """
+        Clears the serial instrumentation counters.
+        """
+        self.api.reset_stats()
+        self._update_diagnostics()
+    
+    def _button_clear_plots_clicked(self, *a):
+        """
+        Clears the live plots.
+        """
+        self.decimator_time.clear()
+        self.binner_spectrum.clear()
+        self.curve_time.setData([], [])
+        self.curve_spectrum.setData([], [])
+    
+    def _update_plots(self):
+        """
+        Feeds the samples collected since the last tick to the decimated plot
+        buffers and redraws them. Only the new samples are processed and only
+        a few thousand points are drawn, however long the acquisition.
+        """
+        new = self.worker.buffer.count - self._plotted
+        if new <= 0: return
+        
+        rows = self.worker.buffer.snapshot(new) # Fewer if the ring buffer wrapped
+        self._plotted += new
+        
+        rows = rows[rows['pmt'] == rows['pmt']]  # Drop samples the board did not answer
+        if not len(rows): return
         
+        self.decimator_time .extend(rows['time'] - self.t0, rows['pmt'])
+        self.binner_spectrum.extend(rows['position'], rows['pmt'])
+        
+        self.curve_time    .setData(*self.decimator_time .envelope())
+        self.curve_spectrum.setData(*self.binner_spectrum.envelope())
+    
+    def _update_diagnostics(self):
+        """
+        Shows the api's serial instrumentation (see Monochromator_api.stats()) 
+        in the Acquisition tab.
+        """
+        stats = self.api.stats()
+        ms    = lambda t: '--' if t is None else '%.1f'%(1e3*t)
+        
+        lines = ['%-16s %6s %8s %8s %5s %5s'%('Command', 'Calls', 'p50 ms', 'p99 ms', 'T/O', 'Bad')]
+        for name, command in sorted(stats['commands'].items()):
+            lines.append('%-16s %6d %8s %8s %5d %5d'%(name, command['count'], ms(command['p50']), ms(command['p99']), 
+                                                     command['timeouts'], command['malformed']))
+        lines.append('')
+        lines.append('In %d B, out %d B, %d timeouts, %d malformed'%(stats['bytes_in'], stats['bytes_out'], stats['timeouts'], stats['malformed']))
+        
+        scans = stats['scans']
+        if scans['count']: 
+            lines.append('Scans %.1f s: ADC %.1f s, motor and link %.1f s, api %.1f s'%(
+                scans['duration'], scans['adc_time'], scans['motor_and_link_time'], scans['own_time']))
+        
+        self.label_diagnostics.set_text('\n'.join(lines))
     
     def _timer_tick(self, *a):
         """
-        Called whenever the timer ticks. Let's update the plot and save the latest data.
+        Called whenever the timer ticks. Updates the display from the latest
+        sample collected by the acquisition worker. No serial I/O happens here.
         """
         current_time = _time.time()
         
-        self.api.serial.reset_input_buffer()
-        status = self.api.get_calibration()
+        sample = self.worker.buffer.latest()
+        if sample is None: return
         
-
-        if status == '': status = "Homing"
+        self._update_status()
+        if sample['position'] == sample['position']: self.numberbox_position.set_value(sample['position'])
         
-        self._update_status(status)
-            
+        # Diagnostics don't need to refresh as often
+        if current_time - self._diagnostics_time > 1: 
+            self._diagnostics_time = current_time
+            self._update_diagnostics()
         
-        # Get the time, temperature, and setpoint
-        t = current_time - self.t0
-        '''
-        self.plot.append_row([t, t**2], ckeys=['Time (s)', 'Counts (C)'])
-        self.plot.plot()
-        '''
+        self._update_plots()
         
         # Update the GUI
         self.window.process_events()
@@ -444,6 +606,22 @@ class Monochrmator(serial_gui_base):
         self.tab_2 = self.tabs.add_tab('PMT')
         self.tab_1 = self.tabs.add_tab('Motor')
         
+        # Live plots of the PMT against position (the spectrum) and time
+        self.button_clear_plots = self.tab_2.add(_g.Button(text="Clear", tip='Clear the plots.'), alignment=1)
+        self.button_clear_plots.signal_clicked.connect(self._button_clear_plots_clicked)
+        
+        self.tab_2.new_autorow()
+        self.plot_spectrum = self.tab_2.add(_pg.PlotWidget(), alignment=0)
+        self.plot_spectrum.setLabel('bottom', 'Position (microsteps)')
+        self.plot_spectrum.setLabel('left', 'PMT')
+        self.curve_spectrum = self.plot_spectrum.plot(pen='y')
+        
+        self.tab_2.new_autorow()
+        self.plot_time = self.tab_2.add(_pg.PlotWidget(), alignment=0)
+        self.plot_time.setLabel('bottom', 'Time (s)')
+        self.plot_time.setLabel('left', 'PMT')
+        self.curve_time = self.plot_time.plot(pen='c')
+        
         
         self.tab_1.add(_g.Label('Status:'), alignment=1, row_span=1).set_style('font-size: 17pt; font-weight: bold; color: white')
         self.tab_1.new_autorow()
@@ -474,7 +652,8 @@ class Monochrmator(serial_gui_base):
         self.tab_1.new_autorow()
         # Add 
 
-        self.button_test = self.tab_1.add(_g.Button(text="Home"),alignment = 1).set_height(30)
+        self.button_home = self.tab_1.add(_g.Button(text="Home"),alignment = 1).set_height(30)
+        self.button_home.signal_clicked.connect(self._button_home_clicked)
         
         self.tab_1.new_autorow()
         
@@ -485,15 +664,20 @@ class Monochrmator(serial_gui_base):
         
                 # Add 
         self.tab_1.add(_g.Label('Target:'), alignment=2, row_span=1).set_style('font-size: 14pt; font-weight: bold; color: cyan')
-        self.numberbox_move_target = self.tab_1.add(_g.NumberBox(0, tip='A test.'),
-            alignment=2).set_width(100).disable().set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.numberbox_move_target = self.tab_1.add(_g.NumberBox(0, int=True, bounds=(0, MAX_STEP), tip='Absolute target position (microsteps).'),
+            alignment=2).set_width(100).set_style('font-size: 14pt; font-weight: bold; color: cyan')
         self.tab_1.new_autorow()
         self.tab_1.add(_g.Label('Speed:'), alignment=2, row_span=1).set_style('font-size: 14pt; font-weight: bold; color: cyan')
-        self.numberbox_move_speed = self.tab_1.add(_g.NumberBox(0, tip='A test.'),
-            alignment=2).set_width(100).disable().set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.numberbox_move_speed = self.tab_1.add(_g.NumberBox(2400, int=True, bounds=(16, 65535), suffix=' steps/s', 
+            tip='Cruise speed of the motor. Moves start at 893 steps/s and ramp up to it and back down.', autosettings_path=name+'.numberbox_move_speed'),
+            alignment=2).set_width(100).set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.numberbox_move_speed.signal_changed.connect(self._numberbox_move_speed_changed)
         
         self.tab_1.new_autorow()
-        self.button_test = self.tab_1.add(_g.Button(text="Move"),alignment = 1).set_height(30)
+        self.button_move = self.tab_1.add(_g.Button(text="Move"),alignment = 1).set_height(30)
+        self.button_move.signal_clicked.connect(self._button_move_clicked)
+        self.button_stop = self.tab_1.add(_g.Button(text="Stop"),alignment = 1).set_height(30)
+        self.button_stop.signal_clicked.connect(self._button_stop_clicked)
         self.tab_1.new_autorow()
         
         
@@ -509,8 +693,43 @@ class Monochrmator(serial_gui_base):
         self.tab_1.set_column_stretch(8, 100)
 
         
-        # Timer for collecting data
-        self.timer = _g.Timer(interval_ms=1000, single_shot=False)
+        # Acquisition rates
+        self.tab_3 = self.tabs.add_tab('Acquisition')
+        
+        self.tab_3.add(_g.Label('Poll:'), alignment=2).set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.numberbox_poll = self.tab_3.add(_g.NumberBox(0.2, dec=True, bounds=(0.01, None), suffix='s', 
+            tip='Time between status updates pushed by the instrument.', autosettings_path=name+'.numberbox_poll'),
+            alignment=2).set_width(100).set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.numberbox_poll.signal_changed.connect(self._numberbox_poll_changed)
+        
+        self.tab_3.new_autorow()
+        self.tab_3.add(_g.Label('Refresh:'), alignment=2).set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.numberbox_refresh = self.tab_3.add(_g.NumberBox(0.03, dec=True, bounds=(0.01, None), suffix='s', 
+            tip='Time between display updates.', autosettings_path=name+'.numberbox_refresh'),
+            alignment=2).set_width(100).set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.numberbox_refresh.signal_changed.connect(self._numberbox_refresh_changed)
+        
+        # Recording to disk
+        self.tab_3.new_autorow()
+        self.tab_3.add(_g.Label('Disk:'), alignment=2).set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.button_record = self.tab_3.add(_g.Button(text="Record", checkable=True, 
+            tip='Stream every sample to a new run directory (see Monochromator_storage).'), alignment=2)
+        self.button_record.signal_toggled.connect(self._button_record_toggled)
+        self.label_record = self.tab_3.add(_g.Label(''), alignment=1)
+        
+        # Serial diagnostics
+        self.tab_3.new_autorow()
+        self.tab_3.add(_g.Label('Serial:'), alignment=2).set_style('font-size: 14pt; font-weight: bold; color: cyan')
+        self.button_reset_stats = self.tab_3.add(_g.Button(text="Reset", tip='Clear the serial statistics.'), alignment=2)
+        self.button_reset_stats.signal_clicked.connect(self._button_reset_stats_clicked)
+        
+        self.tab_3.new_autorow()
+        self.label_diagnostics = self.tab_3.add(_g.Label(''), column_span=3).set_style('font-family: monospace;')
+        
+        self.tab_3.set_column_stretch(2, 100)
+        
+        # Timer for refreshing the display
+        self.timer = _g.Timer(interval_ms=int(1000*self.numberbox_refresh.get_value()), single_shot=False)
         self.timer.signal_tick.connect(self._timer_tick)
 
 
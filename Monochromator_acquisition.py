@@ -0,0 +1,230 @@
+import threading          as _threading
+import queue              as _queue
+import time               as _time
+import numpy              as _n
+import concurrent.futures as _futures
+
+from Monochromator_api import CALIBRATION_STATES, MOTION_STATES
+
+# One row of the acquisition ring buffer. Values that could not be read are nan (or -1).
+SAMPLE_DTYPE = _n.dtype([
+    ('time'       , 'f8'),  # time.time() when the sample was taken (s)
+    ('position'   , 'f8'),  # Absolute motor position (microsteps)
+    ('pmt'        , 'f8'),  # Digitized PMT voltage
+    ('calibration', 'i1'),  # Index into CALIBRATION_STATES, -1 if the board did not answer
+    ('state'      , 'i1'),  # Index into MOTION_STATES, -1 if the board did not answer
+    ])
+
+class Ring_buffer():
+    """
+    Preallocated ring buffer of samples with a single writer. Readers never
+    block the writer: they copy what they need and drop any rows that were
+    overwritten while copying.
+
+    Parameters
+    ----------
+    size=100000 : int
+        Number of samples to keep.
+    dtype=SAMPLE_DTYPE : numpy.dtype
+        Type of one sample.
+    """
+    def __init__(self, size=100000, dtype=SAMPLE_DTYPE):
+
+        self.data  = _n.zeros(size, dtype=dtype)
+        self.size  = size
+
+        # Total number of samples ever written. Only the writer changes it,
+        # after the row is complete, so readers only see finished rows.
+        self.count = 0
+
+    def append(self, sample):
+        """
+        Writes one sample, overwriting the oldest one if the buffer is full.
+
+        Parameters
+        ----------
+        sample : tuple
+            Values for each field of the dtype.
+        """
+        self.data[self.count % self.size] = sample
+        self.count += 1
+
+    def snapshot(self, n=None):
+        """
+        Returns a copy of the most recent samples, oldest first.
+
+        Parameters
+        ----------
+        n=None : int
+            Maximum number of samples to return. None returns everything kept.
+
+        Returns
+        -------
+        numpy.ndarray
+            Structured array of samples.
+        """
+        count = self.count
+        n = min(count, self.size) if n is None else min(n, count, self.size)
+
+        indices = _n.arange(count-n, count) % self.size
+        rows    = self.data[indices]
+
+        # Drop rows the writer overwrote (or may be writing) while we were copying.
+        overwritten = self.count + 1 - self.size - (count-n)
+        if overwritten > 0: rows = rows[overwritten:]
+
+        return rows
+
+    def latest(self):
+        """
+        Returns the most recent sample, or None if nothing was written yet.
+        """
+        rows = self.snapshot(1)
+        return rows[0] if len(rows) else None
+
+class Acquisition_worker(_threading.Thread):
+    """
+    Background thread that owns a Monochromator_api and polls the instrument
+    into a Ring_buffer. Anything else that needs the serial line is handed
+    to the worker with call(), so only one thread ever talks to the board.
+
+    Parameters
+    ----------
+    api : Monochromator_api
+        Connected instrument.
+    poll_interval=0.2 : float
+        Time between polls (s).
+    buffer_size=100000 : int
+        Number of samples kept in the ring buffer.
+    telemetry=False : bool
+        If True, subscribe to the firmware's status stream (every poll_interval)
+        instead of polling. The telemetry thread then writes the buffer.
+    writer=None : Monochromator_storage.Run_writer
+        If specified, every sample is also streamed to disk (with SAMPLE_DTYPE).
+        Can be changed at any time; the worker does not close it.
+    """
+    def __init__(self, api, poll_interval=0.2, buffer_size=100000, telemetry=False, writer=None):
+        _threading.Thread.__init__(self, daemon=True)
+
+        self.api           = api
+        self.poll_interval = poll_interval
+        self.buffer        = Ring_buffer(buffer_size)
+        self.telemetry     = telemetry
+        self.writer        = writer
+
+        self.last_error = None # Exception raised by the last poll (or writer), None once polling works again
+
+        self._calls   = _queue.Queue()
+        self._stopped = _threading.Event()
+
+    def call(self, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) on the worker thread, between polls.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the return value of the function.
+        """
+        future = _futures.Future()
+        self._calls.put((future, function, args, kwargs))
+        return future
+
+    def set_poll_interval(self, poll_interval):
+        """
+        Changes the time between polls (or status frames) (s).
+        """
+        self.poll_interval = poll_interval
+        if self.telemetry: self.call(self._subscribe)
+
+    def stop(self, timeout=None):
+        """
+        Stops polling and waits for the thread to finish. In telemetry 
+        mode, the thread unsubscribes before it finishes.
+        """
+        self._stopped.set()
+        self._calls.put(None) # Wake up the thread
+        if self.is_alive(): self.join(timeout)
+
+    def run(self):
+        if self.telemetry: self._subscribe()
+        next_poll = _time.time()
+
+        try:
+            while not self._stopped.is_set():
+
+                # Wait for a call, but no longer than the next poll. With 
+                # telemetry, the firmware pushes the samples and we only wait for calls.
+                try:    item = self._calls.get(timeout=None if self.telemetry else max(next_poll-_time.time(), 0))
+                except _queue.Empty: item = None
+
+                if item is not None:
+                    future, function, args, kwargs = item
+                    if future.set_running_or_notify_cancel():
+                        try:                   future.set_result(function(*args, **kwargs))
+                        except Exception as e: future.set_exception(e)
+
+                if _time.time() >= next_poll and not self._stopped.is_set() and not self.telemetry:
+                    try:                   self.poll()
+                    except Exception as e: self.last_error = e
+                    next_poll = max(next_poll + self.poll_interval, _time.time())
+
+        # Stop the stream before giving up the serial line
+        finally:
+            if self.telemetry:
+                try:                   self.api.unsubscribe()
+                except Exception as e: self.last_error = e
+
+    def poll(self):
+        """
+        Reads the instrument status and appends it to the buffer. Replies
+        that time out are stored as missing.
+        """
+        t = _time.time()
+
+        # One serial transaction for everything
+        with self.api.batch():
+            calibration = self.api.get_calibration()
+            position    = self.api.get_position()
+            pmt         = self.api.get_pmt()
+            state       = self.api.get_state()
+
+        calibration = calibration.result()
+        calibration = CALIBRATION_STATES.index(calibration) if calibration in CALIBRATION_STATES else -1
+
+        state = state.result()
+        state = MOTION_STATES.index(state) if state in MOTION_STATES else -1
+
+        try:              position = position.result()
+        except Exception: position = _n.nan
+
+        try:              pmt = pmt.result()
+        except Exception: pmt = _n.nan
+
+        self._store((t, position, pmt, calibration, state))
+
+    def _store(self, sample):
+        """
+        Appends a sample to the buffer and to the writer, if any.
+        """
+        self.last_error = None # Polling works (again)
+        self.buffer.append(sample)
+
+        # The writer may be swapped or closed from another thread
+        writer = self.writer
+        if writer is not None:
+            try:                   writer.append(sample)
+            except Exception as e: self.last_error = e
+
+    def _subscribe(self):
+        """
+        (Re)subscribes to the status stream at the current poll interval.
+        """
+        self.api.subscribe(self._telemetry_received, max(int(1000*self.poll_interval), 1))
+
+    def _telemetry_received(self, status):
+        """
+        Appends a status frame pushed by the firmware to the buffer.
+        """
+        self._store((status['time'], status['position'], status['pmt'],
+                     CALIBRATION_STATES.index(status['calibration']), MOTION_STATES.index(status['state'])))
@@ -1,13 +1,425 @@
 import serial as _serial
 import time   as _time
+import numpy  as _n
+import collections        as _collections
+import threading          as _threading
+import queue              as _queue
+import contextlib         as _contextlib
+import concurrent.futures as _futures
 
 
 _serial_left_marker  = '<'
 _serial_right_marker = '>'  
 
+# Real ports opened by an api of this process, which port discovery must leave alone
+_open_ports = set()
+
 _debug_enabled       = True 
 
-CONTROL_MODES = ["FRONT_PANEL", "COMPUTER"]
+CONTROL_MODES      = ["FRONT_PANEL", "COMPUTER"]
+CALIBRATION_STATES = ["NOT_DONE", "COMPLETED", "FAILED", "RECAL"]
+MOTION_STATES      = ["IDLE", "MOVING", "HOMING", "HOMING_RETURN", "SCANNING"]
+
+MAX_STEP   = 58860   # Full range of the motor (microsteps)
+STEP_TIME  = 1120e-6 # Longest time taken by one motor step at the default speed (s), i.e. the start rate 2*STEP_DELAY in the firmware
+ADC_TIME   = 112e-6  # Time taken by one analogRead() on the arduino (s)
+
+# Move programs (see Monochromator_api.measure_targets())
+PROGRAM_SIZE = 64  # Number of targets the firmware holds at once
+PROGRAM_ARGS = 6   # Targets sent per prog_add command, to fit the firmware's 64 byte buffer
+BACKLASH     = 200 # Forward run before each target, to take up the slack of the drive (microsteps). Generous; measure it.
+
+# Binary framing: SYNC, type, length, payload (little-endian), XOR checksum
+FRAME_SYNC  = 0xA5
+FRAME_VALUE = 0x01 # One 16-bit value
+FRAME_SCAN  = 0x02 # Scan header
+FRAME_SUM16 = 0x03 # Block of 16-bit PMT sums
+FRAME_SUM32 = 0x04 # Block of 32-bit PMT sums
+FRAME_END   = 0x05 # End of a data stream
+
+_scan_header = _n.dtype([('start', '<u2'), ('step', '<i2'), ('points', '<u2')])
+_sum_dtypes  = {FRAME_SUM16: _n.dtype('<u2'), FRAME_SUM32: _n.dtype('<u4')}
+
+# Upper edges of the latency histogram bins (s): 10 per decade from 100 us to 100 s, then overflow
+LATENCY_BINS = 10**_n.linspace(-4, 2, 61)
+
+def parse_telemetry(line, t=None):
+    """
+    Parses a status frame pushed by the firmware:
+    T,<position>,<direction>,<calibration>,<control>,<max limit>,<min limit>,<knob>,<pmt>,<state>
+    
+    Parameters
+    ----------
+    line : str
+        Status frame, without the line ending.
+    t=None : float
+        Time the frame was received. Defaults to now.
+    
+    Returns
+    -------
+    dict
+        Same keys as Monochromator_api.get_status(), plus knob, state and time.
+    """
+    values = [int(v) for v in line.split(',')[1:]]
+    return dict(
+        time        = _time.time() if t is None else t,
+        position    = values[0],
+        direction   = bool(values[1]),
+        calibration = CALIBRATION_STATES[values[2]],
+        control     = CONTROL_MODES[values[3]],
+        max_limit   = bool(values[4]),
+        min_limit   = bool(values[5]),
+        knob        = values[6],
+        pmt         = values[7],
+        state       = MOTION_STATES[values[8]])
+
+PMT_stats = _collections.namedtuple('PMT_stats', ['n', 'mean', 'variance', 'min', 'max'])
+PMT_stats.__doc__ = """
+Summary of many PMT readings accumulated on the arduino. The variance is
+the unbiased sample variance (0 for a single reading).
+"""
+
+def plan_targets(targets, position=None, backlash=BACKLASH, reversal_cost=200):
+    """
+    Orders targets for a move program (see Monochromator_api.measure_targets()).
+    Every target is reached moving forward, so visiting them in increasing
+    order needs no reversal at all. Starting from the middle of the list, 
+    it can be shorter to first go up through the targets above, then come
+    back down once for the rest; every such split is compared.
+    
+    Parameters
+    ----------
+    targets : array-like
+        Positions to visit (microsteps). Duplicates are visited once.
+    position=None : int
+        Current motor position. None starts below the lowest target.
+    backlash=BACKLASH : int
+        Forward run before each target (microsteps).
+    reversal_cost=200 : float
+        Travel (microsteps) one reversal is considered to cost, for the 
+        motor stopping and accelerating again.
+    
+    Returns
+    -------
+    numpy.ndarray
+        Targets in the order to visit them.
+    """
+    t = _n.unique(_n.clip(_n.asarray(targets, dtype=_n.int64), 0, MAX_STEP))
+    if len(t) < 2 or position is None: return t
+    
+    # Cost of starting at t[k] and going up to the last target...
+    start = _n.where(t >= position, t - position, position - t + 2*backlash + 2*reversal_cost)
+    run   = t[-1] - t
+    
+    # ...then, if k > 0, going back below the first and up to t[k-1]
+    wrap     = _n.zeros(len(t))
+    wrap[1:] = t[-1] - t[0] + 2*backlash + 2*reversal_cost + t[:-1] - t[0]
+    
+    k = int(_n.argmin(start + run + wrap))
+    return _n.concatenate([t[k:], t[:k]])
+
+def parse_pmt_stats(reply):
+    """
+    Parses a "<n>,<sum>,<sum of squares>,<min>,<max>" reply into PMT_stats.
+    """
+    n, total, squares, lowest, highest = [int(v) for v in reply.split(',')]
+    variance = (squares - total*total/n)/(n-1) if n > 1 else 0.0
+    return PMT_stats(n, total/n, variance, lowest, highest)
+
+class Batch():
+    """
+    Commands collected by Monochromator_api.batch(). They are sent in a 
+    single write when the with block ends, and the replies are read back
+    in order.
+    
+    Attributes
+    ----------
+    futures : list
+        One concurrent.futures.Future per command that has a reply, in order.
+    """
+    def __init__(self):
+        self.data    = bytearray() # Encoded commands waiting to be sent
+        self.futures = []
+        self.pending = []          # (future, kind, convert, duration, name) for each expected reply
+    
+    @property
+    def results(self):
+        """
+        Replies to the batched commands, in order. Only valid once the with block has ended.
+        """
+        return [future.result() for future in self.futures]
+
+class Io_stats():
+    """
+    Counters for the serial traffic of a Monochromator_api: calls, bytes,
+    timeouts, malformed replies and a latency histogram for each command,
+    and where the time of each scan went. Updated by the api, read with
+    Monochromator_api.stats(). Safe to read from another thread.
+    """
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """
+        Clears all the counters.
+        """
+        with self._lock:
+            self.bytes_in  = 0   # Received, including telemetry
+            self.bytes_out = 0   # Sent
+            self.timeouts  = 0   # Replies that never came
+            self.malformed = 0   # Replies that could not be parsed
+            self.io_time   = 0.0 # Time spent waiting in serial reads (s)
+            self.commands  = dict()
+            self.scans     = dict(count=0, points=0, duration=0.0, io_time=0.0, adc_time=0.0)
+    
+    def _command(self, name):
+        if name not in self.commands:
+            self.commands[name] = dict(count=0, replies=0, timeouts=0, malformed=0, bytes_out=0, bytes_in=0, 
+                                       total_time=0.0, max_time=0.0, histogram=_n.zeros(len(LATENCY_BINS)+1, dtype=_n.int64))
+        return self.commands[name]
+    
+    def sent(self, name, size):
+        """
+        Records a command of size bytes.
+        """
+        with self._lock:
+            command = self._command(name)
+            command['count']     += 1
+            command['bytes_out'] += size
+    
+    def transferred(self, size_in=0, size_out=0, io_time=0.0):
+        """
+        Records bytes on the wire and time spent waiting for them (s).
+        """
+        with self._lock:
+            self.bytes_in  += size_in
+            self.bytes_out += size_out
+            self.io_time   += io_time
+    
+    def replied(self, name, latency, size):
+        """
+        Records a reply of size bytes, latency (s) after its command was sent.
+        """
+        with self._lock:
+            command = self._command(name)
+            command['replies']    += 1
+            command['bytes_in']   += size
+            command['total_time'] += latency
+            command['max_time']    = max(command['max_time'], latency)
+            command['histogram'][_n.searchsorted(LATENCY_BINS, latency)] += 1
+    
+    def failed(self, name, kind):
+        """
+        Records a reply to name that was missing (kind='timeouts') or unreadable (kind='malformed').
+        """
+        with self._lock:
+            self._command(name)[kind] += 1
+            setattr(self, kind, getattr(self, kind) + 1)
+    
+    def scanned(self, points, samples, duration, io_time):
+        """
+        Records a scan of points points, each the sum of samples readings.
+        """
+        with self._lock:
+            self.scans['count']    += 1
+            self.scans['points']   += points
+            self.scans['duration'] += duration
+            self.scans['io_time']  += io_time
+            self.scans['adc_time'] += points*samples*ADC_TIME
+    
+    def summary(self):
+        """
+        Snapshot of the counters. Latency percentiles are estimated from the 
+        histograms (upper bin edges). See Monochromator_api.stats().
+        """
+        with self._lock:
+            commands = dict()
+            for name, command in self.commands.items():
+                summary = dict(command, histogram=command['histogram'].tolist(), mean=None, p50=None, p99=None)
+                if command['replies']:
+                    cumulative = _n.cumsum(command['histogram'])
+                    edges      = _n.append(LATENCY_BINS, _n.inf)
+                    summary['mean'] = command['total_time']/command['replies']
+                    summary['p50']  = float(min(edges[_n.searchsorted(cumulative, 0.50*command['replies'])], command['max_time']))
+                    summary['p99']  = float(min(edges[_n.searchsorted(cumulative, 0.99*command['replies'])], command['max_time']))
+                commands[name] = summary
+            
+            # Scan time is spent either waiting for data (ADC, motor and link) or in our own code
+            scans = dict(self.scans)
+            scans['motor_and_link_time'] = max(scans['io_time'] - scans['adc_time'], 0.0)
+            scans['own_time']            = scans['duration'] - scans['io_time']
+            
+            return dict(bytes_in=self.bytes_in, bytes_out=self.bytes_out, timeouts=self.timeouts, 
+                        malformed=self.malformed, io_time=self.io_time, commands=commands, scans=scans,
+                        latency_bins=LATENCY_BINS.tolist())
+
+class State_cache():
+    """
+    Last known values of slow-changing instrument settings (control, 
+    direction, calibration), each trusted for ttl seconds. Monochromator_api 
+    updates it when it sends a setting or receives telemetry, and 
+    invalidates it when a command may change a setting on the board. Any 
+    object with the same get/set/invalidate methods can replace it.
+    
+    Parameters
+    ----------
+    ttl=1.0 : float
+        How long a value is trusted (s). None trusts values until invalidated.
+    """
+    def __init__(self, ttl=1.0):
+        self.ttl     = ttl
+        self._values = dict() # Name -> (value, time it was known)
+    
+    def get(self, name):
+        """
+        Returns the value of name, or None if it is unknown or expired.
+        """
+        value, t = self._values.get(name, (None, None))
+        if value is None or (self.ttl is not None and _time.time() - t > self.ttl): return None
+        return value
+    
+    def set(self, name, value, t=None):
+        """
+        Records the value of name, known at time t (default now).
+        """
+        self._values[name] = (value, _time.time() if t is None else t)
+    
+    def invalidate(self, *names):
+        """
+        Forgets the values of names, or of everything if no name is given.
+        """
+        if not names: self._values.clear()
+        for name in names: self._values.pop(name, None)
+
+class Serial_reader():
+    """
+    Persistent receive buffer for a serial port. Each fill() pulls in 
+    everything that has arrived with a single read, and complete lines and
+    frames are split off the front of the buffer as they are asked for, so
+    nothing received is ever thrown away and streamed data is read in bulk.
+    
+    Parameters
+    ----------
+    serial : serial.Serial
+        Port to read from. Its timeout is how long fill() waits for data.
+    stats=None : Io_stats
+        Where to count the bytes received and the time spent waiting.
+    """
+    def __init__(self, serial, stats=None):
+        self.serial   = serial
+        self.stats    = stats
+        self.buffer   = bytearray()
+        self.start    = 0 # Start of the data not consumed yet
+        self._scanned = 0 # Where the last search for a line ending stopped
+    
+    def __len__(self): return len(self.buffer) - self.start
+    
+    def fill(self):
+        """
+        Waits up to the port timeout for data, then appends everything that
+        has arrived. Returns the number of bytes added.
+        """
+        # Drop consumed data now and then rather than after every line
+        if self.start and (self.start == len(self.buffer) or self.start > 4096):
+            del self.buffer[:self.start]
+            self._scanned = max(self._scanned - self.start, 0)
+            self.start    = 0
+        
+        t    = _time.time()
+        data = self.serial.read(max(self.serial.in_waiting, 1))
+        self.buffer += data
+        
+        if self.stats is not None: self.stats.transferred(len(data), io_time=_time.time()-t)
+        return len(data)
+    
+    def read_line(self):
+        """
+        Returns the next complete line, without its ending, or None if it 
+        does not arrive before the port times out.
+        """
+        while True:
+            end = self.buffer.find(b'\r\n', max(self._scanned, self.start))
+            if end >= 0:
+                line = self.buffer[self.start:end].decode(errors='replace')
+                self.start = self._scanned = end + 2
+                return line
+            
+            # Next time, only search what is new (the last byte may be a \r)
+            self._scanned = max(len(self.buffer) - 1, self.start)
+            if not self.fill(): return None
+    
+    def read_frame(self, deadline):
+        """
+        Returns the next binary frame, skipping anything before the sync 
+        byte, waiting through port timeouts until deadline (from time.time()).
+        
+        Returns
+        -------
+        kind : int
+            Frame type.
+        payload : bytes
+            Raw little-endian payload.
+        """
+        while True:
+            frame = self._complete_frame()
+            if frame is not None: return frame
+            if not self.fill() and _time.time() >= deadline: 
+                raise Exception('Timed out waiting for the monochromator.')
+    
+    def _complete_frame(self):
+        """
+        Splits off the frame at the front of the buffer, if it has all arrived.
+        """
+        buffer = self.buffer
+        
+        sync = buffer.find(FRAME_SYNC, self.start)
+        if sync < 0: 
+            self.start = len(buffer)
+            return None
+        self.start = sync
+        
+        if len(buffer) - sync < 3: return None
+        kind, length = buffer[sync+1], buffer[sync+2]
+        end = sync + length + 4
+        if len(buffer) < end: return None
+        
+        payload    = bytes(buffer[sync+3:end-1])
+        self.start = end
+        
+        if buffer[end-1] != kind ^ length ^ int(_n.bitwise_xor.reduce(_n.frombuffer(payload, _n.uint8), initial=0)):
+            raise Exception('Corrupted frame (type %d).'%kind)
+        
+        return kind, payload
+    
+    def discard(self, count):
+        """
+        Drops up to count complete lines or frames that have already 
+        arrived, without waiting. Partial data is kept.
+        
+        Returns
+        -------
+        int
+            The number dropped.
+        """
+        if self.serial.in_waiting: self.fill()
+        
+        dropped = 0
+        while dropped < count and len(self):
+            if self.buffer[self.start] == FRAME_SYNC:
+                start = self.start
+                try:              frame = self._complete_frame()
+                except Exception: frame = True # Corrupted, but complete
+                if frame is None: 
+                    self.start = start
+                    break
+            else:
+                end = self.buffer.find(b'\r\n', self.start)
+                if end < 0: break
+                self.start = self._scanned = max(end + 2, self._scanned)
+            dropped += 1
+        
+        return dropped
 
 class Monochromator_api():
     """
@@ -17,20 +429,43 @@ class Monochromator_api():
     Parameters
     ----------
     port='COM4' : str
-        Name of the port to connect to.
+        Name of the port to connect to, or 'Simulation' for a virtual 
+        instrument. Raises an exception if the port cannot be opened.
     baudrate=115200 : int
         Baud rate of the connection. Must match the instrument setting.
     timeout=15 : number
         How long to wait for responses before giving up (s). 
+    reset=True : bool
+        Whether opening the port resets the arduino (by toggling DTR). 
+        With False, the board keeps running and connecting is immediate.
+    cache=None : State_cache
+        If specified, get_control(), get_direction() and get_calibration() 
+        answer from this cache when they can, unless asked for a fresh value.
         
     """
-    def __init__(self, port='COM4', address=0, baudrate=115200, timeout=3):
+    def __init__(self, port='COM4', address=0, baudrate=115200, timeout=3, reset=True, cache=None):
                 
         if not _serial:
             print('You need to install pyserial to use the Atomic Spectra Monochromator.')
             self.simulation_mode = True
         
         self.simulation_mode = False
+        self.binary_mode     = False
+        self._batch          = None
+        self._step_time      = STEP_TIME # Slowest time per step, for estimating how long moves take
+        self.firmware_version = None     # Reported by the board when it is ready
+        self.cache           = cache
+        
+        # Instrumentation
+        self._stats       = Io_stats()
+        self._reply_bytes = 0    # Bytes of replies read so far, for per-command counts
+        self._late        = 0    # Replies that timed out, which may still turn up
+        self.trace        = None # Optional trace(time, event, data), called for every write, read and failure
+        
+        # Telemetry subscription
+        self.telemetry         = None           # Last status frame received
+        self._subscriber       = None           # Thread reading the stream while subscribed
+        self._replies          = _queue.Queue() # Replies to commands, read while subscribed
         
         # If the port is "Simulation"
         if port=='Simulation': self.simulation_mode = True
@@ -39,17 +474,73 @@ class Monochromator_api():
         if not self.simulation_mode:
             try:
                 # Create the instrument and ensure the settings are correct.
-                self.serial = _serial.Serial(port = port, baudrate = baudrate, timeout = timeout)
+                # Exclusive, so other programs (and port probes) cannot open it too
+                self.serial = _serial.Serial(baudrate = baudrate, timeout = timeout, exclusive = True)
+                self.serial.port = port
                 
-            # Something went wrong. Go into simulation mode.
+                # Keeping DTR (and RTS) low while opening leaves the board running
+                if not reset:
+                    self.serial.dtr = False
+                    self.serial.rts = False
+                self.serial.open()
+                _open_ports.add(port)
+                
+            # Something went wrong. Say so, rather than carry on with made-up data.
             except Exception as e:
-                  print('Could not open connection to "'+port+':'+'" at baudrate '+str(baudrate)+'. Entering simulation mode.')
-                  print(e)
-                  self.simulation_mode = True
-                  self.serial = None
+                raise Exception('Could not open connection to "'+port+'" at baudrate '+str(baudrate)+'. '+str(e))
+        
+        # In simulation mode, talk to a virtual instrument running the same protocol.
+        if self.simulation_mode:
+            from Monochromator_simulator import Simulated_serial
+            self.serial = Simulated_serial(baudrate = baudrate, timeout = timeout, dtr = reset)
         
-        # Give the arduino time to run the setup loop
-        _time.sleep(2)
+        # Everything received goes through one persistent buffer
+        self._reader = Serial_reader(self.serial, self._stats)
+        
+        # Wait until the arduino says it is ready
+        self._wait_until_ready(reset)
+    
+    def _wait_until_ready(self, reset=True):
+        """
+        Waits for the "READY,<version>" banner the arduino sends at the end
+        of setup() after a reset, or for its reply to a ping if it was not 
+        reset (or the banner never came). Records firmware_version.
+        Firmware without the handshake never answers; after the timeout we
+        carry on regardless, as we used to after a fixed delay.
+        """
+        # The bootloader alone can take over a second, however short the reply timeout
+        timeout  = self.serial.timeout
+        deadline = _time.time() + max(timeout, 2)
+        
+        try:
+            # Banner after a reset. Anything else on the line is noise from the boot.
+            while reset and _time.time() < deadline:
+                self.serial.timeout = max(deadline - _time.time(), 0)
+                reply = self.read()
+                if reply.startswith('READY,'):
+                    self.firmware_version = reply.split(',',1)[1]
+                    return
+            
+            # Already running, or the board did not reset after all
+            if reset: self.serial.timeout = min(timeout, 0.5)
+            self.firmware_version = self.ping()
+        
+        finally:
+            self.serial.timeout = timeout
+        
+        if self.firmware_version is None: 
+            print('The monochromator did not announce itself. Its firmware may predate the ready handshake.')
+    
+    def ping(self):
+        """
+        Checks that the arduino is listening.
+        
+        Returns
+        -------
+        str or None
+            Firmware version, or None if there was no reply.
+        """
+        return self._query('ping', 'text', lambda reply: reply.split(',',1)[1] if reply.startswith('PONG,') else None)
         
     
     def set_control(self,mode):
@@ -67,15 +558,18 @@ class Monochromator_api():
             print("Controller mode has not been changed. %s is not a vaild mode."%mode)
             return 
         
-        if self.simulation_mode: 
-            return
-        
         self.write("set_control,%s"%mode)
+        if self.cache is not None: self.cache.set('control', mode)
         
-    def get_control(self):
+    def get_control(self, fresh=False):
         """
         Get the control mode of the of the monochromator motor.
         
+        Parameters
+        ----------
+        fresh=False : bool
+            Ask the board even if the cache has a value.
+        
         Returns
         ----------
         mode : str
@@ -83,9 +577,7 @@ class Monochromator_api():
 
         """
         
-        self.write("get_control")
-        
-        return self.read()
+        return self._cached('control', fresh, lambda: self._query("get_control"))
         
     def set_direction(self, direction):
         """
@@ -95,68 +587,575 @@ class Monochromator_api():
         ----------
         direction: bool
             False and True are the forward and backward directions, respectively.
+            Ignored by the firmware while the motor is moving.
             
         """
         self.write("set_direction,%d"%direction)
+        if self.cache is not None: self.cache.invalidate('direction') # Not applied if the motor is moving
         
-    def get_calibration(self):
+    def get_calibration(self, fresh=False):
         """
         Get the current status of operation.
         
-        """
-        self.write('get_calibration')
+        Parameters
+        ----------
+        fresh=False : bool
+            Ask the board even if the cache has a value.
         
-        return self.read()
+        """
+        return self._cached('calibration', fresh, lambda: self._query('get_calibration'))
     
-    def get_direction(self):
+    def get_direction(self, fresh=False):
         """
         Get the current motor direction.
 
+        Parameters
+        ----------
+        fresh=False : bool
+            Ask the board even if the cache has a value.
+        
         Returns
         -------
         direction: bool
             False and True are the forward and backward directions, respectively.
 
         """
-        self.write("get_direction")
+        return self._cached('direction', fresh, lambda: self._query("get_direction", 'value', bool))
+    
+    def _cached(self, name, fresh, query):
+        """
+        Returns the cached value of name if there is one (and fresh is False),
+        otherwise runs query() and caches what it returns. Inside a batch, 
+        the value comes as a Future either way.
+        """
+        if self.cache is None: return query()
+        
+        value = None if fresh else self.cache.get(name)
+        if value is not None:
+            if self._batch is None: return value
+            future = _futures.Future()
+            future.set_result(value)
+            self._batch.futures.append(future)
+            return future
+        
+        t     = _time.time()
+        value = query()
+        
+        # Missing replies come back empty and are not worth remembering
+        def remember(value): 
+            if value not in ('', None): self.cache.set(name, value, t)
+        
+        def remember_result(future):
+            if not future.cancelled() and future.exception() is None: remember(future.result())
         
-        return bool(self.read())        
+        if isinstance(value, _futures.Future): value.add_done_callback(remember_result)
+        else:                                  remember(value)
+        return value
         
     def get_position(self):
         """
         Get the current absolute position of the Monochromator motor.
 
         """
-        if self.simulation:
-            return
+        return self._query('get_position', 'value')
+    
+    def get_pmt(self, samples=None, integration_time=None):
+        """
+        Get the photomultiplier tube (PMT) voltage. With samples or 
+        integration_time, many readings are accumulated on the arduino and
+        summarized in a single reply.
+
+        Parameters
+        ----------
+        samples=None : int
+            Number of readings to accumulate.
+        integration_time=None : float
+            Accumulate readings for this long instead (s).
+
+        Returns
+        -------
+        int
+            Digitized voltage [0-2**(bit_depth)-1], for a single reading.
+        PMT_stats
+            Number of readings, mean, variance, min and max otherwise.
+
+        """
+        if samples is not None:
+            samples = max(int(samples),1)
+            return self._query("get_pmt_avg,%d"%samples, 'text', parse_pmt_stats, samples*ADC_TIME)
         
-        self.write('get_position')
+        if integration_time is not None:
+            return self._query("get_pmt_time,%d"%max(int(integration_time*1e6),0), 'text', parse_pmt_stats, integration_time)
         
-        return int(self.read())
+        return self._query("get_pmt", 'value')
     
-    def get_pmt(self):
+    def get_knob(self):
         """
-        Get the photomultiplier tube (PMT) something.
+        Get the position of the front panel knob.
 
         Returns
         -------
         int
-            Digitized voltage [0-2**(bit_depth)-1].
+            Digitized knob voltage [0-1023].
+
+        """
+        return self._query("get_knob", 'value')
+    
+    def get_max_limit(self):
+        """
+        Get the state of the forward limit switch.
+
+        Returns
+        -------
+        bool
+            True if the switch is triggered.
+
+        """
+        return self._query("get_max_limit", 'value', bool)
+    
+    def get_min_limit(self):
+        """
+        Get the state of the reverse limit switch.
+
+        Returns
+        -------
+        bool
+            True if the switch is triggered.
+
+        """
+        return self._query("get_min_limit", 'value', bool)
+    
+    def get_status(self, fresh=False):
+        """
+        Get the full instrument status in a single serial transaction.
+
+        Parameters
+        ----------
+        fresh=False : bool
+            Ask the board for the settings even if the cache has them.
+        
+        Returns
+        -------
+        dict
+            Position, direction, calibration, control, max_limit, min_limit, pmt and state.
+
+        """
+        with self.batch() as batch:
+            position    = self.get_position()
+            direction   = self.get_direction(fresh)
+            calibration = self.get_calibration(fresh)
+            control     = self.get_control(fresh)
+            max_limit   = self.get_max_limit()
+            min_limit   = self.get_min_limit()
+            pmt         = self.get_pmt()
+            state       = self.get_state()
+        
+        return dict(position=position.result(), direction=direction.result(), calibration=calibration.result(),
+                    control=control.result(), max_limit=max_limit.result(), min_limit=min_limit.result(), 
+                    pmt=pmt.result(), state=state.result())
+    
+    @_contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager that buffers commands and sends them in a single 
+        write at the end of the with block. Inside the block, methods that
+        return a reply return a concurrent.futures.Future instead, which
+        is resolved once the block ends. Nested batches join the outer one.
+        
+        Scans cannot be batched.
+        
+        Example
+        -------
+        with api.batch() as batch:
+            position = api.get_position()
+            pmt      = api.get_pmt()
+        print(position.result(), pmt.result(), batch.results)
+        
+        """
+        if self._batch is not None: 
+            yield self._batch
+            return
+        
+        batch = self._batch = Batch()
+        try: 
+            yield batch
+        except:
+            for future in batch.futures: future.cancel()
+            raise
+        finally: 
+            self._batch = None
+        
+        # Everything goes out in one write, then the replies are read in order.
+        t = _time.time()
+        if self._late: self._discard_late()
+        if len(batch.data): self._serial_write(bytes(batch.data))
+        for future, kind, convert, duration, name in batch.pending:
+            try:                   future.set_result(self._read_reply(kind, convert, duration, name, t))
+            except Exception as e: future.set_exception(e)
+    
+    def set_binary(self, enabled=True):
+        """
+        Switch numeric replies and scan data between the text protocol and
+        compact binary frames. The text protocol is kept if the firmware
+        does not acknowledge the request.
+        
+        Parameters
+        ----------
+        enabled=True : bool
+            Whether to use binary frames.
+            
+        Returns
+        -------
+        bool
+            Whether binary mode is now enabled.
+        
+        """
+        if self._batch is not None: raise Exception('The protocol cannot be changed inside a batch.')
+        if self._subscriber:        raise Exception('The protocol cannot be changed while subscribed to telemetry.')
+        
+        self.write("set_binary,%d"%enabled)
+        
+        if self.read() == "BINARY,%d"%enabled: self.binary_mode = bool(enabled)
+        
+        return self.binary_mode
+    
+    def subscribe(self, callback, period_ms=100):
+        """
+        Ask the firmware to push a status frame every period_ms and call
+        callback(status) for each one, from a background thread. While 
+        subscribed, replies to other commands are picked out of the same 
+        stream, so the rest of the api keeps working. Text protocol only.
+        
+        Parameters
+        ----------
+        callback : callable
+            Called with a dict like the one from get_status(), plus knob and time.
+        period_ms=100 : int
+            Time between status frames (ms).
+        
+        """
+        if self.binary_mode: raise Exception('Telemetry is only available with the text protocol.')
+        
+        self._callback = callback
+        self.write("subscribe,%d"%period_ms)
+        
+        if self._subscriber is None:
+            self._subscriber = _threading.Thread(target=self._subscriber_loop, daemon=True)
+            self._subscribed = True
+            self._subscriber.start()
+    
+    def unsubscribe(self):
+        """
+        Stop the telemetry stream.
+        """
+        if self._subscriber is None: return
+        
+        self.write("subscribe,0")
+        self._subscribed = False
+        self._subscriber.join()
+        self._subscriber = None
+        
+        # Drop replies nobody read
+        while not self._replies.empty(): self._replies.get()
+    
+    @property
+    def subscribed(self):
+        """
+        Whether the telemetry stream is on (see subscribe()).
+        """
+        return self._subscriber is not None
+    
+    def _subscriber_loop(self):
+        """
+        Reads the serial line while subscribed, sending status frames to 
+        the callback and queueing everything else for read().
+        """
+        while self._subscribed and self.serial is not None:
+            try:    line = self._reader.read_line()
+            except: break
+            
+            if line is None: continue
+            self._trace('read', line)
+            
+            if   line.startswith('T,'):
+                try:               self.telemetry = parse_telemetry(line)
+                except Exception:  continue
+                if self.cache is not None:
+                    for name in ['control', 'direction', 'calibration']: self.cache.set(name, self.telemetry[name], self.telemetry['time'])
+                self._callback(self.telemetry)
+            elif line != '': self._replies.put(line)
+    
+    def scan(self, start, stop, stride=1, samples=1, writer=None):
+        """
+        Scan the motor from start to stop, reading the PMT at every stride
+        microsteps. The whole scan runs on the arduino, which streams the
+        data back as it goes. If the scan is stopped early (see stop()), 
+        only the points taken are returned.
+
+        Parameters
+        ----------
+        start : int
+            Absolute motor position of the first point.
+        stop : int
+            Absolute motor position of the last point. May be less than start.
+        stride=1 : int
+            Number of microsteps between points.
+        samples=1 : int
+            Number of PMT readings averaged at each point.
+        writer=None : Monochromator_storage.Run_writer
+            If specified, each point is appended to it as (time, position, 
+            counts) as soon as it arrives, e.g. with SCAN_DTYPE.
+
+        Returns
+        -------
+        positions : numpy.ndarray
+            Absolute motor position of each point.
+        counts : numpy.ndarray
+            Mean digitized PMT voltage at each point.
 
         """
+        if self._batch is not None: raise Exception('Scans cannot be batched.')
+        
+        start, stop, stride, samples = int(start), int(stop), max(int(stride),1), max(int(samples),1)
+        
+        t, io_time, reply_bytes = _time.time(), self._stats.io_time, self._reply_bytes
+        self.write("scan,%d,%d,%d,%d"%(start, stop, stride, samples))
+        if self.cache is not None: self.cache.invalidate('direction')
+        
+        try: 
+            positions, counts = self._read_scan(start, stop, stride, samples, writer)
+        except Exception as e:
+            self._failed('scan', e)
+            raise
+        
+        # Where the time went
+        self._stats.replied('scan', _time.time()-t, self._reply_bytes-reply_bytes)
+        self._stats.scanned(len(positions), samples, _time.time()-t, self._stats.io_time-io_time)
+        
+        return positions, counts
+    
+    def _read_scan(self, start, stop, stride, samples, writer=None, duration=None, positions=None):
+        """
+        Reads the data streamed back by a scan command (or a move program),
+        passing each point on to writer if specified. duration is the 
+        longest the stream may take (s), and positions, if known, replace 
+        the ones worked out from a binary scan header.
+        """
+        # Worst case duration: slew over the full range, then step through the scan.
+        if duration is None:
+            points   = abs(stop-start)//stride + 1
+            duration = (MAX_STEP + abs(stop-start))*self._step_time + points*samples*ADC_TIME
+        deadline = _time.time() + duration + self.serial.timeout
+        
+        if self.binary_mode: return self._read_scan_frames(deadline, samples, writer, positions)
+        
+        # Header with the number of points
+        reply = self._read_before(deadline)
+        if not reply.startswith('SCAN,'):
+            raise Exception('Unexpected reply to scan: %r'%reply)
+        points = int(reply.split(',')[1])
+        
+        positions = _n.empty(points, dtype=_n.int64)
+        sums      = _n.empty(points, dtype=_n.int64)
         
-        self.write("get_pmt")
+        filled = 0
+        reply  = self._read_before(deadline)
+        while reply != 'END':
+            if filled == points: raise Exception('Scan did not terminate properly.')
+            positions[filled], sums[filled] = reply.split(',')
+            if writer is not None: writer.append((_time.time(), positions[filled], sums[filled]/samples))
+            filled += 1
+            reply = self._read_before(deadline)
         
-        return int(self.read())
+        return positions[:filled], sums[:filled]/samples
+    
+    def measure_targets(self, targets, samples=1, backlash=BACKLASH, plan=True, writer=None):
+        """
+        Visits a list of positions and reads the PMT at each, with a single
+        move program run by the firmware (no round trip per target). Each
+        target is approached moving forward over at least backlash steps, 
+        so the slack of the drive is always taken up the same way.
+        
+        Parameters
+        ----------
+        targets : array-like
+            Positions to visit (microsteps).
+        samples=1 : int
+            Number of PMT readings averaged at each target.
+        backlash=BACKLASH : int
+            Forward run before each target (microsteps). 0 goes straight there.
+        plan=True : bool
+            Whether to reorder the targets with plan_targets() first. 
+            Otherwise they are visited in the order given.
+        writer=None : Monochromator_storage.Run_writer
+            If specified, each point is appended to it as (time, position, 
+            counts) as soon as it arrives.
+        
+        Returns
+        -------
+        positions : numpy.ndarray
+            Targets, in the order they were visited.
+        counts : numpy.ndarray
+            Mean digitized PMT voltage at each.
+        """
+        if self._batch is not None: raise Exception('Move programs cannot be batched.')
+        
+        samples, backlash = max(int(samples), 1), max(int(backlash), 0)
+        targets = _n.clip(_n.asarray(targets, dtype=_n.int64).ravel(), 0, MAX_STEP)
+        if plan: targets = plan_targets(targets, self.get_position(), backlash)
+        if self.cache is not None: self.cache.invalidate('direction')
+        
+        # Programs larger than the firmware's are run in pieces
+        all_positions, all_counts = [], []
+        for first in range(0, len(targets), PROGRAM_SIZE):
+            chunk = targets[first:first+PROGRAM_SIZE]
+            
+            self.write("prog_clear")
+            for n in range(0, len(chunk), PROGRAM_ARGS):
+                self.write("prog_add," + ",".join(str(target) for target in chunk[n:n+PROGRAM_ARGS]))
+            
+            t, io_time, reply_bytes = _time.time(), self._stats.io_time, self._reply_bytes
+            self.write("prog_run,%d,%d"%(samples, backlash))
+            
+            # Worst case duration: the whole path plus an approach to each target, from anywhere.
+            travel   = MAX_STEP + _n.abs(_n.diff(chunk)).sum() + 2*backlash*len(chunk)
+            duration = travel*self._step_time + len(chunk)*samples*ADC_TIME
+            try:
+                positions, counts = self._read_scan(0, 0, 1, samples, writer, duration, chunk)
+            except Exception as e:
+                self._failed('prog_run', e)
+                raise
+            
+            self._stats.replied('prog_run', _time.time()-t, self._reply_bytes-reply_bytes)
+            self._stats.scanned(len(positions), samples, _time.time()-t, self._stats.io_time-io_time)
+            
+            all_positions.append(positions)
+            all_counts   .append(counts)
+            if len(positions) < len(chunk): break # Stopped, or the firmware has no move programs
+        
+        if not all_positions: return _n.zeros(0, dtype=_n.int64), _n.zeros(0)
+        return _n.concatenate(all_positions), _n.concatenate(all_counts)
     
     def home(self):
         """
-        Home the motor.
+        Start homing the motor. Returns as soon as the board has started; 
+        use get_state() or wait_until_idle() to know when it is done.
         """
-        self.write('home')
+        if self.cache is not None: self.cache.invalidate('direction', 'calibration')
+        return self._query('home', 'text', lambda reply: reply == "HOMING")
+    
+    def move_to(self, position):
+        """
+        Start moving the motor to an absolute position. Returns immediately.
         
-        if self.read() == "HOMING": return True
-        else                      : return False
+        Parameters
+        ----------
+        position : int
+            Target position (microsteps).
+        
+        """
+        self.write("move_to,%d"%position)
+        if self.cache is not None: self.cache.invalidate('direction')
+    
+    def step_motor(self, steps):
+        """
+        Start stepping the motor in the current direction. Returns immediately.
+        
+        Parameters
+        ----------
+        steps : int
+            Number of microsteps.
+        
+        """
+        self.write("step_motor,%d"%steps)
+        if self.cache is not None: self.cache.invalidate('direction')
+    
+    def stop(self):
+        """
+        Stop the motor, abandoning any homing or scan in progress.
+        """
+        self.write("stop")
+    
+    def set_speed(self, steps_per_second):
+        """
+        Set the cruise speed of the motor. Moves accelerate up to this speed
+        and decelerate from it (see set_accel()).
+        
+        Parameters
+        ----------
+        steps_per_second : int
+            Cruise speed (microsteps/s). The firmware's minimum is 16.
+        
+        """
+        steps_per_second = max(int(steps_per_second), 16)
+        self._step_time  = max(STEP_TIME, 1.0/steps_per_second)
+        self.write("set_speed,%d"%steps_per_second)
+    
+    def get_speed(self):
+        """
+        Get the cruise speed of the motor (microsteps/s).
+        """
+        return self._query("get_speed", 'text', int)
+    
+    def set_accel(self, steps_per_second2):
+        """
+        Set the acceleration and deceleration of the motor.
+        
+        Parameters
+        ----------
+        steps_per_second2 : int
+            Acceleration (microsteps/s^2). The speed reachable is also limited
+            by the length of the firmware's ramp table, to 16*sqrt(acceleration).
+        
+        """
+        self.write("set_accel,%d"%max(int(steps_per_second2), 1))
+    
+    def get_accel(self):
+        """
+        Get the acceleration of the motor (microsteps/s^2).
+        """
+        return self._query("get_accel", 'text', int)
+    
+    def get_state(self):
+        """
+        Get the motion state of the motor.
+        
+        Returns
+        -------
+        str
+            One of MOTION_STATES.
+        
+        """
+        return self._query("get_state")
+    
+    def wait_until_idle(self, timeout=None, interval=0.05):
+        """
+        Wait until the motor has stopped moving.
+        
+        Parameters
+        ----------
+        timeout=None : number
+            Give up after this long (s). None waits forever.
+        interval=0.05 : number
+            Time between state queries (s).
+        
+        Returns
+        -------
+        bool
+            Whether the motor is idle.
+        
+        """
+        # A simulated port keeps its own time, which may run faster than ours
+        clock = getattr(self.serial, 'clock', _time.time)
+        sleep = getattr(self.serial, 'sleep', _time.sleep)
+        
+        deadline = None if timeout is None else clock() + timeout
+        while True:
+            state = self.get_state()
+            if state == "IDLE":            return True
+            if state not in MOTION_STATES: raise Exception('The monochromator stopped answering while waiting for the motor (get_state replied '+repr(state)+').')
+            if deadline is not None and clock() > deadline: return False
+            sleep(interval)
         
         
     def write(self,raw_data):
@@ -174,7 +1173,19 @@ class Monochromator_api():
         
         """
         encoded_data = (_serial_left_marker + raw_data + _serial_right_marker).encode()
-        self.serial.write(encoded_data) 
+        self._stats.sent(raw_data.split(',')[0], len(encoded_data))
+        
+        # Inside a batch, hold on to it until the batch is sent.
+        if self._batch is not None: self._batch.data += encoded_data
+        else:                       self._serial_write(encoded_data) 
+    
+    def _serial_write(self, data):
+        """
+        Writes bytes to the serial port, counting them.
+        """
+        self._stats.transferred(size_out=len(data))
+        self._trace('write', data)
+        self.serial.write(data)
     
     def read(self):
         """
@@ -185,12 +1196,233 @@ class Monochromator_api():
         str
             Raw data string read from the serial line.
         """
-        return self.serial.read_until(expected = '\r\n'.encode()).decode().strip('\r\n')
+        if self._subscriber is not None:
+            try:                 reply = self._replies.get(timeout = self.serial.timeout)
+            except _queue.Empty: reply = ''
+        
+        else:
+            reply = self._reader.read_line()
+            if reply is None: reply = ''
+            else:             self._trace('read', reply)
+        
+        if reply != '': self._reply_bytes += len(reply) + 2
+        return reply
+    
+    def stats(self):
+        """
+        Instrumentation of the serial traffic since the api was created (or
+        reset_stats() was called).
+        
+        Returns
+        -------
+        dict
+            bytes_in, bytes_out, timeouts, malformed and io_time (s spent 
+            waiting in serial reads) for the whole connection, plus:
+            
+            commands: for each command name, count (sent), replies, timeouts,
+            malformed, bytes_out, bytes_in, mean, p50, p99 and max_time (s) 
+            of the latency from sending to reading the reply, and a histogram
+            of the latencies with upper bin edges latency_bins.
+            
+            scans: count, points, duration (s), and how that time divides into
+            io_time (waiting for data), of which adc_time (estimated, PMT 
+            readings) and motor_and_link_time (moving and transferring), and 
+            own_time (parsing in this api).
+        """
+        return self._stats.summary()
+    
+    def reset_stats(self):
+        """
+        Clears the counters returned by stats().
+        """
+        self._stats.reset()
+    
+    def _trace(self, event, data):
+        """
+        Calls the trace hook, if any, with the time, the event ('write', 
+        'read', 'frame', 'timeout', 'malformed' or 'late') and its data.
+        """
+        if self.trace is not None: self.trace(_time.time(), event, data)
+    
+    def _failed(self, name, exception):
+        """
+        Records a command whose reply timed out or could not be parsed.
+        """
+        kind = 'timeouts' if str(exception).startswith('Timed out') else 'malformed'
+        if kind == 'timeouts': self._late += 1
+        self._stats.failed(name, kind)
+        self._trace('timeout' if kind == 'timeouts' else 'malformed', (name, repr(exception)))
+    
+    def _query(self, command, kind='text', convert=None, duration=0):
+        """
+        Sends a command that has a single reply and returns the converted
+        reply. Inside a batch, returns a Future for it instead.
+        
+        Parameters
+        ----------
+        command : str
+            Raw data string to be sent to the arduino.
+        kind='text' : str
+            'text' for a text line, or 'value' for a number (a frame in binary mode).
+        convert=None : callable
+            Applied to the reply, if specified.
+        duration=0 : float
+            How long the arduino needs before it can reply (s), on top of the timeout.
+        """
+        name = command.split(',')[0]
+        t    = _time.time()
+        if self._late and self._batch is None: self._discard_late()
+        self.write(command)
+        
+        if self._batch is not None:
+            future = _futures.Future()
+            self._batch.futures.append(future)
+            self._batch.pending.append((future, kind, convert, duration, name))
+            return future
+        
+        return self._read_reply(kind, convert, duration, name, t)
+    
+    def _read_reply(self, kind, convert=None, duration=0, name=None, t=None):
+        """
+        Reads a reply of the given kind ('text' or 'value'), applying convert 
+        if specified. Text replies may take duration (s) longer than the timeout.
+        The reply is recorded in stats() under name, sent at time t.
+        """
+        if t is None: t = _time.time()
+        reply_bytes = self._reply_bytes
+        
+        try:
+            if   kind == 'value': reply = self._read_value()
+            elif duration > 0:    reply = self._read_before(_time.time() + duration + self.serial.timeout)
+            else:                 reply = self.read()
+        except Exception as e:
+            self._failed(name, e)
+            raise
+        
+        # A missing text reply is passed on as an empty string
+        if reply == '': 
+            self._failed(name, Exception('Timed out waiting for the monochromator.'))
+            return reply if convert is None else convert(reply)
+        
+        try:                   reply = reply if convert is None else convert(reply)
+        except Exception as e:
+            self._failed(name, e)
+            raise
+        
+        self._stats.replied(name, _time.time()-t, self._reply_bytes-reply_bytes)
+        return reply
+    
+    def _read_value(self):
+        """
+        Reads a numeric reply, sent as a frame in binary mode or as text otherwise.
+        
+        Returns
+        -------
+        int
+            The value.
+        """
+        if not self.binary_mode: 
+            reply = self.read()
+            if reply == '': raise Exception('Timed out waiting for the monochromator.')
+            return int(reply)
+        
+        kind, payload = self._read_frame()
+        if kind != FRAME_VALUE: raise Exception('Expected a value frame, got type %d.'%kind)
+        
+        return int(_n.frombuffer(payload, '<u2')[0])
+    
+    def _read_frame(self, deadline=None):
+        """
+        Reads one binary frame from the serial line, skipping anything 
+        before the sync byte.
+        
+        Parameters
+        ----------
+        deadline=None : float
+            Keep waiting through read timeouts until this time (from time.time()).
+        
+        Returns
+        -------
+        kind : int
+            Frame type.
+        payload : bytes
+            Raw little-endian payload.
+        """
+        if deadline is None: deadline = _time.time()
+        
+        kind, payload = self._reader.read_frame(deadline)
+        
+        self._reply_bytes += len(payload) + 4
+        self._trace('frame', (kind, payload))
+        return kind, payload
+    
+    def _discard_late(self):
+        """
+        Drops replies to commands that timed out, if they have turned up
+        since, so they are not taken for replies to the next command. Only
+        what arrived before the next command is sent can be dropped.
+        """
+        if self._subscriber is not None:
+            dropped = 0
+            while dropped < self._late and not self._replies.empty(): 
+                self._replies.get()
+                dropped += 1
+        else: dropped = self._reader.discard(self._late)
+        
+        if dropped: self._trace('late', dropped)
+        self._late -= dropped
+    
+    def _read_scan_frames(self, deadline, samples, writer=None, positions=None):
+        """
+        Reads the binary frames streamed by a scan, filling the output 
+        arrays straight from the frame payloads, and passing each block of
+        points on to writer if specified.
+        """
+        kind, payload = self._read_frame(deadline)
+        if kind != FRAME_SCAN: raise Exception('Expected a scan header, got frame type %d.'%kind)
+        header = _n.frombuffer(payload, _scan_header)[0]
+        
+        if positions is None: positions = int(header['start']) + int(header['step'])*_n.arange(header['points'], dtype=_n.int64)
+        else:                 positions = _n.asarray(positions, dtype=_n.int64)[:header['points']]
+        sums      = _n.empty(header['points'], dtype=_n.int64)
+        
+        filled = 0
+        while True:
+            kind, payload = self._read_frame(deadline)
+            if kind == FRAME_END: break
+            
+            block = _n.frombuffer(payload, _sum_dtypes[kind])
+            sums[filled:filled+len(block)] = block
+            if writer is not None: 
+                t = _time.time()
+                writer.extend([(t, position, total/samples) for position, total in zip(positions[filled:filled+len(block)], block)])
+            filled += len(block)
+        
+        return positions[:filled], sums[:filled]/samples
+    
+    def _read_before(self, deadline):
+        """
+        Reads data from the serial line, waiting through read timeouts until 
+        the deadline (from time.time()). Used for replies that arrive only 
+        after the motor has moved.
+        
+        Returns
+        -------
+        str
+            Raw data string read from the serial line.
+        """
+        reply = self.read()
+        while reply == '' and _time.time() < deadline: reply = self.read()
+        if reply == '': raise Exception('Timed out waiting for the monochromator.')
+        return reply
             
     def disconnect(self):
         """
         Disconnects the port.
         """
-        if not self.simulation_mode and self.serial != None: 
+        self.unsubscribe()
+        
+        if self.serial != None: 
             self.serial.close()
+            _open_ports.discard(self.serial.port)
             self.serial = None
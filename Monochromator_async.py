@@ -0,0 +1,313 @@
+import asyncio as _asyncio
+import serial  as _serial
+import numpy   as _n
+
+from Monochromator_api import CONTROL_MODES, MAX_STEP, STEP_TIME, ADC_TIME, parse_pmt_stats, _serial_left_marker, _serial_right_marker, _open_ports
+
+class AsyncMonochromator_api():
+    """
+    asyncio client for the Atomic Spectra Monochromator hardware. Every
+    request is tagged (<#tag:command>) and the firmware echoes the tag in
+    its reply, so many requests can be in flight at once and replies are
+    matched to the right caller.
+
+    The serial port is read without blocking from a polling task on the
+    event loop, so no thread is dedicated to the device. Only the text
+    protocol is supported.
+
+    Parameters
+    ----------
+    port='COM4' : str
+        Name of the port to connect to, or 'Simulation' for a virtual instrument.
+    baudrate=115200 : int
+        Baud rate of the connection. Must match the instrument setting.
+    timeout=3 : number
+        How long to wait for each reply before giving up (s).
+    poll_interval=0.002 : number
+        How often the serial port is checked for new data (s).
+    reset=True : bool
+        Whether opening the port resets the arduino (by toggling DTR).
+    """
+    def __init__(self, port='COM4', baudrate=115200, timeout=3, poll_interval=0.002, reset=True):
+
+        self.timeout          = timeout
+        self.poll_interval    = poll_interval
+        self.firmware_version = None
+
+        if port == 'Simulation':
+            from Monochromator_simulator import Simulated_serial
+            self.serial = Simulated_serial(baudrate=baudrate, timeout=0, dtr=reset)
+        else: 
+            self.serial = _serial.Serial(baudrate=baudrate, timeout=0, exclusive=True)
+            self.serial.port = port
+            if not reset:
+                self.serial.dtr = False
+                self.serial.rts = False
+            self.serial.open()
+            _open_ports.add(port)
+
+        self._pending = dict()      # Tag -> (future, reply lines or None, last line)
+        self._tag     = 0
+        self._buffer  = bytearray()
+        self._reader  = None
+
+    async def connect(self):
+        """
+        Starts reading replies and pings the arduino until it answers, 
+        which is as soon as it has finished booting. Firmware without the 
+        ping command never answers; after the timeout we carry on regardless.
+        """
+        self._reader = _asyncio.ensure_future(self._read_loop())
+
+        deadline = _asyncio.get_running_loop().time() + self.timeout
+        while self.firmware_version is None and _asyncio.get_running_loop().time() < deadline:
+            try:                            self.firmware_version = await self.ping(timeout=0.25)
+            except _asyncio.TimeoutError:  pass
+
+        if self.firmware_version is None:
+            print('The monochromator did not answer a ping. Its firmware may predate the ready handshake.')
+        return self
+
+    async def disconnect(self):
+        """
+        Stops reading, fails any outstanding requests and closes the port.
+        """
+        if self._reader is not None:
+            self._reader.cancel()
+            try:                             await self._reader
+            except _asyncio.CancelledError: pass
+            self._reader = None
+
+        for future, lines, until in self._pending.values():
+            if not future.done(): future.set_exception(ConnectionError('Disconnected.'))
+        self._pending.clear()
+
+        self.serial.close()
+        _open_ports.discard(self.serial.port)
+
+    async def __aenter__(self): return await self.connect()
+    async def __aexit__(self, *a): await self.disconnect()
+
+    def write(self, raw_data):
+        """
+        Writes an untagged command, for commands that do not reply.
+
+        Parameters
+        ----------
+        raw_data : str
+            Raw data string to be sent to the arduino.
+        """
+        self.serial.write((_serial_left_marker + raw_data + _serial_right_marker).encode())
+
+    async def request(self, raw_data, until=None, timeout=None):
+        """
+        Sends a tagged command and waits for its reply.
+
+        Parameters
+        ----------
+        raw_data : str
+            Raw data string to be sent to the arduino.
+        until=None : str
+            For multi-line replies, the line that ends the reply.
+        timeout=None : number
+            How long to wait for the reply (s). Defaults to self.timeout.
+
+        Returns
+        -------
+        str or list
+            The reply line, or all the reply lines up to and including until.
+        """
+        self._tag = (self._tag + 1) % 65536
+        tag = self._tag
+
+        future = _asyncio.get_running_loop().create_future()
+        self._pending[tag] = (future, [] if until else None, until)
+
+        self.write('#%d:%s'%(tag, raw_data))
+
+        try:     return await _asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        finally: self._pending.pop(tag, None)
+
+    async def _read_loop(self):
+        """
+        Reads whatever is available on the serial line and hands complete
+        reply lines to the requests waiting for them.
+        """
+        while True:
+            waiting = self.serial.in_waiting
+            if waiting: self._buffer += self.serial.read(waiting)
+            else:       await _asyncio.sleep(self.poll_interval)
+
+            while True:
+                end = self._buffer.find(b'\r\n')
+                if end < 0: break
+                line = self._buffer[:end].decode(errors='replace')
+                del self._buffer[:end+2]
+                self._dispatch(line)
+
+    def _dispatch(self, line):
+        """
+        Routes one "#tag:reply" line to its request. Untagged lines are dropped.
+        """
+        if not line.startswith('#') or ':' not in line: return
+
+        tag, reply = line[1:].split(':', 1)
+        try:               pending = self._pending.get(int(tag))
+        except ValueError: return
+        if pending is None: return
+
+        future, lines, until = pending
+        if future.done(): return
+
+        if lines is None: future.set_result(reply)
+        else:
+            lines.append(reply)
+            if reply == until: future.set_result(lines)
+
+    async def ping(self, timeout=None):
+        """
+        Checks that the arduino is listening. Returns its firmware version.
+        """
+        reply = await self.request("ping", timeout=timeout)
+        return reply.split(',',1)[1] if reply.startswith('PONG,') else None
+
+    async def set_control(self, mode):
+        """
+        Set the control mode of the of the monochromator motor.
+
+        Parameters
+        ----------
+        mode : str
+            The desired operating mode.
+        """
+        if mode not in CONTROL_MODES:
+            print("Controller mode has not been changed. %s is not a vaild mode."%mode)
+            return
+        self.write("set_control,%s"%mode)
+
+    async def get_control(self):
+        """
+        Get the control mode of the of the monochromator motor.
+        """
+        return await self.request("get_control")
+
+    async def set_direction(self, direction):
+        """
+        Set the direction of the motor.
+
+        Parameters
+        ----------
+        direction: bool
+            False and True are the forward and backward directions, respectively.
+        """
+        self.write("set_direction,%d"%direction)
+
+    async def get_direction(self):
+        """
+        Get the current motor direction.
+        """
+        return bool(int(await self.request("get_direction")))
+
+    async def get_calibration(self):
+        """
+        Get the current status of operation.
+        """
+        return await self.request("get_calibration")
+
+    async def get_position(self):
+        """
+        Get the current absolute position of the Monochromator motor.
+        """
+        return int(await self.request("get_position"))
+
+    async def get_pmt(self, samples=None, integration_time=None):
+        """
+        Get the digitized photomultiplier tube (PMT) voltage, or a PMT_stats
+        summary of many readings. See Monochromator_api.get_pmt().
+        """
+        if samples is not None:
+            samples = max(int(samples),1)
+            return parse_pmt_stats(await self.request("get_pmt_avg,%d"%samples, timeout=self.timeout+samples*ADC_TIME))
+
+        if integration_time is not None:
+            return parse_pmt_stats(await self.request("get_pmt_time,%d"%max(int(integration_time*1e6),0),
+                                                      timeout=self.timeout+integration_time))
+
+        return int(await self.request("get_pmt"))
+
+    async def get_knob(self):
+        """
+        Get the position of the front panel knob.
+        """
+        return int(await self.request("get_knob"))
+
+    async def get_max_limit(self):
+        """
+        Get the state of the forward limit switch.
+        """
+        return bool(int(await self.request("get_max_limit")))
+
+    async def get_min_limit(self):
+        """
+        Get the state of the reverse limit switch.
+        """
+        return bool(int(await self.request("get_min_limit")))
+
+    async def home(self):
+        """
+        Home the motor. Returns once the board has started homing.
+        """
+        return await self.request("home") == "HOMING"
+
+    async def move_to(self, position):
+        """
+        Start moving the motor to an absolute position. Returns immediately.
+        """
+        self.write("move_to,%d"%position)
+
+    async def stop(self):
+        """
+        Stop the motor, abandoning any homing or scan in progress.
+        """
+        self.write("stop")
+
+    async def set_speed(self, steps_per_second):
+        """
+        Set the cruise speed of the motor (microsteps/s).
+        """
+        self.write("set_speed,%d"%max(int(steps_per_second), 16))
+
+    async def set_accel(self, steps_per_second2):
+        """
+        Set the acceleration and deceleration of the motor (microsteps/s^2).
+        """
+        self.write("set_accel,%d"%max(int(steps_per_second2), 1))
+
+    async def get_state(self):
+        """
+        Get the motion state of the motor (one of MOTION_STATES).
+        """
+        return await self.request("get_state")
+
+    async def scan(self, start, stop, stride=1, samples=1, timeout=None):
+        """
+        Scan the motor from start to stop. See Monochromator_api.scan().
+
+        Parameters
+        ----------
+        timeout=None : number
+            How long to wait for the whole scan (s). Defaults to the worst case
+            estimate used by Monochromator_api.scan().
+
+        Returns
+        -------
+        positions, counts : numpy.ndarray
+        """
+        start, stop, stride, samples = int(start), int(stop), max(int(stride),1), max(int(samples),1)
+        points = abs(stop-start)//stride + 1
+        if timeout is None: timeout = (MAX_STEP + abs(stop-start))*STEP_TIME + points*samples*ADC_TIME + self.timeout
+
+        lines = await self.request("scan,%d,%d,%d,%d"%(start, stop, stride, samples), until='END', timeout=timeout)
+
+        data = _n.array([line.split(',') for line in lines[1:-1]], dtype=_n.int64).reshape(-1,2)
+        return data[:,0], data[:,1]/samples
@@ -0,0 +1,375 @@
+"""
+Latency and throughput benchmarks for Monochromator_api, against the
+simulated instrument or real hardware. Results are saved as JSON so runs
+from different firmware and api revisions can be compared:
+
+    python Monochromator_benchmark.py --port Simulation --output new.json
+    python Monochromator_benchmark.py --compare old.json new.json
+    python Monochromator_benchmark.py --devices 1 2 4 8   # Monochromator_manager scaling
+"""
+import sys        as _sys
+import json       as _json
+import time       as _time
+import platform   as _platform
+import argparse   as _argparse
+import subprocess as _subprocess
+import numpy      as _n
+
+import Monochromator_api as _api
+
+# Commands timed by benchmark_commands(), as (name, function of the api)
+COMMANDS = [
+    ('get_pmt'        , lambda api: api.get_pmt()),
+    ('get_position'   , lambda api: api.get_position()),
+    ('get_state'      , lambda api: api.get_state()),
+    ('get_calibration', lambda api: api.get_calibration()),
+    ('get_pmt_avg_100', lambda api: api.get_pmt(samples=100)),
+    ('get_status'     , lambda api: api.get_status()),
+    ]
+
+class Counting_serial():
+    """
+    Wraps a serial port and counts the bytes going each way.
+
+    Parameters
+    ----------
+    serial : serial.Serial
+        Port to wrap. Everything not overridden is passed through.
+    """
+    def __init__(self, serial):
+        self.serial    = serial
+        self.bytes_in  = 0 # Received from the instrument
+        self.bytes_out = 0 # Sent to the instrument
+
+    def __getattr__(self, name): return getattr(self.serial, name)
+
+    def read(self, *args, **kwargs):
+        data = self.serial.read(*args, **kwargs)
+        self.bytes_in += len(data)
+        return data
+
+    def read_until(self, *args, **kwargs):
+        data = self.serial.read_until(*args, **kwargs)
+        self.bytes_in += len(data)
+        return data
+
+    def write(self, data):
+        self.bytes_out += len(data)
+        return self.serial.write(data)
+
+def summarize(times):
+    """
+    Summary statistics of a list of durations (s).
+
+    Returns
+    -------
+    dict
+        n, mean, min, max, p50 and p99.
+    """
+    times = _n.asarray(times, dtype=float)
+    return dict(n    = len(times),
+                mean = float(times.mean()),
+                min  = float(times.min()),
+                max  = float(times.max()),
+                p50  = float(_n.percentile(times, 50)),
+                p99  = float(_n.percentile(times, 99)))
+
+def clock_of(api):
+    """
+    Clock to time the api with: the simulated clock for a simulated
+    instrument (so fast simulations report instrument time), the
+    performance counter otherwise.
+    """
+    serial = api.serial.serial if isinstance(api.serial, Counting_serial) else api.serial
+    return getattr(serial, 'clock', _time.perf_counter)
+
+def benchmark_commands(api, repeats=200):
+    """
+    Round-trip latency of single commands.
+
+    Parameters
+    ----------
+    api : Monochromator_api
+        Connected instrument.
+    repeats=200 : int
+        Number of times each command is sent.
+
+    Returns
+    -------
+    dict
+        Latency summary (s) and bytes on the wire for each command in COMMANDS.
+    """
+    clock   = clock_of(api)
+    counter = api.serial
+    results = dict()
+
+    for name, function in COMMANDS:
+        function(api) # Warm up
+        bytes_in, bytes_out = counter.bytes_in, counter.bytes_out
+
+        times = []
+        for n in range(repeats):
+            t = clock()
+            function(api)
+            times.append(clock()-t)
+
+        results[name] = summarize(times)
+        results[name]['bytes_in']  = (counter.bytes_in -bytes_in )/repeats
+        results[name]['bytes_out'] = (counter.bytes_out-bytes_out)/repeats
+
+    return results
+
+def benchmark_home(api, timeout=120):
+    """
+    Time to home the motor (s), until it is idle again.
+    """
+    clock = clock_of(api)
+    t = clock()
+    api.home()
+    api.wait_until_idle(timeout)
+    return dict(duration=clock()-t, calibration=api.get_calibration())
+
+def benchmark_scan(api, start=24000, stop=26000, stride=10, samples=4, binary=False):
+    """
+    Throughput of a scan, starting with the motor already at start.
+
+    Returns
+    -------
+    dict
+        Duration (s), points per second and bytes received per point.
+    """
+    clock   = clock_of(api)
+    counter = api.serial
+
+    api.set_binary(binary)
+    api.move_to(start)
+    api.wait_until_idle(60)
+
+    bytes_in = counter.bytes_in
+    t = clock()
+    positions, counts = api.scan(start, stop, stride, samples)
+    duration = clock()-t
+    bytes_in = counter.bytes_in - bytes_in
+    binary   = api.binary_mode # False if the firmware does not support it
+
+    api.set_binary(False)
+    return dict(start=start, stop=stop, stride=stride, samples=samples, binary=binary,
+                points           = len(positions),
+                duration         = duration,
+                points_per_second= len(positions)/duration,
+                bytes_per_point  = bytes_in/max(len(positions),1))
+
+def benchmark_adaptive(api, start=20000, stop=30000, coarse_stride=None, samples=16):
+    """
+    Time of a full scan at stride 1 compared with an adaptive scan (see
+    Monochromator_scans) of the same range, both in binary mode.
+
+    Returns
+    -------
+    dict
+        Durations (s), speedup and number of points of each.
+    """
+    from Monochromator_scans import adaptive_scan
+    clock = clock_of(api)
+    api.set_binary(True)
+
+    api.move_to(start)
+    api.wait_until_idle(60)
+    t = clock()
+    positions, counts = api.scan(start, stop, 1, samples)
+    full = clock()-t
+
+    api.move_to(start)
+    api.wait_until_idle(60)
+    t = clock()
+    adaptive_positions, adaptive_counts, windows = adaptive_scan(api, start, stop, coarse_stride, 1, 1, samples)
+    adaptive = clock()-t
+
+    api.set_binary(False)
+    return dict(start=start, stop=stop, coarse_stride=coarse_stride, samples=samples,
+                full_duration     = full,
+                full_points       = len(positions),
+                adaptive_duration = adaptive,
+                adaptive_points   = len(adaptive_positions),
+                windows           = len(windows),
+                speedup           = full/adaptive)
+
+def benchmark_startup(port='Simulation', baudrate=115200, timeout=3):
+    """
+    Wall time from creating the api to the first PMT reading (s).
+    """
+    t   = _time.perf_counter()
+    api = _api.Monochromator_api(port=port, baudrate=baudrate, timeout=timeout)
+    api.get_pmt()
+    duration = _time.perf_counter()-t
+    api.disconnect()
+    return dict(duration=duration)
+
+def benchmark_devices(counts=(1, 2, 4, 8), span=1000, stride=10, samples=4, timeout=3):
+    """
+    Scaling of Monochromator_manager: the same scan on 1, 2, 4, ... simulated
+    instruments at once, on the wall clock. Ideally the total throughput
+    grows in proportion to the number of devices.
+
+    Parameters
+    ----------
+    counts=(1, 2, 4, 8) : tuple
+        Numbers of devices to scan with.
+    span=1000, stride=10, samples=4 : int
+        Length (microsteps), stride and PMT readings per point of the scan.
+
+    Returns
+    -------
+    dict
+        For each number of devices: duration (s), total points per second
+        and efficiency (throughput relative to that many single devices).
+    """
+    from Monochromator_manager import Monochromator_manager
+    manager = Monochromator_manager(timeout=timeout)
+    results = dict()
+    try:
+        names = manager.connect(['Simulation']*max(counts))
+        manager.home()
+        start = manager.gather(manager.call(_api.Monochromator_api.get_position, names=names[:1]))[names[0]]
+
+        single = None
+        for count in counts:
+            manager.move_to(start, names[:count])
+            t = _time.perf_counter()
+            scans = manager.scan(start, start-span, stride, samples, names[:count])
+            duration = _time.perf_counter()-t
+
+            points = sum(len(scan[0]) for scan in scans.values())
+            if single is None: single = points/duration/count
+            results[str(count)] = dict(duration=duration, points=points, points_per_second=points/duration,
+                                       efficiency=points/duration/(count*single))
+    finally:
+        manager.disconnect()
+
+    return dict(span=span, stride=stride, samples=samples, devices=results)
+
+def revision():
+    """
+    Git revision of the api, or None outside a git checkout.
+    """
+    try:    return _subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=_sys.path[0] or '.',
+                                            stderr=_subprocess.DEVNULL).decode().strip()
+    except Exception: return None
+
+def run(port='Simulation', baudrate=115200, timeout=3, repeats=200, home=True, realtime=True, startup=True):
+    """
+    Runs every benchmark.
+
+    Parameters
+    ----------
+    port='Simulation' : str
+        Port of the instrument, or 'Simulation'.
+    baudrate=115200 : int
+        Baud rate of the connection.
+    timeout=3 : number
+        Reply timeout (s).
+    repeats=200 : int
+        Number of times each command is timed.
+    home=True : bool
+        Whether to time homing (and home before the scans).
+    realtime=True : bool
+        For the simulation, whether the instrument runs on the wall clock.
+        Otherwise the simulated clock skips ahead whenever the api waits and
+        the results are in instrument time.
+    startup=True : bool
+        Whether to time startup-to-first-sample.
+
+    Returns
+    -------
+    dict
+        Results, ready to be saved as JSON.
+    """
+    results = dict(meta=dict(port=port, baudrate=baudrate, realtime=realtime, repeats=repeats,
+                             revision=revision(), time=_time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             python=_platform.python_version()))
+
+    if startup: results['startup'] = benchmark_startup(port, baudrate, timeout)
+
+    api = _api.Monochromator_api(port=port, baudrate=baudrate, timeout=timeout)
+    if api.simulation_mode and not realtime:
+        from Monochromator_simulator import Simulated_serial
+        api.serial = Simulated_serial(baudrate=baudrate, timeout=timeout, realtime=False, dtr=False)
+    api.serial = api._reader.serial = Counting_serial(api.serial)
+
+    try:
+        results['commands'] = benchmark_commands(api, repeats)
+        if home: results['home'] = benchmark_home(api)
+        results['scan_text']   = benchmark_scan(api, binary=False)
+        results['scan_binary'] = benchmark_scan(api, binary=True)
+        results['adaptive']    = benchmark_adaptive(api)
+    finally:
+        api.disconnect()
+
+    return results
+
+def compare(old, new):
+    """
+    Prints the ratio new/old of every time and rate found in both results.
+
+    Parameters
+    ----------
+    old, new : dict
+        Results from run(), or names of JSON files holding them.
+    """
+    if isinstance(old, str): old = _json.load(open(old))
+    if isinstance(new, str): new = _json.load(open(new))
+
+    def walk(a, b, path):
+        for key in a:
+            if key == 'meta' or key not in b: continue
+            if isinstance(a[key], dict): walk(a[key], b[key], path+[key])
+            elif isinstance(a[key], (int, float)) and not isinstance(a[key], bool) and a[key]:
+                print('%-45s %12.6g %12.6g %8.3f'%('.'.join(path+[key]), a[key], b[key], b[key]/a[key]))
+
+    print('%-45s %12s %12s %8s'%('', 'old', 'new', 'new/old'))
+    walk(old, new, [])
+
+def report(results):
+    """
+    Prints the main numbers of a run.
+    """
+    if 'startup' in results: print('startup to first sample  %8.3f s'%results['startup']['duration'])
+    for name, r in results.get('commands', dict()).items():
+        print('%-24s p50 %8.3f ms  p99 %8.3f ms  %5.1f bytes'%(name, 1e3*r['p50'], 1e3*r['p99'], r['bytes_in']+r['bytes_out']))
+    if 'home' in results: print('home                     %8.3f s'%results['home']['duration'])
+    for name in ['scan_text', 'scan_binary']:
+        if name not in results: continue
+        r = results[name]
+        print('%-24s %8.1f points/s  %5.2f bytes/point'%(name, r['points_per_second'], r['bytes_per_point']))
+    if 'adaptive' in results:
+        r = results['adaptive']
+        print('adaptive scan            %8.1f s vs %.1f s at full resolution (%.1fx)'%(r['adaptive_duration'], r['full_duration'], r['speedup']))
+    if 'devices' in results:
+        for count, r in results['devices']['devices'].items():
+            print('%2s devices               %8.1f points/s  %5.0f %% efficiency'%(count, r['points_per_second'], 100*r['efficiency']))
+
+if __name__ == '__main__':
+    parser = _argparse.ArgumentParser(description='Benchmark the Atomic Spectra Monochromator api.')
+    parser.add_argument('--port'      , default='Simulation')
+    parser.add_argument('--baudrate'  , type=int, default=115200)
+    parser.add_argument('--timeout'   , type=float, default=3)
+    parser.add_argument('--repeats'   , type=int, default=200)
+    parser.add_argument('--no-home'   , action='store_true', help='Do not home the motor.')
+    parser.add_argument('--no-startup', action='store_true', help='Do not time startup.')
+    parser.add_argument('--fast'      , action='store_true', help='Run the simulation on its own clock.')
+    parser.add_argument('--output'    , help='JSON file to save the results to.')
+    parser.add_argument('--compare'   , nargs=2, metavar=('OLD', 'NEW'), help='Compare two saved results and exit.')
+    parser.add_argument('--devices'   , type=int, nargs='+', metavar='N', help='Only time scans on N simulated instruments at once.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        _sys.exit()
+
+    if args.devices: results = dict(devices=benchmark_devices(args.devices, timeout=args.timeout))
+    else:            results = run(args.port, args.baudrate, args.timeout, args.repeats,
+                                   home=not args.no_home, realtime=not args.fast, startup=not args.no_startup)
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f: _json.dump(results, f, indent=2)
@@ -0,0 +1,193 @@
+"""
+Conversion between motor positions (microsteps) and wavelengths (nm).
+
+A Calibration is fitted once from reference lines of known wavelength found
+at measured positions, saved as JSON, and then converts whole arrays both
+ways through a dense lookup table covering every position of the motor:
+
+    calibration = Calibration.fit(positions, wavelengths, model='polynomial', degree=2)
+    calibration.save('calibration.json')
+
+    calibration = Calibration.load('calibration.json')
+    calibration.wavelength(positions)      # Array of nm
+    calibration.step_target(656.28)        # Position to give to move_to()
+
+Two models are available:
+
+    polynomial   wavelength = c0 + c1*p + c2*p**2 + ...
+    grating      wavelength = A*sin(theta0 + k*p), the grating equation of a
+                 fixed-deviation (Czerny-Turner) mount, with
+                 A = 2e6*cos(deviation/2)/(order*grooves_per_mm). Given the
+                 grating, theta0 and k follow from a linear fit of
+                 arcsin(wavelength/A) against p.
+"""
+import json  as _json
+import numpy as _n
+
+from Monochromator_api import MAX_STEP
+
+MODELS = ['polynomial', 'grating']
+
+class Calibration():
+    """
+    Position to wavelength mapping. Use Calibration.fit() or
+    Calibration.load() rather than creating one directly.
+
+    Parameters
+    ----------
+    model : str
+        One of MODELS.
+    parameters : dict
+        Parameters of the model: 'coefficients' (lowest power first) for a
+        polynomial; 'amplitude', 'theta0' and 'k' for a grating.
+    rms=None : float
+        Root mean square residual of the fit (nm).
+    points=None : list
+        Reference (position, wavelength) pairs the fit was made from.
+    """
+    def __init__(self, model, parameters, rms=None, points=None):
+
+        if model not in MODELS: raise Exception('Unknown calibration model %s. Use one of %s.'%(model, MODELS))
+
+        self.model      = model
+        self.parameters = dict(parameters)
+        self.rms        = rms
+        self.points     = [] if points is None else [list(p) for p in points]
+
+        self._table = None # Wavelength at every position, built when first needed
+
+    @classmethod
+    def fit(cls, positions, wavelengths, model='polynomial', degree=2, grooves_per_mm=1200, deviation=0, order=1):
+        """
+        Fits a calibration to reference lines.
+
+        Parameters
+        ----------
+        positions : array-like
+            Positions (microsteps) where the lines were found.
+        wavelengths : array-like
+            Known wavelengths of the lines (nm).
+        model='polynomial' : str
+            One of MODELS.
+        degree=2 : int
+            Degree of the polynomial model. Needs at least degree+1 lines.
+        grooves_per_mm=1200, deviation=0, order=1 : number
+            Groove density of the grating, full angle between the incident
+            and diffracted beams (degrees), and diffraction order, for the
+            grating model. Needs at least 2 lines.
+
+        Returns
+        -------
+        Calibration
+        """
+        positions   = _n.asarray(positions,   dtype=float)
+        wavelengths = _n.asarray(wavelengths, dtype=float)
+        if len(positions) != len(wavelengths): raise Exception('Got %d positions for %d wavelengths.'%(len(positions), len(wavelengths)))
+
+        if model == 'polynomial':
+            if len(positions) <= degree: raise Exception('A degree %d fit needs at least %d lines.'%(degree, degree+1))
+            coefficients = _n.polynomial.polynomial.polyfit(positions, wavelengths, degree)
+            parameters   = dict(coefficients=[float(c) for c in coefficients])
+
+        elif model == 'grating':
+            if len(positions) < 2: raise Exception('A grating fit needs at least 2 lines.')
+            amplitude = 2e6*_n.cos(_n.radians(deviation)/2)/(order*grooves_per_mm)
+            if _n.any(_n.abs(wavelengths) >= amplitude): raise Exception('Wavelengths beyond %.1f nm cannot be reached with this grating.'%amplitude)
+            k, theta0 = _n.polyfit(positions, _n.arcsin(wavelengths/amplitude), 1)
+            parameters = dict(amplitude=float(amplitude), theta0=float(theta0), k=float(k),
+                              grooves_per_mm=grooves_per_mm, deviation=deviation, order=order)
+
+        else: raise Exception('Unknown calibration model %s. Use one of %s.'%(model, MODELS))
+
+        calibration     = cls(model, parameters, points=list(zip(positions.tolist(), wavelengths.tolist())))
+        calibration.rms = float(_n.sqrt(_n.mean((calibration.evaluate(positions) - wavelengths)**2)))
+        return calibration
+
+    def evaluate(self, positions):
+        """
+        Wavelengths (nm) computed from the model itself, without the table.
+        """
+        positions = _n.asarray(positions, dtype=float)
+        if self.model == 'polynomial':
+            return _n.polynomial.polynomial.polyval(positions, self.parameters['coefficients'])
+        p = self.parameters
+        return p['amplitude']*_n.sin(p['theta0'] + p['k']*positions)
+
+    def table(self):
+        """
+        Wavelength (nm) at every position from 0 to MAX_STEP, computed once.
+        """
+        if self._table is None:
+            self._table = self.evaluate(_n.arange(MAX_STEP+1))
+            steps = _n.diff(self._table)
+            if not (_n.all(steps > 0) or _n.all(steps < 0)):
+                raise Exception('The calibration is not monotonic over 0-%d, so it cannot be inverted.'%MAX_STEP)
+        return self._table
+
+    def wavelength(self, positions):
+        """
+        Converts positions (microsteps, any shape) to wavelengths (nm) by
+        interpolating in the table. Positions outside 0-MAX_STEP are clipped.
+        """
+        table = self.table()
+        return _n.interp(positions, _n.arange(len(table)), table)
+
+    def position(self, wavelengths):
+        """
+        Converts wavelengths (nm, any shape) to fractional positions
+        (microsteps). This is a binary search in the table, so arrays of
+        any size are cheap. Wavelengths outside the range are clipped.
+        """
+        table = self.table()
+        steps = _n.arange(len(table), dtype=float)
+        if table[0] < table[-1]: return _n.interp(wavelengths, table, steps)
+        return _n.interp(wavelengths, table[::-1], steps[::-1])
+
+    def step_target(self, wavelengths):
+        """
+        Nearest whole positions (for move_to()) to wavelengths (nm). Returns
+        an int for a scalar, an integer array otherwise.
+        """
+        targets = _n.rint(self.position(wavelengths)).astype(int)
+        return int(targets) if targets.ndim == 0 else targets
+
+    def range(self):
+        """
+        Wavelengths (nm) at position 0 and MAX_STEP.
+        """
+        table = self.table()
+        return float(table[0]), float(table[-1])
+
+    def residuals(self):
+        """
+        Fit residuals (nm) at the reference points: measured minus model.
+        """
+        if not self.points: return _n.zeros(0)
+        positions, wavelengths = _n.array(self.points).T
+        return wavelengths - self.evaluate(positions)
+
+    def to_dict(self):
+        """
+        JSON-serializable description of the calibration.
+        """
+        return dict(version=1, model=self.model, parameters=self.parameters, rms=self.rms, points=self.points)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Inverse of to_dict().
+        """
+        return cls(data['model'], data['parameters'], data.get('rms'), data.get('points'))
+
+    def save(self, path):
+        """
+        Saves the calibration as JSON.
+        """
+        with open(path, 'w') as f: _json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a calibration saved with save().
+        """
+        with open(path) as f: return cls.from_dict(_json.load(f))
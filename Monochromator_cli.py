@@ -0,0 +1,218 @@
+"""
+Command line interface to the Atomic Spectra Monochromator, for scripts and
+headless acquisition. Only the api layer and numpy are imported; the GUI
+stack (spinmob, Qt, pyqtgraph) is only loaded by the gui command.
+
+    python -m Monochromator_cli scan --start 24000 --stop 26000 --stride 10 --out scan.csv
+    python -m Monochromator_cli scan --port Simulation --start 24000 --stop 26000 --stride 10
+    python -m Monochromator_cli status --port COM4
+    python -m Monochromator_cli startup
+"""
+import sys        as _sys
+import json       as _json
+import time       as _time
+import argparse   as _argparse
+import subprocess as _subprocess
+import numpy      as _n
+
+from Monochromator_api import Monochromator_api, MAX_STEP, STEP_TIME, BACKLASH
+
+def connect(args):
+    """
+    Opens the instrument described by the command line arguments. Without
+    --port, that is the one port that looks like an arduino; simulated data
+    is only ever recorded with --port Simulation.
+    """
+    port = args.port
+    if port is None:
+        from Monochromator_manager import find_arduinos
+        ports = find_arduinos()
+        if len(ports) != 1: 
+            raise SystemExit(('Found no arduino port. ' if not ports else 'Found several arduino ports: '+', '.join(ports)+'. ')
+                             + 'Choose one with --port (or --port Simulation for a virtual instrument).')
+        port = ports[0]
+    
+    api = Monochromator_api(port=port, baudrate=args.baudrate, timeout=args.timeout, reset=not args.no_reset)
+    if args.binary: api.set_binary(True)
+    return api
+
+def save(path, positions, counts):
+    """
+    Saves scan data as .npy (two columns) or text (anything else), or
+    prints it as csv if path is None.
+    """
+    data = _n.column_stack([positions, counts])
+    if   path is None:          _n.savetxt(_sys.stdout, data, fmt=['%d', '%.6g'], delimiter=',', header='position,counts', comments='')
+    elif path.endswith('.npy'): _n.save(path, data)
+    else:                       _n.savetxt(path, data, fmt=['%d', '%.6g'], delimiter=',', header='position,counts', comments='')
+
+def command_scan(args):
+    api = connect(args)
+    try:
+        if args.home:
+            api.home()
+            api.wait_until_idle(args.timeout + 2*MAX_STEP*STEP_TIME)
+        if args.adaptive:
+            from Monochromator_scans import adaptive_scan
+            positions, counts, windows = adaptive_scan(api, args.start, args.stop, args.coarse_stride, 1, args.stride, args.samples)
+        elif args.passes > 1:
+            from Monochromator_scans import averaged_scan
+            accumulator = averaged_scan(api, args.start, args.stop, args.stride, args.samples, args.passes, args.sem)
+            positions, counts = accumulator.spectrum()
+            print('%d passes, largest standard error %.3g, background %.6g'%(
+                accumulator.passes, _n.nanmax(accumulator.sem()), accumulator.background()[0]), file=_sys.stderr)
+        else: positions, counts = api.scan(args.start, args.stop, args.stride, args.samples)
+    finally: api.disconnect()
+    save(args.out, positions, counts)
+    
+    # Name the lamp from the peaks. Printed to stderr so stdout stays csv.
+    if args.calibration:
+        from Monochromator_calibration import Calibration
+        from Monochromator_lines       import identify_scan
+        for match in identify_scan(positions, counts, Calibration.load(args.calibration))[:5]:
+            print('%-6s score %.3f  %d of %d lines'%match, file=_sys.stderr)
+
+def command_measure(args):
+    targets = list(args.at or [])
+    if args.nm:
+        if not args.calibration: raise SystemExit('--nm needs --calibration.')
+        from Monochromator_calibration import Calibration
+        targets += list(Calibration.load(args.calibration).step_target(args.nm))
+    
+    api = connect(args)
+    try:     positions, counts = api.measure_targets(targets, args.samples, args.backlash)
+    finally: api.disconnect()
+    save(args.out, positions, counts)
+
+def command_status(args):
+    api = connect(args)
+    try:     status = api.get_status()
+    finally: api.disconnect()
+    status['firmware_version'] = api.firmware_version
+    print(_json.dumps(status, indent=2))
+
+def command_home(args):
+    api = connect(args)
+    try:
+        api.home()
+        if args.wait and not api.wait_until_idle(args.timeout + 2*MAX_STEP*STEP_TIME):
+            raise SystemExit('Homing did not finish in time.')
+        print(api.get_calibration())
+    finally: api.disconnect()
+
+def command_move(args):
+    api = connect(args)
+    try:
+        distance = abs(args.to - api.get_position()) + BACKLASH
+        api.move_to(args.to)
+        if args.wait and not api.wait_until_idle(args.timeout + distance*STEP_TIME):
+            raise SystemExit('The move did not finish in time.')
+        print(api.get_position())
+    finally: api.disconnect()
+
+def command_pmt(args):
+    api = connect(args)
+    try:
+        if args.samples is None: print(api.get_pmt())
+        else:                    print(_json.dumps(api.get_pmt(samples=args.samples)._asdict()))
+    finally: api.disconnect()
+
+def command_gui(args):
+    import Monochromator # Loads the whole GUI stack
+    Monochromator.Monochrmator(block=True)
+
+def import_cost(module, repeats=3):
+    """
+    Time (s) and peak resident memory (kB, None if unavailable) to start a
+    fresh python and import module. Returns the best of repeats, or None
+    if the import fails.
+    """
+    code = ("import time; t = time.perf_counter(); import %s; t = time.perf_counter() - t\n"
+            "try:\n    import resource; m = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+            "except ImportError: m = None\n"
+            "print(t, m)")%module
+
+    results = []
+    for n in range(repeats):
+        t = _time.perf_counter()
+        process = _subprocess.run([_sys.executable, '-c', code], capture_output=True, text=True, cwd=_sys.path[0] or '.')
+        if process.returncode: return None
+        total = _time.perf_counter() - t
+        imported, memory = process.stdout.split()
+        results.append((total, float(imported), None if memory == 'None' else int(memory)))
+
+    return min(results)
+
+def command_startup(args):
+    print('%-26s %10s %10s %12s'%('', 'start (s)', 'import (s)', 'memory (kB)'))
+    for label, module in [('cli (api + numpy)', 'Monochromator_cli'), ('gui (spinmob + Qt)', 'Monochromator')]:
+        cost = import_cost(module, args.repeats)
+        if cost is None: print('%-26s could not be imported'%label)
+        else:            print('%-26s %10.3f %10.3f %12s'%(label, cost[0], cost[1], cost[2]))
+
+def parser():
+    """
+    Command line parser.
+    """
+    parser = _argparse.ArgumentParser(prog='python -m Monochromator_cli', description='Control the Atomic Spectra Monochromator.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add(name, function, help):
+        command = commands.add_parser(name, help=help)
+        command.set_defaults(function=function)
+        command.add_argument('--port'    , help='Serial port, or Simulation. Defaults to the only arduino found.')
+        command.add_argument('--baudrate', type=int, default=115200)
+        command.add_argument('--timeout' , type=float, default=3, help='Reply timeout (s).')
+        command.add_argument('--no-reset', action='store_true', help='Open the port without resetting the arduino.')
+        command.add_argument('--binary'  , action='store_true', help='Use binary frames for numbers and scan data.')
+        return command
+
+    scan = add('scan', command_scan, 'Scan and save the PMT counts.')
+    scan.add_argument('--start'  , type=int, required=True, help='First position (microsteps).')
+    scan.add_argument('--stop'   , type=int, required=True, help='Last position (microsteps).')
+    scan.add_argument('--stride' , type=int, default=1, help='Microsteps between points.')
+    scan.add_argument('--samples', type=int, default=1, help='PMT readings averaged at each point.')
+    scan.add_argument('--home'   , action='store_true', help='Home the motor first.')
+    scan.add_argument('--adaptive', action='store_true', help='Sweep quickly first, then scan at --stride only around the lines found.')
+    scan.add_argument('--coarse-stride', type=int, help='Stride of the adaptive sweep. Swept on the fly if omitted.')
+    scan.add_argument('--passes' , type=int, default=1, help='Repeat the scan and save the mean of the passes.')
+    scan.add_argument('--sem'    , type=float, help='With --passes, stop once the standard error is at most this everywhere.')
+    scan.add_argument('--out'    , help='Output file (.npy, otherwise csv). Printed if omitted.')
+    scan.add_argument('--calibration', help='Calibration file (see Monochromator_calibration) to identify the lines with.')
+
+    measure = add('measure', command_measure, 'Read the PMT at a list of positions, in one move program.')
+    measure.add_argument('--at'      , type=int, nargs='+', metavar='POSITION', help='Positions (microsteps).')
+    measure.add_argument('--nm'      , type=float, nargs='+', metavar='WAVELENGTH', help='Wavelengths (nm), with --calibration.')
+    measure.add_argument('--calibration', help='Calibration file (see Monochromator_calibration).')
+    measure.add_argument('--samples' , type=int, default=1, help='PMT readings averaged at each position.')
+    measure.add_argument('--backlash', type=int, default=BACKLASH, help='Forward run before each position (microsteps).')
+    measure.add_argument('--out'     , help='Output file (.npy, otherwise csv). Printed if omitted.')
+    
+    add('status', command_status, 'Print the instrument status as JSON.')
+
+    home = add('home', command_home, 'Home the motor.')
+    home.add_argument('--wait', action='store_true', help='Wait until homing is done.')
+
+    move = add('move', command_move, 'Move the motor to an absolute position.')
+    move.add_argument('--to'  , type=int, required=True, help='Target position (microsteps).')
+    move.add_argument('--wait', action='store_true', help='Wait until the move is done.')
+
+    pmt = add('pmt', command_pmt, 'Read the PMT.')
+    pmt.add_argument('--samples', type=int, help='Summarize this many readings taken on the arduino.')
+
+    gui = commands.add_parser('gui', help='Open the GUI.')
+    gui.set_defaults(function=command_gui)
+
+    startup = commands.add_parser('startup', help='Compare the startup cost of the cli and the GUI.')
+    startup.add_argument('--repeats', type=int, default=3)
+    startup.set_defaults(function=command_startup)
+
+    return parser
+
+def main(argv=None):
+    cli  = parser()
+    args = cli.parse_args(argv)
+    if args.command == 'scan' and args.adaptive and args.passes > 1: cli.error('--adaptive cannot be combined with --passes.')
+    args.function(args)
+
+if __name__ == '__main__': main()
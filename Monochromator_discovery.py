@@ -0,0 +1,243 @@
+"""
+Background discovery of the serial ports that really have a monochromator
+on them. Listing ports can take a while on some systems, and a trial
+connection costs the board's boot time, so a Port_discovery thread keeps
+the list up to date instead:
+
+    discovery = Port_discovery()
+    discovery.start()
+    ...
+    for port in discovery.monochromators(): print(port.device, port.version)
+
+The port list is re-read every interval, which is also how ports being
+plugged in or removed are noticed. Every new port that looks like an
+arduino (see Monochromator_manager.is_arduino()) is probed once, all of
+them in parallel: the probe sends a ping without resetting the board and
+accepts the firmware's PONG,<version> (or the READY,<version> banner of a
+board that reset anyway). Ports are opened exclusively, so a port in use
+by another program is never disturbed, and the ports this process has
+open are not touched at all. Busy ports are tried again on the next pass.
+"""
+import os                 as _os
+import time               as _time
+import errno              as _errno
+import threading          as _threading
+import collections        as _collections
+import concurrent.futures as _futures
+import serial             as _serial
+
+from serial.tools.list_ports import comports as _comports
+from Monochromator_api       import _serial_left_marker, _serial_right_marker, _open_ports
+from Monochromator_manager   import is_arduino
+
+PROBE_TIMEOUT  = 2.5  # Longest wait for a board to answer (s), enough for one that resets when opened
+PROBE_INTERVAL = 0.25 # Time between pings while probing (s), in case the first ones land during a reset
+
+# One listed port. version is the firmware version if the port answered a probe, None otherwise.
+# busy is True if the port was in use (here or by another program) when last probed.
+Port_info = _collections.namedtuple('Port_info', ['device', 'description', 'hwid', 'arduino', 'version', 'busy'])
+
+def probe(port, baudrate=115200, timeout=PROBE_TIMEOUT):
+    """
+    Asks whatever is on a port whether it is a monochromator, without
+    resetting it (DTR and RTS are kept low). The port is opened
+    exclusively, and ports already open in this process are skipped.
+
+    Parameters
+    ----------
+    port : str
+        Name of the port, or 'Simulation'.
+    baudrate=115200 : int
+        Baud rate of the firmware.
+    timeout=PROBE_TIMEOUT : float
+        Longest time to wait for an answer (s).
+
+    Returns
+    -------
+    str or None
+        Firmware version, or None if the port is busy or did not answer.
+    """
+    return _probe(port, baudrate, timeout)[0]
+
+def _in_use(error):
+    """
+    Whether an exception from opening a port means someone else has it
+    open: the exclusive lock or the device itself was busy, or access was
+    denied on Windows, which is how it reports a port open elsewhere.
+    Other failures (port gone, no permission on posix) are not.
+    """
+    if getattr(error, 'errno', None) in (_errno.EBUSY, _errno.EAGAIN, _errno.EWOULDBLOCK): return True
+    if 'exclusively lock' in str(error):                                               return True
+    return _os.name == 'nt' and ('PermissionError' in str(error) or 'Access is denied' in str(error))
+
+def _probe(port, baudrate=115200, timeout=PROBE_TIMEOUT):
+    """
+    probe(), also telling whether the port was busy: returns (version, busy).
+    """
+    if port in _open_ports: return None, True
+    try:
+        if port == 'Simulation':
+            from Monochromator_simulator import Simulated_serial
+            serial = Simulated_serial(baudrate=baudrate, timeout=0.05, dtr=False)
+        else:
+            serial = _serial.Serial(baudrate=baudrate, timeout=0.05, exclusive=True)
+            serial.port = port
+            serial.dtr  = False
+            serial.rts  = False
+            serial.open()
+    except Exception as e: return None, _in_use(e)
+
+    try:
+        deadline  = _time.time() + timeout
+        next_ping = 0
+        buffer    = b''
+        while _time.time() < deadline:
+            if _time.time() >= next_ping:
+                serial.write((_serial_left_marker + 'ping' + _serial_right_marker).encode())
+                next_ping = _time.time() + PROBE_INTERVAL
+
+            buffer += serial.read(max(serial.in_waiting, 1))
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                line = line.decode(errors='replace').strip()
+                if line.startswith('PONG,') or line.startswith('READY,'): return line.split(',', 1)[1], False
+        return None, False
+
+    except Exception: return None, False
+    finally:          serial.close()
+
+class Port_discovery(_threading.Thread):
+    """
+    Background thread keeping a cached list of the serial ports, with the
+    ones answering as the monochromator firmware identified.
+
+    Parameters
+    ----------
+    interval=2.0 : float
+        Time between readings of the port list (s).
+    baudrate=115200 : int
+        Baud rate of the probes.
+    probe_timeout=PROBE_TIMEOUT : float
+        Longest wait for each probe (s). The probes run in parallel.
+    probe_all=False : bool
+        Probe every port, not only those that look like an arduino.
+    on_change=None : function
+        Called with this object (from the discovery thread) whenever the
+        list changes. GUIs should rather watch revision from a timer.
+    """
+    def __init__(self, interval=2.0, baudrate=115200, probe_timeout=PROBE_TIMEOUT, probe_all=False, on_change=None):
+        _threading.Thread.__init__(self, daemon=True)
+
+        self.interval      = interval
+        self.baudrate      = baudrate
+        self.probe_timeout = probe_timeout
+        self.probe_all     = probe_all
+        self.on_change     = on_change
+
+        self.revision   = 0                  # Incremented whenever the list changes
+        self.ready      = _threading.Event() # Set once the first listing and probes are done
+        self.last_error = None               # Last exception raised while listing
+
+        self._ports    = dict()  # Device -> Port_info, replaced as a whole on every change
+        self._excluded = set()   # Ports not to probe, e.g. because they are in use
+        self._reprobe  = False   # Whether the next pass probes again the ports that did not answer
+        self._wake     = _threading.Event()
+        self._stopped  = _threading.Event()
+
+    def ports(self):
+        """
+        Every listed port, those answering as a monochromator first.
+
+        Returns
+        -------
+        list
+            Port_info of each port.
+        """
+        return sorted(self._ports.values(), key=lambda p: (p.version is None, not p.arduino, p.device))
+
+    def monochromators(self):
+        """
+        Only the ports that answered as the monochromator firmware.
+
+        Returns
+        -------
+        list
+            Port_info of each port, version set.
+        """
+        return [p for p in self.ports() if p.version is not None]
+
+    def refresh(self):
+        """
+        Reads the port list again now, and probes again the ports that did
+        not answer before.
+        """
+        self._reprobe = True
+        self._wake.set()
+
+    def exclude(self, port):
+        """
+        Stops probing a port. Its last result is kept. Ports open in this
+        process are skipped anyway.
+        """
+        self._excluded.add(port)
+
+    def include(self, port):
+        """
+        Allows probing a port again, after exclude().
+        """
+        self._excluded.discard(port)
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread and waits for it to finish (at most the time of a
+        pass of probes).
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self.is_alive(): self.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:                   self.update()
+            except Exception as e: self.last_error = e
+            self.ready.set()
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def update(self):
+        """
+        One pass: reads the port list, forgets the ports that are gone and
+        probes the new ones (and those that were busy) in parallel.
+        """
+        reprobe, self._reprobe = self._reprobe, False
+
+        listed = {p.device: p for p in _comports()}
+        known  = {device: info for device, info in self._ports.items()
+                  if device in listed and info.hwid == listed[device].hwid} # A different device on the same port is new
+
+        candidates = [p for device, p in listed.items()
+                      if device not in self._excluded and device not in _open_ports and (self.probe_all or is_arduino(p))
+                      and (device not in known or known[device].busy or reprobe and known[device].version is None)]
+
+        results = dict()
+        if candidates:
+            with _futures.ThreadPoolExecutor(len(candidates)) as pool:
+                for p, result in zip(candidates, pool.map(lambda p: _probe(p.device, self.baudrate, self.probe_timeout), candidates)):
+                    results[p.device] = result
+
+        ports = dict()
+        for device, p in listed.items():
+            if device in results:
+                version, busy = results[device]
+                if busy and device in known: version = known[device].version # Keep what we knew until it can be asked again
+                ports[device] = Port_info(device, p.description, p.hwid, is_arduino(p), version, busy)
+            elif device in known:
+                ports[device] = known[device]._replace(busy=device in _open_ports or known[device].busy)
+            else:
+                ports[device] = Port_info(device, p.description, p.hwid, is_arduino(p), None, device in _open_ports)
+
+        if ports != self._ports:
+            self._ports    = ports
+            self.revision += 1
+            if self.on_change: self.on_change(self)
@@ -0,0 +1,267 @@
+"""
+Reference emission lines and automatic identification of measured peaks.
+
+The bundled table (Monochromator_lines.csv) holds the strong lines of the
+usual discharge lamps. It is shipped sorted as Monochromator_lines.npz,
+which is what gets loaded; after editing the csv, regenerate it with
+Line_database.load(LINES_CSV).save(LINES_NPZ). Larger lists (e.g. exported
+from the NIST atomic spectra database, with the same
+element,wavelength,intensity columns) can be loaded instead and saved as
+.npz the same way. Lines are kept as
+arrays sorted by wavelength, so matching any number of peaks is a couple
+of binary searches:
+
+    positions, counts = api.scan(0, MAX_STEP, 10)
+    print(identify_scan(positions, counts, Calibration.load('calibration.json')))
+"""
+import os          as _os
+import collections as _collections
+import numpy       as _n
+
+LINES_CSV = _os.path.join(_os.path.dirname(_os.path.abspath(__file__)), 'Monochromator_lines.csv') # Source of the bundled table
+LINES_NPZ = _os.path.join(_os.path.dirname(_os.path.abspath(__file__)), 'Monochromator_lines.npz') # Same table, sorted, as loaded
+
+# Score of one element against a list of peaks. See Line_database.identify().
+Identification = _collections.namedtuple('Identification', ['element', 'score', 'matched', 'lines'])
+
+class Line_database():
+    """
+    Emission lines sorted by wavelength.
+
+    Parameters
+    ----------
+    elements : array-like of str
+        Element (or ion, e.g. 'Ar II') of each line.
+    wavelengths : array-like
+        Wavelength of each line (nm).
+    intensities=None : array-like
+        Relative intensity of each line. All equal if None.
+    """
+    def __init__(self, elements, wavelengths, intensities=None):
+
+        wavelengths = _n.asarray(wavelengths, dtype=float)
+        intensities = _n.ones(len(wavelengths)) if intensities is None else _n.asarray(intensities, dtype=float)
+        order       = _n.argsort(wavelengths, kind='stable')
+
+        # Elements are stored as indices into self.elements
+        self.elements, element = _n.unique(_n.asarray(elements, dtype=str), return_inverse=True)
+        self.elements   = [str(e) for e in self.elements]
+        self.wavelength = wavelengths[order]
+        self.intensity  = intensities[order]
+        self.element    = element[order].astype(_n.int16)
+
+        # Intensity relative to the strongest line of the same element
+        strongest = _n.zeros(len(self.elements))
+        _n.maximum.at(strongest, self.element, self.intensity)
+        self.weight = self.intensity/_n.where(strongest > 0, strongest, 1)[self.element]
+
+    def __len__(self): return len(self.wavelength)
+
+    @classmethod
+    def load(cls, path=LINES_NPZ):
+        """
+        Loads lines from a csv file (element,wavelength,intensity with a
+        header, # comments allowed) or from an .npz saved with save().
+        """
+        if path.endswith('.npz'):
+            data = _n.load(path)
+            return cls(data['elements'][data['element']], data['wavelength'], data['intensity'])
+
+        with open(path) as f: rows = [line.split(',') for line in f if line.strip() and not line.startswith('#')]
+        header = [name.strip() for name in rows[0]]
+        data   = dict(zip(header, zip(*[[value.strip() for value in row] for row in rows[1:]])))
+        return cls(data['element'], _n.array(data['wavelength'], dtype=float), _n.array(data['intensity'], dtype=float))
+
+    def save(self, path):
+        """
+        Saves the sorted arrays as .npz.
+        """
+        _n.savez(path, elements=_n.array(self.elements), element=self.element, wavelength=self.wavelength, intensity=self.intensity)
+
+    def select(self, elements):
+        """
+        A new database with only the lines of the given elements.
+        """
+        keep = _n.isin(self.element, [self.elements.index(e) for e in elements if e in self.elements])
+        return Line_database(_n.array(self.elements)[self.element[keep]], self.wavelength[keep], self.intensity[keep])
+
+    def window(self, low, high):
+        """
+        Slice of the lines with low <= wavelength <= high.
+        """
+        return slice(_n.searchsorted(self.wavelength, low, 'left'), _n.searchsorted(self.wavelength, high, 'right'))
+
+    def nearest(self, wavelengths):
+        """
+        Nearest line to each wavelength.
+
+        Returns
+        -------
+        index, distance : numpy.ndarray
+            Index of the nearest line and (line - wavelength) in nm.
+        """
+        wavelengths = _n.asarray(wavelengths, dtype=float)
+        right = _n.minimum(_n.searchsorted(self.wavelength, wavelengths), len(self)-1)
+        left  = _n.maximum(right - 1, 0)
+        index = _n.where(wavelengths - self.wavelength[left] <= self.wavelength[right] - wavelengths, left, right)
+        return index, self.wavelength[index] - wavelengths
+
+    def match(self, wavelengths, tolerance=0.5):
+        """
+        Every (peak, line) pair closer than tolerance.
+
+        Parameters
+        ----------
+        wavelengths : array-like
+            Measured peak wavelengths (nm).
+        tolerance=0.5 : float
+            Largest accepted difference (nm).
+
+        Returns
+        -------
+        peak, line : numpy.ndarray
+            Index of the peak and of the line for each pair.
+        """
+        wavelengths = _n.asarray(wavelengths, dtype=float)
+        low   = _n.searchsorted(self.wavelength, wavelengths - tolerance, 'left')
+        count = _n.searchsorted(self.wavelength, wavelengths + tolerance, 'right') - low
+
+        # Expand each peak's [low, low+count) range of lines into pairs
+        peak  = _n.repeat(_n.arange(len(wavelengths)), count)
+        start = _n.repeat(_n.cumsum(count) - count, count)
+        line  = _n.repeat(low, count) + _n.arange(len(peak)) - start
+        return peak, line
+
+    def identify(self, wavelengths, tolerance=0.5, range=None):
+        """
+        Scores each element by how well its lines explain the peaks.
+
+        An element scores the sum, over peaks, of the best matching line's
+        weight (intensity relative to the element's strongest line) times
+        its closeness (1 at the line, 0 at the tolerance), divided by the
+        total weight of its lines within range. A lamp of that element
+        showing all its lines at the right place scores 1; missing strong
+        lines or spurious near-coincidences score less.
+
+        Parameters
+        ----------
+        wavelengths : array-like
+            Measured peak wavelengths (nm).
+        tolerance=0.5 : float
+            Largest accepted difference (nm).
+        range=None : (float, float)
+            Wavelength range that was measured. Defaults to the span of the
+            peaks.
+
+        Returns
+        -------
+        list
+            Identification(element, score, matched, lines) for each element
+            with at least one match, best first. matched is the number of
+            peaks explained and lines the number of lines within range.
+        """
+        wavelengths = _n.asarray(wavelengths, dtype=float)
+        if not len(wavelengths): return []
+        if range is None: range = (wavelengths.min() - tolerance, wavelengths.max() + tolerance)
+
+        peak, line = self.match(wavelengths, tolerance)
+        value      = self.weight[line]*(1 - _n.abs(self.wavelength[line] - wavelengths[peak])/tolerance)
+
+        # Best line of each element for each peak
+        best = _n.zeros((len(wavelengths), len(self.elements)))
+        _n.maximum.at(best, (peak, self.element[line]), value)
+
+        inside   = self.window(*range)
+        expected = _n.bincount(self.element[inside], self.weight[inside], minlength=len(self.elements))
+        lines    = _n.bincount(self.element[inside], minlength=len(self.elements))
+        matched  = (best > 0).sum(axis=0)
+        score    = best.sum(axis=0)/_n.where(expected > 0, expected, 1)
+
+        results = [Identification(self.elements[e], float(score[e]), int(matched[e]), int(lines[e]))
+                   for e in _n.argsort(-score) if matched[e]]
+        return results
+
+_default_database = None
+
+def default_database():
+    """
+    The bundled line table, loaded once.
+    """
+    global _default_database
+    if _default_database is None: _default_database = Line_database.load()
+    return _default_database
+
+def robust_threshold(y, sigmas=5):
+    """
+    Level sigmas times the noise above the baseline of y, with the baseline
+    and noise estimated from the median and median absolute deviation, so
+    sparse peaks do not bias them.
+    """
+    y      = _n.asarray(y, dtype=float)
+    median = _n.median(y)
+    return median + sigmas*1.4826*_n.median(_n.abs(y - median))
+
+def find_peaks(x, y, threshold=None, width=2):
+    """
+    Local maxima of a scan.
+
+    Parameters
+    ----------
+    x, y : array-like
+        Evenly spaced positions and counts of the scan.
+    threshold=None : float
+        Smallest peak height. Defaults to robust_threshold(y).
+    width=2 : int
+        A peak must be the highest point within this many points on each
+        side.
+
+    Returns
+    -------
+    x_peak, y_peak : numpy.ndarray
+        Peak positions, refined by fitting a parabola through the top three
+        points, and heights.
+    """
+    x = _n.asarray(x, dtype=float)
+    y = _n.asarray(y, dtype=float)
+    if len(y) < 2*width+1: return _n.zeros(0), _n.zeros(0)
+
+    if threshold is None: threshold = robust_threshold(y)
+
+    # Highest in its window (the first of equal neighbours) and above threshold
+    window = _n.lib.stride_tricks.sliding_window_view(_n.pad(y, width, constant_values=-_n.inf), 2*width+1)
+    top    = (y == window.max(axis=1)) & (y > threshold)
+    top[1:] &= y[1:] != y[:-1]
+    i = _n.flatnonzero(top)
+    i = i[(i > 0) & (i < len(y)-1)]
+
+    # Parabola through the top three points
+    left, center, right = y[i-1], y[i], y[i+1]
+    curvature = left - 2*center + right
+    shift     = _n.where(curvature < 0, 0.5*(left - right)/_n.where(curvature < 0, curvature, -1), 0)
+    return x[i] + shift*(x[i+1] - x[i-1])/2, center
+
+def identify_scan(positions, counts, calibration, database=None, tolerance=0.5, threshold=None, width=2):
+    """
+    Finds the peaks of a scan and identifies the elements they come from.
+
+    Parameters
+    ----------
+    positions, counts : array-like
+        Scan data, as returned by Monochromator_api.scan().
+    calibration : Monochromator_calibration.Calibration
+        Position to wavelength conversion.
+    database=None : Line_database
+        Reference lines. Defaults to the bundled table.
+    tolerance, threshold, width :
+        See Line_database.identify() and find_peaks().
+
+    Returns
+    -------
+    list
+        See Line_database.identify().
+    """
+    if not len(positions): return []
+    if database is None: database = default_database()
+    peaks, heights = find_peaks(positions, counts, threshold, width)
+    span = calibration.wavelength([_n.min(positions), _n.max(positions)])
+    return database.identify(calibration.wavelength(peaks), tolerance, (span.min(), span.max()))
@@ -0,0 +1,323 @@
+"""
+Several monochromators driven from one process. Each instrument gets its
+own Acquisition_worker, which owns the api, polls the status in the
+background and runs everything else handed to it, so the instruments work
+concurrently while each serial line only ever has one user:
+
+    manager = Monochromator_manager()
+    manager.connect()                       # Every port that looks like an arduino
+    manager.home()
+    results = manager.scan(24000, 26000, 10)
+    print(manager.summary())
+    manager.disconnect()
+
+Simulated instruments are added by listing 'Simulation' as many times as
+needed, e.g. manager.connect(['Simulation']*4).
+"""
+import time               as _time
+import concurrent.futures as _futures
+
+from Monochromator_api         import Monochromator_api, MAX_STEP, STEP_TIME, CALIBRATION_STATES, MOTION_STATES
+from Monochromator_acquisition import Acquisition_worker
+
+from serial.tools.list_ports import comports as _comports
+
+# USB vendor ids of arduinos and of the usb-serial chips found on clones
+ARDUINO_VIDS = {
+    0x2341 : 'Arduino',
+    0x2A03 : 'Arduino (arduino.org)',
+    0x1A86 : 'CH340',
+    0x10C4 : 'CP210x',
+    0x0403 : 'FTDI',
+    }
+
+def is_arduino(port):
+    """
+    Whether a port listed by serial.tools.list_ports.comports() looks like an
+    arduino: 'Arduino' in its description, as the GUI has always checked, or
+    the USB vendor id of an arduino or of a usb-serial chip used on clones
+    (which describe themselves as e.g. 'USB-SERIAL CH340').
+    """
+    return 'Arduino' in (port.description or '') or getattr(port, 'vid', None) in ARDUINO_VIDS
+
+def find_arduinos():
+    """
+    Names of the serial ports that look like an arduino (see is_arduino()),
+    sorted.
+    """
+    return sorted(p.device for p in _comports() if is_arduino(p))
+
+class Device():
+    """
+    One instrument of a Monochromator_manager.
+
+    Parameters
+    ----------
+    name : str
+        Name the manager knows it by.
+    port : str
+        Serial port it is connected to.
+    api : Monochromator_api
+        Connected instrument. Only the worker uses it.
+    poll_interval=1.0 : float
+        Time between status polls (s).
+    """
+    def __init__(self, name, port, api, poll_interval=1.0):
+
+        self.name    = name
+        self.port    = port
+        self.api     = api
+        self.worker  = Acquisition_worker(api, poll_interval, buffer_size=1000)
+        self.pending = set() # Futures of the calls queued or running on the worker
+
+        self.worker.start()
+
+    def call(self, function, *args, **kwargs):
+        """
+        Runs function(api, *args, **kwargs) on the device's worker.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the return value of the function.
+        """
+        future = self.worker.call(function, self.api, *args, **kwargs)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+    def status(self):
+        """
+        Latest polled status.
+
+        Returns
+        -------
+        dict
+            port, time, position, pmt, calibration and state of the last
+            poll (None before the first), busy (calls queued or running) and
+            error (the last polling error, or None).
+        """
+        status = dict(port=self.port, time=None, position=None, pmt=None, calibration=None, state=None,
+                      busy=len(self.pending) > 0, error=self.worker.last_error)
+
+        sample = self.worker.buffer.latest()
+        if sample is not None:
+            status.update(time        = float(sample['time']),
+                          position    = float(sample['position']),
+                          pmt         = float(sample['pmt']),
+                          calibration = CALIBRATION_STATES[sample['calibration']] if sample['calibration'] >= 0 else None,
+                          state       = MOTION_STATES     [sample['state']]       if sample['state']       >= 0 else None)
+        return status
+
+    def close(self, timeout=5):
+        """
+        Stops the worker and closes the port.
+        """
+        self.worker.stop(timeout)
+        self.api.disconnect()
+
+class Monochromator_manager():
+    """
+    Supervises several instruments. Commands are sent to all of them (or to
+    those named) at once, and their results gathered per device.
+
+    Parameters
+    ----------
+    poll_interval=1.0 : float
+        Time between status polls of each device (s).
+    baudrate=115200, timeout=3, reset=True :
+        Passed to each Monochromator_api.
+    api_class=Monochromator_api : class
+        Api to create for each port.
+    """
+    def __init__(self, poll_interval=1.0, baudrate=115200, timeout=3, reset=True, api_class=Monochromator_api):
+
+        self.poll_interval = poll_interval
+        self.baudrate      = baudrate
+        self.timeout       = timeout
+        self.reset         = reset
+        self.api_class     = api_class
+
+        self.devices = dict() # Name -> Device, in the order they were connected
+
+    def __len__(self): return len(self.devices)
+
+    def _open(self, port):
+        """
+        Creates the api of a port, or returns None if the port could not be
+        opened.
+        """
+        try:                   return self.api_class(port=port, baudrate=self.baudrate, timeout=self.timeout, reset=self.reset)
+        except Exception as e: print(e)
+
+    def connect(self, ports=None):
+        """
+        Connects to instruments, all at once, so the time spent waiting for
+        the boards to boot is only paid once.
+
+        Parameters
+        ----------
+        ports=None : list
+            Ports to connect to. Defaults to find_arduinos(). Repeat
+            'Simulation' for several simulated instruments.
+
+        Returns
+        -------
+        list
+            Names of the devices that connected: the port, with a number
+            appended if it was already in use (e.g. 'Simulation 2').
+        """
+        if ports is None: ports = find_arduinos()
+        if not ports: return []
+
+        with _futures.ThreadPoolExecutor(len(ports)) as pool: apis = list(pool.map(self._open, ports))
+
+        names = []
+        for port, api in zip(ports, apis):
+            if api is None:
+                print('Could not connect to '+port+'. Skipping it.')
+                continue
+
+            name, n = port, 1
+            while name in self.devices:
+                n   += 1
+                name = '%s %d'%(port, n)
+
+            self.devices[name] = Device(name, port, api, self.poll_interval)
+            names.append(name)
+
+        return names
+
+    def disconnect(self, names=None):
+        """
+        Stops the workers and closes the ports of the named devices (all by
+        default).
+        """
+        for name in self._names(names): self.devices.pop(name).close()
+
+    def _names(self, names):
+        """
+        Names of the devices to act on: all of them if names is None.
+        """
+        if names is None: return list(self.devices)
+        for name in names:
+            if name not in self.devices: raise Exception('No device named '+repr(name)+'. Connected: '+', '.join(self.devices))
+        return list(names)
+
+    def call(self, function, *args, names=None, **kwargs):
+        """
+        Runs function(api, *args, **kwargs) on every named device (all by
+        default) at once, each on its own worker.
+
+        Returns
+        -------
+        dict
+            Name -> concurrent.futures.Future of the result.
+        """
+        return {name: self.devices[name].call(function, *args, **kwargs) for name in self._names(names)}
+
+    def gather(self, futures, timeout=None):
+        """
+        Waits for the futures returned by call().
+
+        Parameters
+        ----------
+        futures : dict
+            Name -> future.
+        timeout=None : float
+            Longest time to wait for all of them (s). Devices that have not
+            finished by then get a TimeoutError.
+
+        Returns
+        -------
+        dict
+            Name -> result, or the exception the call raised.
+        """
+        deadline = None if timeout is None else _time.time() + timeout
+        results  = dict()
+        for name, future in futures.items():
+            try:                   results[name] = future.result(None if deadline is None else max(deadline - _time.time(), 0))
+            except Exception as e: results[name] = e
+        return results
+
+    def home(self, names=None, timeout=None):
+        """
+        Homes the named devices (all by default) and waits until they are
+        idle.
+
+        Returns
+        -------
+        dict
+            Name -> calibration state, or the exception raised.
+        """
+        if timeout is None: timeout = self.timeout + 2*MAX_STEP*STEP_TIME
+        def home(api):
+            api.home()
+            api.wait_until_idle(timeout)
+            return api.get_calibration(fresh=True)
+        return self.gather(self.call(home, names=names), timeout)
+
+    def move_to(self, position, names=None, timeout=None):
+        """
+        Moves the named devices (all by default) to position and waits until
+        they are idle.
+
+        Returns
+        -------
+        dict
+            Name -> position reached, or the exception raised.
+        """
+        def move(api):
+            api.move_to(position)
+            api.wait_until_idle(timeout)
+            return api.get_position()
+        return self.gather(self.call(move, names=names), timeout)
+
+    def scan(self, start, stop, stride=1, samples=1, names=None, writers=None, timeout=None):
+        """
+        Runs the same scan on the named devices (all by default) at once.
+        See Monochromator_api.scan().
+
+        Parameters
+        ----------
+        writers=None : dict
+            Name -> Monochromator_storage.Run_writer receiving the points of
+            that device.
+        timeout=None : float
+            Longest time to wait for all the scans (s).
+
+        Returns
+        -------
+        dict
+            Name -> (positions, counts), or the exception raised.
+        """
+        writers = dict() if writers is None else writers
+        futures = {name: self.devices[name].call(Monochromator_api.scan, start, stop, stride, samples, writers.get(name))
+                   for name in self._names(names)}
+        return self.gather(futures, timeout)
+
+    def status(self):
+        """
+        Latest polled status of every device.
+
+        Returns
+        -------
+        dict
+            Name -> status, see Device.status().
+        """
+        return {name: device.status() for name, device in self.devices.items()}
+
+    def summary(self):
+        """
+        Number of devices in each motion state, plus 'BUSY' (running a
+        command), 'NOT_HOMED' (calibration not completed) and 'ERROR' (last
+        poll failed) counts.
+        """
+        counts = dict(BUSY=0, NOT_HOMED=0, ERROR=0)
+        for status in self.status().values():
+            state = status['state'] or 'UNKNOWN'
+            counts[state] = counts.get(state, 0) + 1
+            counts['BUSY']      += status['busy']
+            counts['NOT_HOMED'] += status['calibration'] != 'COMPLETED'
+            counts['ERROR']     += status['error'] is not None
+        return counts
@@ -0,0 +1,187 @@
+"""
+Decimation for live plots of long acquisitions. Both classes keep a fixed
+number of min/max bins, so what is drawn each frame depends on the
+width of the plot, not on how many samples have been collected.
+"""
+import numpy as _n
+
+class Minmax_decimator():
+    """
+    A time series reduced to at most capacity bins, each holding the min
+    and max of consecutive samples. When the bins are full, neighbouring
+    pairs are merged and each bin then covers twice as many samples, so
+    memory and drawing cost stay fixed however long the run.
+
+    Parameters
+    ----------
+    capacity=2048 : int
+        Maximum number of bins (rounded up to even). About twice the plot
+        width in pixels is plenty.
+    """
+    def __init__(self, capacity=2048):
+
+        self.capacity = capacity + capacity % 2
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets all the samples.
+        """
+        self.x       = _n.zeros(self.capacity) # x of the first sample in each bin
+        self.ymin    = _n.zeros(self.capacity)
+        self.ymax    = _n.zeros(self.capacity)
+        self.bins    = 0 # Bins in use, the last one possibly partial
+        self.per_bin = 1 # Samples per full bin
+        self.partial = 0 # Samples in the last bin if it is not full
+        self.count   = 0 # Samples seen
+
+    def extend(self, x, y):
+        """
+        Adds samples.
+
+        Parameters
+        ----------
+        x, y : array-like
+            Coordinates of the samples, in order of increasing x.
+        """
+        x = _n.asarray(x, dtype=float)
+        y = _n.asarray(y, dtype=float)
+        self.count += len(x)
+
+        i = 0
+        while i < len(x):
+
+            # Top up the partial bin
+            if self.partial:
+                k    = min(self.per_bin - self.partial, len(x) - i)
+                last = self.bins - 1
+                self.ymin[last] = min(self.ymin[last], y[i:i+k].min())
+                self.ymax[last] = max(self.ymax[last], y[i:i+k].max())
+                self.partial = (self.partial + k) % self.per_bin
+                i += k
+                continue
+
+            if self.bins == self.capacity: self._merge()
+
+            # As many whole bins as fit, then a partial one
+            whole = min((len(x) - i)//self.per_bin, self.capacity - self.bins)
+            if whole:
+                size  = whole*self.per_bin
+                block = y[i:i+size].reshape(whole, self.per_bin)
+                self.x   [self.bins:self.bins+whole] = x[i:i+size:self.per_bin]
+                self.ymin[self.bins:self.bins+whole] = block.min(axis=1)
+                self.ymax[self.bins:self.bins+whole] = block.max(axis=1)
+                self.bins += whole
+                i         += size
+
+            elif len(x) - i:
+                k = len(x) - i
+                self.x   [self.bins] = x[i]
+                self.ymin[self.bins] = y[i:].min()
+                self.ymax[self.bins] = y[i:].max()
+                self.bins   += 1
+                self.partial = k
+                i           += k
+
+    def _merge(self):
+        """
+        Halves the resolution: merges the bins in pairs.
+        """
+        half = self.bins//2
+        self.x   [:half] = self.x[0:self.bins:2]
+        self.ymin[:half] = _n.minimum(self.ymin[0:self.bins:2], self.ymin[1:self.bins:2])
+        self.ymax[:half] = _n.maximum(self.ymax[0:self.bins:2], self.ymax[1:self.bins:2])
+        self.bins     = half
+        self.per_bin *= 2
+
+    def envelope(self):
+        """
+        Curve to draw: for each bin, its min then its max.
+
+        Returns
+        -------
+        x, y : numpy.ndarray
+            Twice as many points as bins in use.
+        """
+        return _n.repeat(self.x[:self.bins], 2), _n.column_stack([self.ymin[:self.bins], self.ymax[:self.bins]]).ravel()
+
+class Column_binner():
+    """
+    Min/max of y in fixed columns of x, for a spectrum that is filled in
+    any order (e.g. PMT counts against motor position, over several scans).
+
+    Parameters
+    ----------
+    x_min, x_max : float
+        Range of x covered by the columns. Samples outside it are ignored.
+    columns=1024 : int
+        Number of columns, about the plot width in pixels.
+    """
+    def __init__(self, x_min, x_max, columns=1024):
+
+        self.x_min   = x_min
+        self.x_max   = x_max
+        self.columns = columns
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets all the samples.
+        """
+        self.ymin  = _n.full(self.columns,  _n.inf)
+        self.ymax  = _n.full(self.columns, -_n.inf)
+        self.last  = _n.full(self.columns,  _n.nan) # Most recent y in each column
+        self.count = _n.zeros(self.columns, dtype=_n.int64)
+
+    def set_range(self, x_min, x_max, columns=None):
+        """
+        Changes the columns (e.g. after zooming). This clears the samples;
+        add them again from the acquisition buffer or a saved run.
+        """
+        self.x_min, self.x_max = x_min, x_max
+        if columns is not None: self.columns = columns
+        self.clear()
+
+    def extend(self, x, y):
+        """
+        Adds samples, in any order.
+        """
+        x = _n.asarray(x, dtype=float)
+        y = _n.asarray(y, dtype=float)
+
+        index = _n.floor((x - self.x_min)*(self.columns/(self.x_max - self.x_min))).astype(_n.int64)
+        keep  = (index >= 0) & (index < self.columns) & (y == y)
+        index, y = index[keep], y[keep]
+
+        _n.minimum.at(self.ymin, index, y)
+        _n.maximum.at(self.ymax, index, y)
+        self.last[index] = y # For repeated indices, numpy keeps the last one
+        self.count += _n.bincount(index, minlength=self.columns)
+
+    def centers(self):
+        """
+        x at the center of each column.
+        """
+        return self.x_min + (_n.arange(self.columns) + 0.5)*(self.x_max - self.x_min)/self.columns
+
+    def envelope(self):
+        """
+        Curve to draw: for each column with samples, its min then its max.
+
+        Returns
+        -------
+        x, y : numpy.ndarray
+        """
+        used = self.count > 0
+        return _n.repeat(self.centers()[used], 2), _n.column_stack([self.ymin[used], self.ymax[used]]).ravel()
+
+    def latest(self):
+        """
+        Most recent y in each column with samples.
+
+        Returns
+        -------
+        x, y : numpy.ndarray
+        """
+        used = self.count > 0
+        return self.centers()[used], self.last[used]
@@ -0,0 +1,388 @@
+"""
+Scan strategies built on Monochromator_api.scan().
+
+Emission spectra are mostly dark baseline, so adaptive_scan() first sweeps
+the range quickly, then rescans only the windows around what stood out, at
+fine stride and with more PMT readings per point:
+
+    positions, counts, windows = adaptive_scan(api, 0, MAX_STEP)
+
+Repeated scans are averaged as they stream in by a Scan_accumulator, which
+keeps running statistics per position instead of every pass, and
+averaged_scan() repeats a scan until the spectrum is known well enough:
+
+    accumulator = averaged_scan(api, 24000, 26000, 10, passes=50, target=0.5)
+    positions, counts = accumulator.spectrum()
+"""
+import numpy as _n
+
+from Monochromator_api   import MAX_STEP
+from Monochromator_lines import robust_threshold
+
+class Scan_accumulator():
+    """
+    Running mean and variance (Welford's algorithm) at each point of a scan
+    repeated many times, plus a running estimate of the dark background of
+    each pass. Memory does not grow with the number of passes.
+
+    Points are added as they arrive by passing the accumulator as the
+    writer of Monochromator_api.scan(), between start_pass() and
+    end_pass(), or a whole pass at once with add_pass().
+
+    Parameters
+    ----------
+    start, stop : int
+        First and last position of the scan. stop may be less than start.
+    stride=1 : int
+        Microsteps between points. Points off this grid are ignored.
+    dark=None : (int, int)
+        Range of positions with no lines, whose mean is the background of a
+        pass. Defaults to the median of the pass, which sparse lines do not
+        bias.
+    writer=None : Monochromator_storage.Run_writer
+        If specified, also receives every point, e.g. to keep the raw data.
+    """
+    def __init__(self, start, stop, stride=1, dark=None, writer=None):
+
+        stride = max(int(stride), 1)
+        self.start  = int(start)
+        self.step   = stride if stop >= start else -stride
+        self.dark   = dark
+        self.writer = writer
+
+        self.positions = self.start + self.step*_n.arange(abs(int(stop)-self.start)//stride + 1)
+        self.count     = _n.zeros(len(self.positions), dtype=_n.int64)
+        self.mean      = _n.zeros(len(self.positions))
+        self._m2       = _n.zeros(len(self.positions)) # Sum of squared deviations from the mean
+        self._pass     = _n.full(len(self.positions), _n.nan) # Points of the pass in progress
+
+        self.passes = 0 # Passes completed
+
+        # Same running statistics for the background of each pass
+        self.background_count = 0
+        self.background_mean  = 0.0
+        self._background_m2   = 0.0
+
+    def __len__(self): return len(self.positions)
+
+    def start_pass(self):
+        """
+        Starts a new pass.
+        """
+        self._pass[:] = _n.nan
+
+    def append(self, row):
+        """
+        Adds one point, as (time, position, counts).
+        """
+        self.extend([row])
+
+    def extend(self, rows):
+        """
+        Adds points, as a sequence of (time, position, counts).
+        """
+        if self.writer is not None: self.writer.extend(rows)
+        if not len(rows): return
+
+        times, positions, counts = _n.asarray(rows, dtype=float).T
+        index = (positions - self.start)/self.step
+        keep  = (index == _n.rint(index)) & (index >= 0) & (index < len(self)) & (counts == counts)
+        index, counts = index[keep].astype(_n.int64), counts[keep]
+
+        # A point already taken in this pass is a new pass in all but name
+        if len(_n.unique(index)) < len(index) or _n.any(self._pass[index] == self._pass[index]):
+            for i, c in zip(index, counts): self._update(_n.array([i]), _n.array([c]))
+        else: self._update(index, counts)
+
+    def _update(self, index, counts):
+        """
+        Welford update of distinct points.
+        """
+        self.count[index] += 1
+        delta = counts - self.mean[index]
+        self.mean[index] += delta/self.count[index]
+        self._m2 [index] += delta*(counts - self.mean[index])
+        self._pass[index] = counts
+
+    def end_pass(self):
+        """
+        Finishes a pass and updates the background estimate with it.
+        """
+        taken = self._pass == self._pass
+        if self.dark is not None:
+            low, high = min(self.dark), max(self.dark)
+            taken    &= (self.positions >= low) & (self.positions <= high)
+        self.passes += 1
+        if not _n.any(taken): return
+
+        background = _n.median(self._pass[taken]) if self.dark is None else self._pass[taken].mean()
+        self.background_count += 1
+        delta = background - self.background_mean
+        self.background_mean += delta/self.background_count
+        self._background_m2  += delta*(background - self.background_mean)
+
+    def add_pass(self, positions, counts):
+        """
+        Adds a whole pass, e.g. as returned by Monochromator_api.scan().
+        """
+        self.start_pass()
+        self.extend(list(zip(_n.zeros(len(positions)), positions, counts)))
+        self.end_pass()
+
+    def variance(self):
+        """
+        Sample variance of the passes at each point (nan with fewer than 2).
+        """
+        with _n.errstate(invalid='ignore', divide='ignore'):
+            return _n.where(self.count > 1, self._m2/(self.count - 1), _n.nan)
+
+    def sem(self):
+        """
+        Standard error of the mean at each point (nan with fewer than 2
+        passes).
+        """
+        with _n.errstate(invalid='ignore', divide='ignore'):
+            return _n.sqrt(self.variance()/self.count)
+
+    def background(self):
+        """
+        Mean background of the passes and its standard error (nan with
+        fewer than 2 passes).
+        """
+        n = self.background_count
+        if n < 2: return float(self.background_mean) if n else _n.nan, _n.nan
+        return float(self.background_mean), float(_n.sqrt(self._background_m2/(n - 1)/n))
+
+    def converged(self, target):
+        """
+        Whether the standard error at every point is at most target.
+        """
+        sem = self.sem()
+        return bool(_n.all(sem == sem) and _n.all(sem <= target))
+
+    def spectrum(self, subtract=False):
+        """
+        Mean counts at each point taken at least once.
+
+        Parameters
+        ----------
+        subtract=False : bool
+            Whether to subtract the mean background.
+
+        Returns
+        -------
+        positions, counts : numpy.ndarray
+        """
+        taken  = self.count > 0
+        counts = self.mean[taken] - (self.background_mean if subtract else 0)
+        return self.positions[taken], counts
+
+def averaged_scan(api, start, stop, stride=1, samples=1, passes=10, target=None, dark=None, alternate=False, writer=None):
+    """
+    Repeats a scan and averages the passes as they stream in, optionally
+    stopping as soon as the spectrum is known well enough.
+
+    Parameters
+    ----------
+    api : Monochromator_api
+        Connected instrument.
+    start, stop, stride, samples : int
+        The scan, see Monochromator_api.scan().
+    passes=10 : int
+        Largest number of passes.
+    target=None : float
+        If specified, stop once the standard error of the mean at every
+        point is at most this (counts). Needs at least 2 passes.
+    dark=None : (int, int)
+        Range of positions used for the background. See Scan_accumulator.
+    alternate=False : bool
+        Scan back and forth instead of always from start to stop, which
+        saves slewing back but approaches every point from both sides, so
+        the backlash of the drive shifts every other pass.
+    writer=None : Monochromator_storage.Run_writer
+        If specified, receives every point of every pass.
+
+    Returns
+    -------
+    Scan_accumulator
+        Statistics of the passes. passes tells how many were done.
+    """
+    accumulator = Scan_accumulator(start, stop, stride, dark, writer)
+    a, b        = start, int(accumulator.positions[-1]) # Back on the same grid when alternating
+    for n in range(passes):
+        accumulator.start_pass()
+        positions, counts = api.scan(a, b, stride, samples, accumulator)
+        accumulator.end_pass()
+
+        if len(positions) < len(accumulator): break # The scan was stopped
+        if target is not None and accumulator.converged(target): break
+        if alternate: a, b = b, a
+
+    return accumulator
+
+def find_windows(positions, counts, margin, threshold=None):
+    """
+    Windows around every point of a scan above threshold, merged where
+    they overlap.
+
+    Parameters
+    ----------
+    positions, counts : array-like
+        Scan data.
+    margin : int
+        Half width added on each side of a point (microsteps).
+    threshold=None : float
+        Level to exceed. Defaults to robust_threshold(counts).
+
+    Returns
+    -------
+    list
+        (low, high) of each window, in increasing order.
+    """
+    positions = _n.asarray(positions)
+    counts    = _n.asarray(counts, dtype=float)
+    if not len(counts): return []
+    if threshold is None: threshold = robust_threshold(counts)
+
+    found = _n.sort(positions[counts > threshold])
+    if not len(found): return []
+
+    # A new window starts wherever a point is too far from the previous one
+    starts = _n.concatenate([[0], _n.flatnonzero(_n.diff(found) > 2*margin) + 1])
+    ends   = _n.concatenate([starts[1:] - 1, [len(found)-1]])
+    return [(max(int(found[s]) - margin, 0), min(int(found[e]) + margin, MAX_STEP)) for s, e in zip(starts, ends)]
+
+def fly_sweep(api, start, stop, period_ms=5, writer=None):
+    """
+    Sweeps the motor from start to stop without stopping, reading the
+    position and PMT from the telemetry stream as it goes. Each point is a
+    single PMT reading, but the motor runs at cruise speed the whole way,
+    which makes this the fastest way to survey a range. Text protocol only.
+
+    Parameters
+    ----------
+    api : Monochromator_api
+        Connected instrument, not already subscribed to telemetry.
+    start, stop : int
+        Range of the sweep (microsteps).
+    period_ms=5 : int
+        Time between readings (ms).
+    writer=None : Monochromator_storage.Run_writer
+        If specified, receives (time, position, counts) of every reading.
+
+    Returns
+    -------
+    positions, counts : numpy.ndarray
+        Readings in the order they were taken.
+    """
+    readings = []
+    def take(status):
+        readings.append((status['time'], status['position'], status['pmt']))
+        if writer is not None: writer.append(readings[-1])
+
+    api.move_to(start)
+    api.wait_until_idle()
+    api.subscribe(take, period_ms)
+    try:
+        api.move_to(stop)
+        api.wait_until_idle(interval=period_ms*1e-3)
+    finally: api.unsubscribe()
+
+    if not readings: return _n.zeros(0, dtype=int), _n.zeros(0)
+    times, positions, counts = _n.array(readings).T
+    return positions.astype(int), counts
+
+def adaptive_scan(api, start=0, stop=MAX_STEP, coarse_stride=None, coarse_samples=1, fine_stride=1, fine_samples=16,
+                  margin=None, threshold=None, segment=2000, writer=None):
+    """
+    Coarse-to-fine scan: a quick sweep of the range, with the windows where
+    the counts stand out of the noise rescanned at fine_stride.
+
+    The sweep is done in segments, and the windows found in a segment are
+    rescanned before moving on, going the same way as the sweep. Going back
+    over a window costs twice its width, where a separate fine pass after
+    the sweep would first have to slew back across the whole range. The
+    window margins are baseline, so the backlash taken up when the motor
+    turns around at the start of a window only affects points of no
+    interest.
+
+    Parameters
+    ----------
+    api : Monochromator_api
+        Connected instrument.
+    start=0, stop=MAX_STEP : int
+        Range of the sweep. stop may be less than start.
+    coarse_stride=None : int
+        Stride (microsteps) of the sweep. None sweeps on the fly (see
+        fly_sweep()), unless the api is already subscribed to telemetry, in
+        which case 40 is used. Lines narrower than the stride can be missed.
+    coarse_samples=1 : int
+        PMT readings per point of the sweep, when coarse_stride is given.
+    fine_stride=1, fine_samples=16 : int
+        Stride and PMT readings per point in the windows.
+    margin=None : int
+        Half width of the windows around each point that stood out.
+        Defaults to 2*coarse_stride (50 on the fly), so the whole line is
+        covered even if the sweep only caught its edge.
+    threshold=None : float
+        Level that counts must exceed in the sweep. Defaults to
+        robust_threshold() of the sweep so far.
+    segment=2000 : int
+        Length of the sweep segments (microsteps). Shorter segments mean
+        shorter trips back to the windows, but each one ramps the motor
+        down and up again.
+    writer=None : Monochromator_storage.Run_writer
+        If specified, receives the points of every scan as they arrive.
+
+    Returns
+    -------
+    positions, counts : numpy.ndarray
+        Sweep points outside the windows and all the fine points, sorted by
+        position.
+    windows : list
+        (low, high) of the windows that were rescanned.
+    """
+    fly = coarse_stride is None and not api.subscribed
+    if coarse_stride is None: coarse_stride = 1 if fly else 40
+    if margin        is None: margin        = 50 if fly else 2*coarse_stride
+
+    sign    = 1 if stop >= start else -1
+    segment = max(segment//coarse_stride, 1)*coarse_stride # Keep the sweep on one grid
+    binary  = api.binary_mode
+
+    coarse_positions, coarse_counts = _n.zeros(0, dtype=int), _n.zeros(0)
+    fine_positions,   fine_counts   = [], []
+    windows = []
+
+    a = start
+    while sign*(stop - a) >= 0:
+        b = a + sign*min(segment, abs(stop - a))
+        if fly:
+            if binary: api.set_binary(False)
+            p, c = fly_sweep(api, a, b, writer=writer)
+            if binary: api.set_binary(True)
+        else: p, c = api.scan(a, b, coarse_stride, coarse_samples, writer)
+        coarse_positions = _n.concatenate([coarse_positions, p])
+        coarse_counts    = _n.concatenate([coarse_counts,    c])
+        a = b + sign*coarse_stride
+        last = sign*(stop - a) < 0 or not len(p) # Done, or the scan was stopped
+
+        # Rescan the new windows the sweep has gone past, or all of them at the end
+        for low, high in find_windows(coarse_positions, coarse_counts, margin, threshold):
+            if any(low <= h and high >= l for l, h in windows): continue
+            if not last and (high >= b if sign > 0 else low <= b): continue
+            windows.append((low, high))
+            p, c = api.scan(low, high, fine_stride, fine_samples, writer) if sign > 0 else \
+                   api.scan(high, low, fine_stride, fine_samples, writer)
+            fine_positions.append(p)
+            fine_counts   .append(c)
+
+        if last: break
+
+    keep = _n.ones(len(coarse_positions), dtype=bool)
+    for low, high in windows: keep &= (coarse_positions < low) | (coarse_positions > high)
+
+    positions = _n.concatenate([coarse_positions[keep]] + fine_positions)
+    counts    = _n.concatenate([coarse_counts   [keep]] + fine_counts)
+    order     = _n.argsort(positions, kind='stable')
+    return positions[order], counts[order], sorted(windows)
@@ -0,0 +1,785 @@
+import os        as _os
+import time      as _time
+import math      as _math
+import struct    as _struct
+import threading as _threading
+import numpy     as _n
+
+from collections import deque as _deque
+
+from Monochromator_api import MAX_STEP, ADC_TIME, FRAME_SYNC, FRAME_VALUE, FRAME_SCAN, FRAME_SUM16, FRAME_SUM32, FRAME_END
+
+# Firmware constants (AtomicSpectra.ino)
+VERSION        = "1.0"  # FIRMWARE_VERSION
+BOOT_TIME      = 0.5    # Time from reset to the READY banner: bootloader and setup() (s)
+STEP_DELAY     = 560e-6 # Default high and low phase of a step (s)
+RAMP_SIZE      = 128    # Number of steps in the acceleration ramp
+QUEUE_SIZE     = 6      # Number of received commands that can wait to be parsed
+RX_BUFFER_SIZE = 64     # Size of the arduino's serial receive buffer (bytes). Bytes arriving when it is full are lost.
+DATA_SIZE      = 64     # Size of each command in the queue, terminator included
+TX_BUFFER_SIZE = 64     # Size of the arduino's serial transmit buffer (bytes)
+BOUNDS_LIMIT   = MAX_STEP//10 # check_bounds() limit while homing
+PROGRAM_SIZE   = 64     # Number of targets a move program can hold
+
+# Names in the order the firmware indexes them
+_calibrations = ["NOT_DONE", "COMPLETED", "FAILED", "RECAL"]
+_controls     = ["FRONT_PANEL", "COMPUTER"]
+_states       = ["IDLE", "MOVING", "HOMING", "HOMING_RETURN", "SCANNING"]
+
+# (position, amplitude, width) of the default emission lines, in microsteps and ADC counts
+DEFAULT_LINES = [
+    (11800, 420, 25),
+    (12250, 160, 25),
+    (24900, 830, 30),
+    (25350, 610, 30),
+    (33000,  90, 60),
+    (41100, 310, 40),
+    (52500, 540, 35),
+    ]
+
+class Spectrum():
+    """
+    Synthetic emission spectrum seen by the PMT, as a function of the
+    physical motor position.
+
+    Parameters
+    ----------
+    lines=DEFAULT_LINES : list
+        (position, amplitude, width) of each Gaussian emission line, in
+        microsteps and ADC counts.
+    dark=40 : float
+        Dark/background level (ADC counts).
+    noise=1.5 : float
+        Standard deviation of the readout noise (ADC counts).
+    shot=0.5 : float
+        Variance of the shot noise per ADC count of signal.
+    seed=None : int
+        Seed for the random number generator.
+    """
+    def __init__(self, lines=None, dark=40.0, noise=1.5, shot=0.5, seed=None):
+
+        self.lines  = list(DEFAULT_LINES if lines is None else lines)
+        self.dark   = dark
+        self.noise  = noise
+        self.shot   = shot
+        self.random = _n.random.default_rng(seed)
+
+    def mean(self, positions):
+        """
+        Noiseless signal at the given positions (ADC counts).
+        """
+        positions = _n.asarray(positions, dtype=float)
+        signal    = _n.full(positions.shape, float(self.dark))
+        for position, amplitude, width in self.lines:
+            signal += amplitude*_n.exp(-0.5*((positions-position)/width)**2)
+        return signal
+
+    def read(self, position, n=1):
+        """
+        n noisy 10-bit ADC readings at position.
+        """
+        mean   = self.mean(position)
+        values = self.random.normal(mean, _n.sqrt(self.noise**2 + self.shot*mean), n)
+        return _n.clip(_n.rint(values), 0, 1023).astype(_n.int64)
+
+class Virtual_monochromator():
+    """
+    Model of the arduino firmware and the hardware it drives, advanced in
+    discrete events on its own clock (s). It implements the serial command
+    set of serial_data.ino, including tags, binary frames, telemetry and the
+    non-blocking motion state machine, and models the time taken by motor
+    steps (with the acceleration ramp), ADC conversions and serial transfers.
+
+    Parameters
+    ----------
+    spectrum=None : Spectrum
+        What the PMT sees. Defaults to Spectrum().
+    baudrate=115200 : int
+        Baud rate used to compute transfer times.
+    start_position=MAX_STEP-2000 : int
+        Physical motor position at power-up, measured from the reverse end.
+        The max limit switch is at MAX_STEP. Homing only succeeds from
+        within BOUNDS_LIMIT of the switch, as with the firmware's check_bounds().
+    knob=512 : int
+        Front panel knob reading.
+    boot_time=BOOT_TIME : float
+        Time from a reset to the READY banner (s). Input is lost until then.
+    backlash=0 : int
+        Lost motion of the drive (microsteps): after a reversal, the motor
+        turns this many steps before the grating follows.
+    """
+    def __init__(self, spectrum=None, baudrate=115200, start_position=MAX_STEP-2000, knob=512, boot_time=BOOT_TIME, backlash=0):
+
+        self.spectrum  = Spectrum() if spectrum is None else spectrum
+        self.baudrate  = baudrate
+        self.physical  = start_position
+        self.knob      = knob
+        self.boot_time = boot_time
+        self.backlash  = backlash
+        self.slack     = 0 # Steps the motor can turn in reverse before the grating follows
+
+        self.reset(0.0, boot=False)
+
+    def reset(self, t, boot=True):
+        """
+        Power-up state of the firmware, at time t. If boot, the board runs
+        its bootloader and setup() first, then sends the READY banner.
+        """
+        self.now = t
+
+        # Firmware variables
+        self.position         = 0
+        self.direction        = 0
+        self.calibration      = 0
+        self.control          = 0
+        self.binary_mode      = False
+        self.telemetry_period = 0
+        self.telemetry_next   = t
+        self.reply_tag        = -1
+
+        # Motion
+        self.state        = 'IDLE'
+        self.target       = 0
+        self.steps_done   = 0
+        self.next_step    = t
+        self.max_speed    = 2400
+        self.acceleration = 20000
+        self.compute_ramp()
+
+        # Scan in progress, or None
+        self.scan = None
+
+        # Move program
+        self.program          = []
+        self.program_backlash = 0
+        self.program_approach = False
+
+        # Serial line. Commands are (time queued, text).
+        self.rx_buffer   = _deque()     # (arrival time, byte) in the receive buffer, not read by receive_data() yet
+        self.rx          = bytearray()
+        self.in_frame    = False
+        self.commands    = _deque()     # The firmware's command queue, at most QUEUE_SIZE
+        self.rx_free     = t
+        self.rx_dropped  = 0            # Bytes lost to a full receive buffer
+        self.tx          = _deque()     # (time the bytes are received by the host, bytes)
+        self.tx_free     = t
+        self.busy_until  = t            # The firmware is inside a blocking call until then
+
+        # Counters
+        self.bytes_in  = 0
+        self.bytes_out = 0
+        self.steps     = 0
+
+        # Booting: deaf until the banner
+        self.ready_time = t + self.boot_time if boot else t
+        if boot: self.emit(('READY,%s\r\n'%VERSION).encode(), self.ready_time)
+
+    ############################
+    # Serial line
+    ############################
+
+    def byte_time(self):
+        """
+        Time to transfer one byte (start bit, 8 data bits, stop bit).
+        """
+        return 10.0/self.baudrate
+
+    def receive(self, data, t):
+        """
+        Bytes written by the host at time t. Each byte lands in the receive
+        buffer when it has arrived, or is lost if the buffer is full, as
+        the firmware only empties it while its command queue has room.
+        """
+        byte_time = self.byte_time()
+        self.bytes_in += len(data)
+
+        for c in bytes(data):
+            self.rx_free = max(self.rx_free, t) + byte_time
+            if self.rx_free < self.ready_time: continue # Still booting
+
+            # Whatever the firmware does before the byte arrives may make room
+            self.run_until(self.rx_free)
+            if len(self.rx_buffer) >= RX_BUFFER_SIZE: self.rx_dropped += 1
+            else:                                      self.rx_buffer.append((self.rx_free, c))
+
+    def receive_data(self):
+        """
+        Moves bytes from the receive buffer into the command queue while it
+        has room, as receive_data() in serial_data.ino.
+        """
+        while self.rx_buffer and self.rx_buffer[0][0] <= self.now and len(self.commands) < QUEUE_SIZE:
+            c = self.rx_buffer.popleft()[1]
+
+            if self.in_frame:
+                if c == ord('>'):
+                    self.commands.append((self.now, self.rx.decode(errors='replace')[:DATA_SIZE-1]))
+                    self.rx.clear()
+                    self.in_frame = False
+                else: self.rx.append(c)
+
+            elif c == ord('<'): self.in_frame = True
+
+    def emit(self, data, t=None):
+        """
+        Sends bytes to the host, starting no earlier than t (default now).
+        Like Serial.print(), this blocks the firmware while the transmit
+        buffer is full.
+        """
+        t = self.now if t is None else t
+        byte_time = self.byte_time()
+
+        start        = max(t, self.tx_free)
+        self.tx_free = start + len(data)*byte_time
+        self.tx.append((self.tx_free, bytes(data)))
+        self.bytes_out += len(data)
+
+        self.busy_until = max(self.busy_until, t, self.tx_free - TX_BUFFER_SIZE*byte_time)
+
+    def reply(self, text, t=None):
+        """
+        Sends a text line, echoing the tag of the command being answered.
+        """
+        prefix = '' if self.reply_tag < 0 else '#%d:'%self.reply_tag
+        self.emit((prefix + str(text) + '\r\n').encode(), t)
+
+    def frame(self, kind, payload, t=None):
+        """
+        Sends a binary frame.
+        """
+        checksum = kind ^ len(payload)
+        for b in payload: checksum ^= b
+        self.emit(bytes([FRAME_SYNC, kind, len(payload)]) + payload + bytes([checksum]), t)
+
+    def value(self, value, t=None):
+        """
+        Sends a number as a frame in binary mode, or as text otherwise.
+        """
+        if self.binary_mode: self.frame(FRAME_VALUE, _struct.pack('<H', value & 0xFFFF), t)
+        else:                self.reply(value, t)
+
+    ############################
+    # Event loop
+    ############################
+
+    def next_event_time(self):
+        """
+        Time of the next thing the firmware will do, or None if it is waiting for input.
+        """
+        times = []
+        if self.rx_buffer and len(self.commands) < QUEUE_SIZE: times.append(max(self.rx_buffer[0][0], self.busy_until))
+        if self.commands: times.append(max(self.commands[0][0], self.busy_until))
+        if self.state != 'IDLE': times.append(self.next_step)
+        if self.scan is not None and self.state == 'IDLE': times.append(max(self.now, self.busy_until))
+        if self.telemetry_period: times.append(max(self.telemetry_next, self.busy_until))
+        return min(times) if times else None
+
+    def run_until(self, t):
+        """
+        Processes everything the firmware does up to time t.
+        """
+        while True:
+            t_next = self.next_event_time()
+            if t_next is None or t_next > t: break
+            self.now = max(self.now, t_next)
+
+            # Same priorities as loop(): reading, commands, motion, scan, telemetry
+            if self.rx_buffer and len(self.commands) < QUEUE_SIZE and max(self.rx_buffer[0][0], self.busy_until) <= self.now:
+                self.receive_data()
+            elif self.commands and max(self.commands[0][0], self.busy_until) <= self.now:
+                self.parse(self.commands.popleft()[1])
+            elif self.state != 'IDLE' and self.next_step <= self.now:
+                self.motion_update()
+            elif self.scan is not None and self.state == 'IDLE' and self.busy_until <= self.now:
+                self.scan_update()
+            else:
+                self.send_telemetry()
+
+        self.now = max(self.now, t)
+
+    ############################
+    # Motion
+    ############################
+
+    def compute_ramp(self):
+        """
+        Step intervals (s) of the acceleration ramp, as compute_ramp() in motion.ino.
+        """
+        cruise = int(1000000/self.max_speed)
+        start  = 1/(2*STEP_DELAY) # Start/stop speed (steps/s)
+        ramp   = []
+        while len(ramp) < RAMP_SIZE-1:
+            interval = 1e6/_math.sqrt(start**2 + 2.0*self.acceleration*len(ramp))
+            if interval <= cruise: break
+            ramp.append(int(interval))
+
+        if len(ramp) == RAMP_SIZE-1: cruise = ramp[-1]
+        ramp.append(cruise)
+        self.ramp = [interval*1e-6 for interval in ramp]
+
+    def start_move(self, target):
+        target = min(target, MAX_STEP)
+        self.direction  = 0 if target > self.position else 1
+        self.target     = target
+        self.state      = 'MOVING'
+        self.steps_done = 0
+
+    def start_home(self):
+        self.position   = 0
+        self.direction  = 0
+        self.state      = 'HOMING'
+        self.steps_done = 0
+
+    def stop_motion(self):
+        self.state = 'IDLE'
+        if self.scan is not None: self.finish_scan()
+
+    def state_index(self):
+        return 4 if self.scan is not None else _states.index(self.state)
+
+    def motion_update(self):
+        """
+        One decision of the motion state machine: either a step or a change of state.
+        """
+        if self.state == 'MOVING' and self.position == self.target:
+            self.state = 'IDLE'
+            return
+
+        if self.state == 'HOMING':
+            if self.position > BOUNDS_LIMIT: self.calibration = 2 # FAILED
+            if self.calibration == 2 or self.physical >= MAX_STEP:
+                self.direction  = 1
+                displacement    = self.position
+                self.position   = MAX_STEP
+                self.target     = MAX_STEP - displacement
+                self.state      = 'HOMING_RETURN'
+                self.steps_done = 0
+                return
+
+        if self.state == 'HOMING_RETURN' and self.position == self.target:
+            if self.calibration != 2: self.calibration = 1 # COMPLETED
+            self.state = 'IDLE'
+            return
+
+        remaining = RAMP_SIZE if self.state == 'HOMING' else abs(self.target - self.position)
+        interval  = self.ramp[min(self.steps_done, remaining-1, len(self.ramp)-1)]
+        if self.steps_done < RAMP_SIZE: self.steps_done += 1
+
+        # Always head for the target, whatever set_direction was given since
+        if self.state != 'HOMING': self.direction = int(self.target < self.position)
+
+        step = -1 if self.direction else 1
+        self.position  = (self.position + step) & 0xFFFF # unsigned int
+        self.steps    += 1
+
+        # The grating only moves once the slack of the drive is taken up
+        if   step > 0 and self.slack > 0:             self.slack -= 1
+        elif step < 0 and self.slack < self.backlash: self.slack += 1
+        else:                                         self.physical += step
+
+        self.next_step = self.now + interval
+
+    ############################
+    # Scans
+    ############################
+
+    def start_scan(self, start, stop, stride, samples):
+        start, stop = min(start, MAX_STEP), min(stop, MAX_STEP)
+        stride, samples = max(stride, 1), max(samples, 1)
+
+        reverse = stop < start
+        points  = (start-stop if reverse else stop-start)//stride + 1
+        self.scan = dict(points=points, index=0, stride=stride, samples=samples,
+                         reverse=reverse, tag=self.reply_tag, sums=[])
+
+        if self.binary_mode: self.frame(FRAME_SCAN, _struct.pack('<HhH', start, -stride if reverse else stride, points))
+        else:                self.reply('SCAN,%d'%points)
+
+        self.start_move(start)
+
+    def start_program(self, samples, backlash):
+        samples = max(samples, 1)
+        self.program_backlash = backlash
+        self.scan = dict(points=len(self.program), index=0, stride=0, samples=samples,
+                         reverse=False, tag=self.reply_tag, sums=[], program=True)
+
+        if self.binary_mode: self.frame(FRAME_SCAN, _struct.pack('<HhH', self.program[0] if self.program else self.position, 0, len(self.program)))
+        else:                self.reply('SCAN,%d'%len(self.program))
+
+        if not self.program: self.finish_scan()
+        else:                self.start_program_move(self.program[0])
+
+    def start_program_move(self, target):
+        """
+        Moves to target with the last program_backlash steps forward, as start_program_move() in motion.ino.
+        """
+        reversing = self.direction == 1 or target < self.position
+        if self.program_backlash and reversing and target < self.position + self.program_backlash:
+            self.program_approach = True
+            self.start_move(max(target - self.program_backlash, 0))
+        else: self.start_move(target)
+
+    def _scan_block_send(self, t=None):
+        scan = self.scan
+        wide = scan['samples'] > 64
+        self.frame(FRAME_SUM32 if wide else FRAME_SUM16,
+                   _struct.pack('<%d%s'%(len(scan['sums']), 'I' if wide else 'H'), *scan['sums']), t)
+        scan['sums'] = []
+
+    def scan_update(self):
+        """
+        Takes the scan point the motor has arrived at.
+        """
+        scan = self.scan
+
+        # Arrived below a program target: now go up to it
+        if self.program_approach:
+            self.program_approach = False
+            self.start_move(self.program[scan['index']])
+            return
+
+        total = int(self.spectrum.read(self.physical, scan['samples']).sum())
+        done  = self.now + scan['samples']*ADC_TIME
+        self.busy_until = done
+
+        tag, self.reply_tag = self.reply_tag, scan['tag']
+        if self.binary_mode:
+            scan['sums'].append(total)
+            width = 4 if scan['samples'] > 64 else 2
+            if len(scan['sums'])*width == 128 or scan['index'] == scan['points']-1: self._scan_block_send(done)
+        else:
+            self.reply('%d,%d'%(self.position, total), done)
+        self.reply_tag = tag
+
+        scan['index'] += 1
+        if scan['index'] == scan['points']: self.finish_scan(done)
+        else:
+            if   scan.get('program'): self.start_program_move(self.program[scan['index']])
+            elif scan['reverse']:     self.start_move(self.position - scan['stride'])
+            else:                     self.start_move(self.position + scan['stride'])
+            self.next_step = max(self.next_step, self.busy_until)
+
+    def finish_scan(self, t=None):
+        tag, self.reply_tag = self.reply_tag, self.scan['tag']
+        if self.binary_mode:
+            if self.scan['sums']: self._scan_block_send(t)
+            self.frame(FRAME_END, b'', t)
+        else: self.reply('END', t)
+        self.reply_tag = tag
+        self.scan = None
+        self.program_approach = False
+
+    ############################
+    # Telemetry
+    ############################
+
+    def send_telemetry(self):
+        self.telemetry_next += self.telemetry_period*1e-3
+        if self.telemetry_next <= self.now: self.telemetry_next = self.now + self.telemetry_period*1e-3
+
+        pmt = int(self.spectrum.read(self.physical)[0])
+        self.emit(('T,%d,%d,%d,%d,%d,%d,%d,%d,%d\r\n'%(
+            self.position, self.direction, self.calibration, self.control,
+            self.max_limit(), self.min_limit(), self.knob, pmt, self.state_index())).encode(),
+            self.now + 2*ADC_TIME)
+
+    ############################
+    # Commands
+    ############################
+
+    def max_limit(self): return int(self.physical >= MAX_STEP)
+    def min_limit(self): return int(self.physical <= 0)
+
+    def pmt_stats(self, samples, duration):
+        """
+        Reply to get_pmt_avg / get_pmt_time, taking the readings' time.
+        """
+        if not samples: samples = max(int(_math.ceil(duration/ADC_TIME)), 1)
+        values = self.spectrum.read(self.physical, samples)
+        done   = self.now + samples*ADC_TIME
+        self.busy_until = done
+        self.reply('%d,%d,%d,%d,%d'%(samples, values.sum(), (values*values).sum(), values.min(), values.max()), done)
+
+    def parse(self, text):
+        """
+        Executes one command, as parseData() in serial_data.ino.
+        """
+        self.reply_tag = -1
+        if text.startswith('#') and ':' in text:
+            tag, text = text[1:].split(':', 1)
+            self.reply_tag = _strtoul(tag)
+
+        args = text.split(',')
+        name = args.pop(0)
+
+        def arg(fallback):
+            return _strtoul(args.pop(0)) if args else fallback
+
+        if   name == 'step_motor':
+            steps = arg(0)
+            self.stop_motion()
+            if self.direction: self.start_move(max(self.position - steps, 0))
+            else:              self.start_move(self.position + steps)
+        elif name == 'move_to':
+            self.stop_motion()
+            self.start_move(arg(self.position))
+        elif name == 'stop':            self.stop_motion()
+        elif name == 'get_state':       self.reply(_states[self.state_index()])
+        elif name == 'set_speed':
+            self.max_speed = max(arg(self.max_speed), 16)
+            self.compute_ramp()
+        elif name == 'get_speed':       self.reply(self.max_speed)
+        elif name == 'set_accel':
+            self.acceleration = max(arg(self.acceleration), 1)
+            self.compute_ramp()
+        elif name == 'get_accel':       self.reply(self.acceleration)
+        elif name == 'get_pmt':         self.value(int(self.spectrum.read(self.physical)[0]), self.now + ADC_TIME)
+        elif name == 'get_pmt_avg':     self.pmt_stats(arg(1), 0)
+        elif name == 'get_pmt_time':    self.pmt_stats(0, arg(0)*1e-6)
+        elif name == 'set_direction':
+            if self.state_index() == 0: self.direction = int(bool(arg(0))) # Ignored while the motor is moving
+        elif name == 'get_direction':   self.value(self.direction)
+        elif name == 'set_control':
+            if args and args[0] in _controls: self.control = _controls.index(args[0])
+        elif name == 'get_control':     self.reply(_controls[self.control])
+        elif name == 'get_knob':        self.value(self.knob, self.now + ADC_TIME)
+        elif name == 'get_calibration': self.reply(_calibrations[self.calibration])
+        elif name == 'get_position':    self.value(self.position)
+        elif name == 'get_u1':          self.reply(0)
+        elif name == 'get_max_limit':   self.value(self.max_limit())
+        elif name == 'get_min_limit':   self.value(self.min_limit())
+        elif name == 'home':
+            self.reply('HOMING')
+            self.stop_motion()
+            self.start_home()
+        elif name == 'scan':
+            start   = arg(self.position)
+            stop    = arg(start)
+            stride  = arg(1)
+            samples = arg(1)
+            self.stop_motion()
+            self.start_scan(start & 0xFFFF, stop & 0xFFFF, stride & 0xFFFF, samples & 0xFFFF)
+        elif name == 'set_binary':
+            self.binary_mode = bool(arg(0))
+            self.reply('BINARY,%d'%self.binary_mode)
+        elif name == 'subscribe':
+            self.telemetry_period = arg(0)
+            self.telemetry_next   = self.now + self.telemetry_period*1e-3
+        elif name == 'ping':            self.reply('PONG,%s'%VERSION)
+        elif name == 'prog_clear':      self.program = []
+        elif name == 'prog_add':
+            while args and len(self.program) < PROGRAM_SIZE: self.program.append(arg(0) & 0xFFFF)
+        elif name == 'prog_run':
+            samples  = arg(1)
+            backlash = arg(0)
+            self.stop_motion()
+            self.start_program(samples & 0xFFFF, backlash & 0xFFFF)
+
+def _strtoul(text):
+    """
+    Leading digits of text as a number, like strtoul() (0 if there are none).
+    """
+    digits = ''
+    for c in text.strip():
+        if not c.isdigit(): break
+        digits += c
+    return int(digits) if digits else 0
+
+class Simulated_serial():
+    """
+    Stand-in for serial.Serial connected to a Virtual_monochromator. It
+    supports the parts of the pyserial interface used by the api: read(),
+    read_until(), write(), in_waiting, reset_input_buffer() and close().
+
+    Parameters
+    ----------
+    port='Simulation' : str
+        Only used for display.
+    baudrate=115200 : int
+        Baud rate, used for transfer times.
+    timeout=None : float
+        Read timeout (s), as for serial.Serial.
+    realtime=True : bool
+        If True, the instrument runs on the wall clock and reads really wait.
+        If False, whenever a read has to wait, the simulated clock jumps
+        straight to the next reply, so long moves and scans take no real time.
+        clock() always returns the simulated time.
+    monochromator=None : Virtual_monochromator
+        The simulated instrument. Defaults to a new one.
+    dtr=True : bool
+        Whether opening the port asserts DTR, which resets the board like 
+        a real arduino. If False, the board is already running.
+    """
+    def __init__(self, port='Simulation', baudrate=115200, timeout=None, realtime=True, monochromator=None, dtr=True, **kwargs):
+
+        self.port          = port
+        self.baudrate      = baudrate
+        self.timeout       = timeout
+        self.write_timeout = None
+        self.realtime      = realtime
+        self.monochromator = Virtual_monochromator(baudrate=baudrate) if monochromator is None else monochromator
+        self.is_open       = True
+
+        self._t0     = _time.monotonic()
+        self._offset = self.monochromator.now # Time skipped ahead while waiting (not realtime)
+        self._buffer = bytearray()        # Received by the host, not read yet
+        self._lock   = _threading.Condition(_threading.RLock()) # Released while a read waits, so writes are never held up
+
+        self.dtr = dtr
+        if dtr: self.monochromator.reset(self.clock())
+
+    def clock(self):
+        """
+        Current simulated time (s).
+        """
+        return _time.monotonic() - self._t0 + self._offset
+
+    def _sync(self, t=None):
+        """
+        Runs the instrument up to time t (default now) and collects what it sent.
+        """
+        t = self.clock() if t is None else t
+        self.monochromator.run_until(t)
+        tx = self.monochromator.tx
+        while tx and tx[0][0] <= t: self._buffer += tx.popleft()[1]
+
+    def _wait(self, ready):
+        """
+        Waits until ready(buffer) returns the number of bytes to hand back,
+        or the timeout expires. Returns the bytes.
+        """
+        with self._lock:
+            if not self.is_open: raise Exception('Port is closed.')
+
+            deadline = None if self.timeout is None else self.clock() + self.timeout
+            while True:
+                self._sync()
+                size = ready(self._buffer)
+                if size is not None: break
+
+                now    = self.clock()
+                t_next = self.monochromator.next_event_time()
+                if self.monochromator.tx:
+                    t_next = self.monochromator.tx[0][0] if t_next is None else min(t_next, self.monochromator.tx[0][0])
+
+                if deadline is not None and now >= deadline: break
+                if deadline is None and t_next is None and not self.realtime: break # Nothing will ever arrive
+
+                wake = deadline if t_next is None else (t_next if deadline is None else min(t_next, deadline))
+                if self.realtime: self._lock.wait(min(max(wake - now, 0), 0.01) if wake is not None else 0.01)
+                else:             self._offset += max(wake - now, 0)
+
+            if size is None: size = len(self._buffer)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def sleep(self, seconds):
+        """
+        Waits on the simulated clock: really sleeps in realtime, otherwise
+        skips the clock ahead, running the instrument meanwhile.
+        """
+        if self.realtime: return _time.sleep(seconds)
+        with self._lock:
+            self._offset += max(seconds, 0)
+            self._sync()
+
+    def read(self, size=1):
+        """
+        Reads size bytes, or fewer if the timeout expires.
+        """
+        return self._wait(lambda buffer: size if len(buffer) >= size else None)
+
+    def read_until(self, expected=b'\n', size=None):
+        """
+        Reads up to and including expected, or fewer if the timeout expires.
+        """
+        def ready(buffer):
+            index = buffer.find(expected)
+            if index >= 0 and (size is None or index + len(expected) <= size): return index + len(expected)
+            if size is not None and len(buffer) >= size: return size
+            return None
+        return self._wait(ready)
+
+    def write(self, data):
+        """
+        Sends bytes to the instrument.
+        """
+        with self._lock:
+            if not self.is_open: raise Exception('Port is closed.')
+            self._sync()
+            self.monochromator.receive(data, self.clock())
+            self._lock.notify_all() # A waiting read may now get its reply sooner
+            return len(data)
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._sync()
+            return len(self._buffer)
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._sync()
+            self._buffer.clear()
+
+    def reset_output_buffer(self): return
+    def flush(self):               return
+
+    def open(self):
+        self.is_open = True
+        if self.dtr: 
+            with self._lock: self.monochromator.reset(self.clock())
+    def close(self): self.is_open = False
+
+class Pty_server():
+    """
+    Exposes a Simulated_serial as a pseudo-terminal (POSIX only), so any
+    program can open the simulated instrument by port name.
+
+    Parameters
+    ----------
+    serial=None : Simulated_serial
+        Simulated port to expose. Defaults to a new realtime one.
+
+    Attributes
+    ----------
+    port : str
+        Name of the pseudo-terminal to connect to.
+    """
+    def __init__(self, serial=None):
+        import tty    as _tty
+        import select as _select
+        self._select = _select
+
+        self.serial = Simulated_serial(timeout=0) if serial is None else serial
+        self.serial.timeout = 0
+
+        self._master, self._slave = _os.openpty()
+        _tty.setraw(self._slave)
+        self.port = _os.ttyname(self._slave)
+
+        self._running = True
+        self._thread  = _threading.Thread(target=self._pump, daemon=True)
+        self._thread.start()
+
+    def _pump(self):
+        """
+        Moves bytes between the pseudo-terminal and the simulated port.
+        """
+        while self._running:
+            readable = self._select.select([self._master], [], [], 0.001)[0]
+            if readable:
+                try:            self.serial.write(_os.read(self._master, 1024))
+                except OSError: break
+
+            waiting = self.serial.in_waiting
+            if waiting: _os.write(self._master, self.serial.read(waiting))
+
+    def stop(self):
+        """
+        Stops serving and closes the pseudo-terminal.
+        """
+        self._running = False
+        self._thread.join()
+        _os.close(self._master)
+        _os.close(self._slave)
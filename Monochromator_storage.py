@@ -0,0 +1,213 @@
+"""
+Append-only on-disk storage for acquisitions. A run is a directory with one
+raw little-endian file per column and a manifest.json describing them:
+
+    run/
+        manifest.json   columns, dtypes, number of committed rows, metadata
+        time.bin
+        position.bin
+        ...
+
+Rows are buffered in memory and written in chunks. The manifest is only
+rewritten (atomically) after the data it counts is on disk, so after a
+crash a run opens with everything up to the last flush, and any partial
+chunk past that is ignored. Finished runs are memory-mapped for reading, so
+multi-hour runs can be sliced without loading them.
+"""
+import os        as _os
+import json      as _json
+import time      as _time
+import threading as _threading
+import numpy     as _n
+
+MANIFEST = 'manifest.json'
+
+# One point of a scan, as streamed by Monochromator_api.scan()
+SCAN_DTYPE = _n.dtype([
+    ('time'    , '<f8'), # time.time() when the point arrived (s)
+    ('position', '<i4'), # Absolute motor position (microsteps)
+    ('counts'  , '<f8'), # Mean digitized PMT voltage
+    ])
+
+class Run_writer():
+    """
+    Streams rows into a new run directory.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the run. Must not already hold a run.
+    dtype : numpy.dtype
+        Structured type of one row, e.g. SAMPLE_DTYPE or SCAN_DTYPE. Each
+        field becomes a column file.
+    chunk_size=4096 : int
+        Number of rows buffered before they are written.
+    flush_interval=1.0 : float
+        Longest time rows wait in memory before being committed (s).
+    metadata=None : dict
+        JSON-serializable information saved with the run.
+    """
+    def __init__(self, path, dtype, chunk_size=4096, flush_interval=1.0, metadata=None):
+
+        if _os.path.exists(_os.path.join(path, MANIFEST)): raise Exception('%s already holds a run.'%path)
+        _os.makedirs(path, exist_ok=True)
+
+        self.path           = path
+        self.dtype          = _n.dtype(dtype).newbyteorder('<')
+        self.flush_interval = flush_interval
+        self.metadata       = dict() if metadata is None else dict(metadata)
+        self.rows           = 0     # Rows committed to disk
+        self.finished       = False
+
+        self._chunk      = _n.zeros(chunk_size, self.dtype)
+        self._filled     = 0
+        self._last_flush = _time.time()
+        self._lock       = _threading.Lock()
+        self._files      = {name: open(_os.path.join(path, name+'.bin'), 'wb') for name in self.dtype.names}
+        self._created    = _time.strftime('%Y-%m-%dT%H:%M:%S')
+
+        self._write_manifest()
+
+    def __enter__(self): return self
+    def __exit__(self, *a): self.close()
+
+    def append(self, row):
+        """
+        Adds one row (a tuple with a value for each field).
+        """
+        with self._lock:
+            if self.finished: raise Exception('The run is closed.')
+            self._chunk[self._filled] = row
+            self._filled += 1
+            if self._filled == len(self._chunk) or _time.time() - self._last_flush > self.flush_interval: self._flush()
+
+    def extend(self, rows):
+        """
+        Adds many rows (a structured array, or a sequence of tuples).
+        """
+        rows = _n.asarray(rows, self.dtype) if not isinstance(rows, _n.ndarray) else rows
+        with self._lock:
+            if self.finished: raise Exception('The run is closed.')
+            start = 0
+            while start < len(rows):
+                size = min(len(rows) - start, len(self._chunk) - self._filled)
+                for name in self.dtype.names: self._chunk[name][self._filled:self._filled+size] = rows[name][start:start+size]
+                self._filled += size
+                start        += size
+                if self._filled == len(self._chunk): self._flush()
+            if _time.time() - self._last_flush > self.flush_interval: self._flush()
+
+    def flush(self):
+        """
+        Commits the buffered rows to disk.
+        """
+        with self._lock: self._flush()
+
+    def close(self):
+        """
+        Commits everything and marks the run finished.
+        """
+        with self._lock:
+            if self.finished: return
+            self._flush()
+            for file in self._files.values(): file.close()
+            self.finished = True
+            self._write_manifest()
+
+    def _flush(self):
+        if self._filled:
+            for name, file in self._files.items():
+                file.write(self._chunk[name][:self._filled].tobytes())
+                file.flush()
+                _os.fsync(file.fileno())
+            self.rows   += self._filled
+            self._filled = 0
+            self._write_manifest()
+        self._last_flush = _time.time()
+
+    def _write_manifest(self):
+        """
+        Replaces the manifest in one step, so it is never seen half written.
+        """
+        manifest = dict(version  = 1,
+                        created  = self._created,
+                        rows     = self.rows,
+                        finished = self.finished,
+                        columns  = [dict(name=name, dtype=self.dtype[name].str) for name in self.dtype.names],
+                        metadata = self.metadata)
+
+        temporary = _os.path.join(self.path, MANIFEST+'.tmp')
+        with open(temporary, 'w') as f:
+            _json.dump(manifest, f, indent=2)
+            f.flush()
+            _os.fsync(f.fileno())
+        _os.replace(temporary, _os.path.join(self.path, MANIFEST))
+
+class Run_reader():
+    """
+    Read-only view of a run written by Run_writer. Columns are memory-mapped,
+    so only the parts that are used are read from disk. A run that is still
+    being written (or was interrupted) shows the rows committed when it was
+    opened.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the run.
+
+    Attributes
+    ----------
+    columns : list
+        Column names, in order.
+    metadata : dict
+        Information saved with the run.
+    finished : bool
+        Whether the writer was closed properly.
+    """
+    def __init__(self, path):
+
+        with open(_os.path.join(path, MANIFEST)) as f: manifest = _json.load(f)
+
+        self.path     = path
+        self.rows     = manifest['rows']
+        self.finished = manifest['finished']
+        self.metadata = manifest['metadata']
+        self.created  = manifest['created']
+        self.dtype    = _n.dtype([(column['name'], column['dtype']) for column in manifest['columns']])
+        self.columns  = list(self.dtype.names)
+
+        self._maps = dict()
+
+    def __len__(self): return self.rows
+
+    def __getitem__(self, key):
+        """
+        A column by name (memory-mapped), or rows by index or slice (copied
+        into a structured array).
+        """
+        if isinstance(key, str): return self.column(key)
+        return self.slice(key)
+
+    def column(self, name):
+        """
+        Memory-mapped, read-only array of one column.
+        """
+        if name not in self._maps:
+            if self.rows == 0: self._maps[name] = _n.zeros(0, self.dtype[name])
+            else: self._maps[name] = _n.memmap(_os.path.join(self.path, name+'.bin'), self.dtype[name], 'r', shape=(self.rows,))
+        return self._maps[name]
+
+    def slice(self, index):
+        """
+        Rows at index (an int, slice or index array), as a structured array.
+        """
+        first = self.column(self.columns[0])[index]
+        rows  = _n.empty(_n.shape(first), self.dtype)
+        for name in self.columns: rows[name] = self.column(name)[index]
+        return rows
+
+def open_run(path):
+    """
+    Opens a run for reading. See Run_reader.
+    """
+    return Run_reader(path)